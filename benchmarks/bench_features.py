@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Microbenchmark of the shared feature module against the old pandas code.
+
+Times one call of training-feature extraction and next-period feature
+construction at 10, 1k and 100k rows:
+
+    python benchmarks/bench_features.py [--repeat N]
+"""
+import os
+import sys
+import argparse
+import timeit
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.features import (DEFAULT_FEATURES, parse_dates, parse_amounts, build_features,
+                         next_period_features, feature_vector)
+
+SIZES = [10, 1000, 100000]
+
+
+def make_expenses(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # One expense a day, so pandas' (unstable) sort gives the same order;
+    # 100k days from 1700 stays inside the datetime64[ns] range
+    dates = np.datetime64('1700-01-01') + np.arange(n)
+    amounts = np.round(rng.gamma(3.0, 20.0, n), 2)
+    return [{'amount': str(a), 'date': f'{d}T00:00:00.000Z'} for a, d in zip(amounts, dates)]
+
+
+def pandas_features(expenses):
+    """The feature code previously copied into ml_service.py and ml/predict.py"""
+    df = pd.DataFrame(expenses)
+    df['date'] = pd.to_datetime(df['date'])
+    df['amount'] = pd.to_numeric(df['amount'])
+    df['month'] = df['date'].dt.month
+    df['year'] = df['date'].dt.year
+    df['day_of_month'] = df['date'].dt.day
+    df['day_of_week'] = df['date'].dt.dayofweek
+    df['is_weekend'] = df['day_of_week'].apply(lambda x: 1 if x >= 5 else 0)
+    df = df.sort_values('date')
+    df['days_since_first'] = (df['date'] - df['date'].min()).dt.days
+    df['seq'] = range(len(df))
+    df['prev_amount'] = df['amount'].shift(1)
+    df['prev_amount_2'] = df['amount'].shift(2)
+    df['prev_amount_3'] = df['amount'].shift(3)
+    df['rolling_mean_2'] = df['amount'].rolling(window=2).mean()
+    df['rolling_mean_3'] = df['amount'].rolling(window=3).mean()
+    df['rolling_std_3'] = df['amount'].rolling(window=3).std()
+    df['trend'] = df['seq'] / max(1, df['seq'].max())
+    df_clean = df.dropna().copy()
+
+    next_month_date = df['date'].max() + timedelta(days=30)
+    next_month_features = {
+        'month': next_month_date.month,
+        'day_of_month': next_month_date.day,
+        'is_weekend': 1 if next_month_date.weekday() >= 5 else 0,
+        'days_since_first': (next_month_date - df['date'].min()).days,
+        'seq': df['seq'].max() + 1,
+        'trend': 1.0,
+        'prev_amount': df['amount'].iloc[-1],
+        'rolling_mean_3': df['amount'].tail(3).mean()
+    }
+    return df_clean[DEFAULT_FEATURES], pd.DataFrame([next_month_features])
+
+
+def numpy_features(expenses):
+    """The same work through ml/features.py"""
+    dates = parse_dates([row['date'] for row in expenses])
+    amounts = parse_amounts([row['amount'] for row in expenses])
+    order = np.argsort(dates, kind='stable')
+    dates, amounts = dates[order], amounts[order]
+    columns = build_features(dates, amounts)
+    matrix = np.column_stack([columns[name] for name in DEFAULT_FEATURES])[columns['valid']]
+    return matrix, feature_vector(next_period_features(dates, amounts))
+
+
+def numpy_features_from_arrays(dates, amounts):
+    """ml/features.py on arrays that are already parsed and sorted"""
+    columns = build_features(dates, amounts)
+    matrix = np.column_stack([columns[name] for name in DEFAULT_FEATURES])[columns['valid']]
+    return matrix, feature_vector(next_period_features(dates, amounts))
+
+
+def check_parity(expenses):
+    old_matrix, old_next = pandas_features(expenses)
+    new_matrix, new_next = numpy_features(expenses)
+    assert np.allclose(old_matrix.to_numpy(dtype=np.float64), new_matrix), 'training features differ'
+    assert np.allclose(old_next[DEFAULT_FEATURES].to_numpy(dtype=np.float64)[0], new_next), 'next-period features differ'
+
+
+def per_call(fn, args, repeat):
+    timer = timeit.Timer(lambda: fn(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'pandas (ms)':>12} {'numpy (ms)':>12} {'speedup':>8} {'arrays only (ms)':>17}")
+    for n in SIZES:
+        expenses = make_expenses(n)
+        check_parity(expenses)
+        dates = parse_dates([row['date'] for row in expenses])
+        amounts = parse_amounts([row['amount'] for row in expenses])
+
+        old = per_call(pandas_features, (expenses,), args.repeat)
+        new = per_call(numpy_features, (expenses,), args.repeat)
+        arrays = per_call(numpy_features_from_arrays, (dates, amounts), args.repeat)
+        print(f"{n:>8} {old * 1000:>12.3f} {new * 1000:>12.3f} {old / new:>7.1f}x {arrays * 1000:>17.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""Synthetic-load benchmark of /train, /predict and ml/predict.py.
+
+Drives the service in-process (Flask test client, no network) or over HTTP
+against a running service, at one or more concurrency levels, and reports
+p50/p95/p99 latency, throughput and peak RSS:
+
+    python benchmarks/bench_service.py --rows 50,1000 --concurrency 1,4
+    python benchmarks/bench_service.py --mode http --url http://localhost:5000 --server-pid <pid>
+
+Results are written as JSON (benchmarks/results/<commit>.json by default);
+compare two runs with benchmarks/compare.py.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import workload, DISTRIBUTIONS, GAPS
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SCENARIOS = ['train', 'predict', 'predict_script', 'predict_serve']
+PREDICT_SCRIPT = os.path.join(ROOT, 'ml', 'predict.py')
+TRAIN_WAIT = 25
+TRAIN_TIMEOUT = 600
+
+
+class InProcessClient:
+    """Calls the Flask app of ml_service.py through its test client"""
+
+    def __init__(self):
+        import ml_service
+        self.service = ml_service
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.service.app.test_client()
+        return self._local.client
+
+    def post(self, path, body):
+        response = self._client().post(path, json=body)
+        return response.status_code, response.get_json()
+
+    def get(self, path):
+        response = self._client().get(path)
+        return response.status_code, response.get_json()
+
+    def close(self):
+        self.service.training_jobs.shutdown()
+
+
+class HttpClient:
+    """Calls a running service over HTTP"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _request(self, request):
+        try:
+            with urllib.request.urlopen(request, timeout=TRAIN_TIMEOUT) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, None
+
+    def post(self, path, body):
+        return self._request(urllib.request.Request(
+            self.url + path, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'}))
+
+    def get(self, path):
+        return self._request(urllib.request.Request(self.url + path))
+
+    def close(self):
+        pass
+
+
+def train_op(client, group, granularity='transaction'):
+    status, job = client.post('/train', {'expenses': group['expenses'], 'user_id': group['user_id'],
+                                         'category': group['category'], 'wait': TRAIN_WAIT,
+                                         'granularity': granularity})
+    deadline = time.time() + TRAIN_TIMEOUT
+    while status == 202 and time.time() < deadline:
+        time.sleep(0.2)
+        status, job = client.get(f"/jobs/{job['job_id']}")
+    return status == 200 and job['status'] == 'succeeded'
+
+
+def predict_body(group, recent):
+    return {'recent_expenses': group['expenses'][-recent:], 'user_id': group['user_id'],
+            'category': group['category']}
+
+
+def predict_op(client, group, recent):
+    status, result = client.post('/predict', predict_body(group, recent))
+    return status == 200 and 'error' not in result
+
+
+def predict_script_op(group, recent, env):
+    body = predict_body(group, recent)
+    output = subprocess.run(
+        [sys.executable, PREDICT_SCRIPT,
+         json.dumps({'recent_expenses': body['recent_expenses'], 'model': {}}),
+         json.dumps({'user_id': body['user_id'], 'category': body['category']})],
+        capture_output=True, text=True, env=env).stdout
+    return 'error' not in json.loads(output)
+
+
+class ServeProcess:
+    """One ml/predict.py --serve process, answering one request at a time"""
+
+    def __init__(self, env):
+        self.process = subprocess.Popen([sys.executable, PREDICT_SCRIPT, '--serve'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, text=True, env=env)
+        self.next_id = 0
+
+    def predict(self, group, recent):
+        self.next_id += 1
+        self.process.stdin.write(json.dumps(dict(predict_body(group, recent), id=self.next_id, model={})) + '\n')
+        self.process.stdin.flush()
+        result = json.loads(self.process.stdout.readline())
+        return result['id'] == self.next_id and 'error' not in result
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def run_ops(op, items, concurrency):
+    """Run op(item) for every item on concurrency threads. Returns (latencies, errors, wall time)"""
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            ok = op(item)
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed, items))
+    wall = time.perf_counter() - start
+    latencies = [latency for latency, ok in outcomes if ok]
+    return latencies, len(outcomes) - len(latencies), wall
+
+
+def summarize(latencies, errors, wall):
+    ms = np.array(latencies) * 1000
+    summary = {'requests': len(latencies) + errors, 'errors': errors,
+               'wall_s': round(wall, 4), 'throughput_rps': round(len(latencies) / wall, 2) if wall > 0 else None}
+    for name, q in (('p50_ms', 50), ('p95_ms', 95), ('p99_ms', 99)):
+        summary[name] = round(float(np.percentile(ms, q)), 3) if len(ms) else None
+    summary['mean_ms'] = round(float(ms.mean()), 3) if len(ms) else None
+    return summary
+
+
+def peak_rss_kb(pid=None):
+    """Peak resident set size in KB of this process, or of pid and its child processes"""
+    if pid is None:
+        if resource is None:
+            return None
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        scale = 1024 if sys.platform == 'darwin' else 1
+        return {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+                'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale}
+    peaks = {}
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks[str(current)] = int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return peaks
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, False
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['inprocess', 'http'], default='inprocess')
+    parser.add_argument('--url', default=os.environ.get('ML_SERVICE_URL', 'http://localhost:5000'))
+    parser.add_argument('--server-pid', type=int, help='report the peak RSS of the service (http mode, Linux)')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma-separated subset of {",".join(SCENARIOS)}')
+    parser.add_argument('--rows', type=int_list, default=[50, 1000], help='history rows per category, e.g. 50,1000')
+    parser.add_argument('--concurrency', type=int_list, default=[1, 4], help='concurrent clients, e.g. 1,4,16')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--categories', type=int, default=2)
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS, default='gamma')
+    parser.add_argument('--gap', default='daily', help=f'one of {",".join(GAPS)} or a number of days')
+    parser.add_argument('--granularity', choices=['transaction', 'month'], default='transaction',
+                        help='train per-expense or calendar-month models')
+    parser.add_argument('--recent', type=int, default=10, help='recent expenses sent with each prediction')
+    parser.add_argument('--requests', type=int, default=200, help='prediction requests per run')
+    parser.add_argument('--script-requests', type=int, default=20, help='one-shot ml/predict.py runs per run')
+    parser.add_argument('--model-dir', help='model directory (default: a temporary one in inprocess mode)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<commit>.json)')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    model_dir = args.model_dir or (tempfile.mkdtemp(prefix='bench_models_') if args.mode == 'inprocess' else None)
+    if model_dir:
+        os.environ['ML_MODEL_DIR'] = model_dir
+    env = dict(os.environ)
+    client = InProcessClient() if args.mode == 'inprocess' else HttpClient(args.url)
+
+    results = []
+    try:
+        for rows in args.rows:
+            groups = workload(args.users, args.categories, rows, args.distribution, args.gap, args.seed)
+            for concurrency in args.concurrency:
+                runs = {}
+                if 'train' in scenarios:
+                    runs['train'] = run_ops(lambda g: train_op(client, g, args.granularity), groups, concurrency)
+                requests = [groups[i % len(groups)] for i in range(args.requests)]
+                if 'predict' in scenarios:
+                    runs['predict'] = run_ops(lambda g: predict_op(client, g, args.recent), requests, concurrency)
+                if 'predict_script' in scenarios:
+                    script_requests = requests[:args.script_requests]
+                    runs['predict_script'] = run_ops(lambda g: predict_script_op(g, args.recent, env),
+                                                     script_requests, concurrency)
+                if 'predict_serve' in scenarios:
+                    # One --serve process per client, started and warmed up before timing
+                    servers = queue.Queue()
+                    for _ in range(concurrency):
+                        server = ServeProcess(env)
+                        server.predict(groups[0], args.recent)
+                        servers.put(server)
+
+                    def serve_op(group):
+                        server = servers.get()
+                        try:
+                            return server.predict(group, args.recent)
+                        finally:
+                            servers.put(server)
+                    runs['predict_serve'] = run_ops(serve_op, requests, concurrency)
+                    while not servers.empty():
+                        servers.get().close()
+
+                for scenario, run in runs.items():
+                    summary = dict(scenario=scenario, mode=args.mode, rows=rows, concurrency=concurrency,
+                                   **summarize(*run))
+                    results.append(summary)
+                    print(f"{scenario:>15} rows={rows:<7} c={concurrency:<3} "
+                          f"p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms "
+                          f"{summary['throughput_rps']} req/s errors={summary['errors']}")
+    finally:
+        client.close()
+
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+        'peak_rss_kb': {'benchmark': peak_rss_kb(),
+                        'server': peak_rss_kb(args.server_pid) if args.server_pid else None}
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Peak RSS (KB): {report['peak_rss_kb']}")
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Payload size and decode time of the ML service's wire formats.
+
+Encodes one expense history as a JSON body, an NDJSON body and an expense
+column frame (ml/wire.py), and times decoding each into the sorted date and
+amount arrays the service works on, at 1k and 100k rows:
+
+    python benchmarks/bench_wire.py [--rows 1000,100000] [--repeat N]
+"""
+import io
+import os
+import sys
+import json
+import argparse
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import history
+from ml import wire
+from ml.features import sorted_series
+from ml.ingest import ingest_ndjson
+
+HEADER = {'user_id': 1, 'category': 'Food'}
+
+
+def json_body(expenses):
+    return json.dumps(dict(HEADER, expenses=expenses)).encode()
+
+
+def ndjson_body(expenses):
+    return '\n'.join(json.dumps(row) for row in [HEADER] + expenses).encode() + b'\n'
+
+
+def decode_json(body):
+    return sorted_series(json.loads(body)['expenses'])
+
+
+def decode_ndjson(body):
+    history = ingest_ndjson(io.BytesIO(body))[1].history()
+    return history.dates, history.amounts
+
+
+def decode_columns(body):
+    _, _, dates, amounts = wire.decode_expenses(body)
+    return dates, amounts
+
+
+def per_call(fn, args, repeat):
+    timer = timeit.Timer(lambda: fn(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='1000,100000', help='comma-separated history sizes')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'format':>8} {'bytes':>11} {'decode (ms)':>12} {'vs json':>8}")
+    for n in [int(v) for v in args.rows.split(',')]:
+        expenses = history(n, gap='irregular', seed=n)
+        dates, amounts = sorted_series(expenses)
+        bodies = {
+            'json': (json_body(expenses), decode_json),
+            'ndjson': (ndjson_body(expenses), decode_ndjson),
+            'columns': (wire.encode_expenses(HEADER, dates, amounts), decode_columns)
+        }
+        baseline = None
+        for name, (body, decode) in bodies.items():
+            decoded_dates, decoded_amounts = decode(body)
+            assert np.array_equal(decoded_dates, dates) and np.array_equal(decoded_amounts, amounts), name
+            seconds = per_call(decode, (body,), args.repeat)
+            baseline = baseline or (len(body), seconds)
+            print(f"{n:>8} {name:>8} {len(body):>11} {seconds * 1000:>12.3f} "
+                  f"{baseline[1] / seconds:>7.1f}x  ({len(body) / baseline[0]:.0%} of the JSON bytes)")
+
+
+if __name__ == '__main__':
+    main()
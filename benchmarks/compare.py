@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Compare two benchmark result files written by bench_service.py.
+
+    python benchmarks/compare.py benchmarks/results/<base>.json benchmarks/results/<new>.json
+
+Prints latency and throughput changes for every run found in both files and
+exits with status 1 when p95 latency grew, or throughput fell, by more than
+--threshold percent.
+"""
+import sys
+import json
+import argparse
+
+KEY = ('scenario', 'mode', 'rows', 'concurrency')
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {tuple(run[k] for k in KEY): run for run in report['results']}
+
+
+def change(old, new):
+    if old is None or new is None or old == 0:
+        return None
+    return 100.0 * (new - old) / old
+
+
+def fmt(value):
+    return f"{value:+.1f}%" if value is not None else 'n/a'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    base_report, base = load(args.base)
+    new_report, new = load(args.new)
+    print(f"base {base_report.get('commit')} -> new {new_report.get('commit')}")
+    print(f"{'scenario':>15} {'mode':>9} {'rows':>7} {'c':>3} {'p50':>8} {'p95':>8} {'p99':>8} {'throughput':>11}")
+
+    regressions = []
+    for key in sorted(base.keys() & new.keys(), key=str):
+        old, cur = base[key], new[key]
+        p95 = change(old['p95_ms'], cur['p95_ms'])
+        throughput = change(old['throughput_rps'], cur['throughput_rps'])
+        print(f"{key[0]:>15} {key[1]:>9} {key[2]:>7} {key[3]:>3} {fmt(change(old['p50_ms'], cur['p50_ms'])):>8} "
+              f"{fmt(p95):>8} {fmt(change(old['p99_ms'], cur['p99_ms'])):>8} {fmt(throughput):>11}")
+        if (p95 is not None and p95 > args.threshold) or (throughput is not None and throughput < -args.threshold):
+            regressions.append(key)
+
+    missing = base.keys() ^ new.keys()
+    if missing:
+        print(f"{len(missing)} runs are only in one of the files")
+    if regressions:
+        print(f"{len(regressions)} runs regressed by more than {args.threshold}%")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Synthetic expense histories for the benchmarks.
+
+Histories vary in row count, number of categories, amount distribution and
+the gaps between expense dates, and are returned in the shape the service
+takes them: lists of {'amount': str, 'date': ISO string}.
+"""
+import numpy as np
+
+DISTRIBUTIONS = ['gamma', 'lognormal', 'uniform', 'spiky']
+GAPS = ['daily', 'weekly', 'monthly', 'irregular']
+
+CATEGORY_NAMES = ['Food', 'Transport', 'Rent', 'Utilities', 'Entertainment', 'Health',
+                  'Shopping', 'Travel', 'Education', 'Other']
+
+
+def amounts(n, distribution='gamma', rng=None):
+    rng = rng or np.random.default_rng(0)
+    if distribution == 'gamma':
+        values = rng.gamma(3.0, 20.0, n)
+    elif distribution == 'lognormal':
+        values = rng.lognormal(3.5, 0.8, n)
+    elif distribution == 'uniform':
+        values = rng.uniform(5, 200, n)
+    elif distribution == 'spiky':
+        # Mostly small amounts with occasional large purchases
+        values = rng.gamma(2.0, 10.0, n) + (rng.random(n) < 0.05) * rng.uniform(200, 2000, n)
+    else:
+        raise ValueError(f"Unknown distribution {distribution!r}, expected one of {DISTRIBUTIONS}")
+    return np.round(values, 2)
+
+
+def date_offsets(n, gap='daily', rng=None):
+    """Increasing day offsets from the first expense"""
+    rng = rng or np.random.default_rng(0)
+    if gap == 'daily':
+        steps = np.ones(n, dtype=np.int64)
+    elif gap == 'weekly':
+        steps = np.full(n, 7)
+    elif gap == 'monthly':
+        steps = np.full(n, 30)
+    elif gap == 'irregular':
+        # Bursts of same-day expenses with occasional long pauses
+        steps = rng.geometric(0.3, n) - 1 + (rng.random(n) < 0.02) * rng.integers(30, 120, n)
+    elif isinstance(gap, int) or str(gap).isdigit():
+        steps = np.full(n, int(gap))
+    else:
+        raise ValueError(f"Unknown gap {gap!r}, expected one of {GAPS} or a number of days")
+    steps[0] = 0
+    return np.cumsum(steps)
+
+
+def history(rows, distribution='gamma', gap='daily', seed=0, start='2015-01-01'):
+    """One category's expense history"""
+    rng = np.random.default_rng(seed)
+    dates = np.datetime64(start) + date_offsets(rows, gap, rng)
+    return [{'amount': str(a), 'date': f'{d}T00:00:00.000Z'}
+            for a, d in zip(amounts(rows, distribution, rng), dates)]
+
+
+def workload(users=10, categories=3, rows=100, distribution='gamma', gap='daily', seed=0):
+    """Histories for users x categories groups: [{user_id, category, expenses}]"""
+    groups = []
+    for user_id in range(1, users + 1):
+        for c in range(categories):
+            category = CATEGORY_NAMES[c % len(CATEGORY_NAMES)] + ('' if c < len(CATEGORY_NAMES) else f' {c}')
+            groups.append({
+                'user_id': user_id,
+                'category': category,
+                'expenses': history(rows, distribution, gap, seed=seed + user_id * 1000 + c)
+            })
+    return groups
@@ -0,0 +1 @@
+"""Shared helpers for the Python ML service and the ml/ command-line scripts."""
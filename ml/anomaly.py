@@ -0,0 +1,154 @@
+"""Streaming anomaly scores of new expenses, from O(1) state per (user, category).
+
+Every (user, category) keeps a fixed-size state: the number of expenses
+seen, an exponentially weighted mean and variance (weight EWMA_ALPHA on the
+newest expense), and the last WINDOW amounts in a ring buffer, whose median
+and median absolute deviation (MAD) are a center and spread that a few huge
+expenses cannot drag along. Each expense is scored against the state before
+it is folded in:
+
+- score: the robust z-score 0.6745 (amount - median) / MAD;
+- ewma_z: the distance from the weighted mean in weighted standard deviations.
+
+An expense is an anomaly when both exceed THRESHOLD, once MIN_OBSERVATIONS
+expenses have been seen. The robust score keeps earlier outliers from
+masking new ones. The EWMA score stops flagging a lasting change of level
+once the weighted mean has moved to it. Scoring and folding in an expense
+takes a few arithmetic operations and two sorts of WINDOW values. No
+history is read and no DataFrame is built.
+
+States are fixed-width records in a memory-mapped file in MODEL_DIR (see
+ml.registry.MappedRecords), shared by every worker process.
+"""
+import os
+
+import numpy as np
+
+from ml.registry import MappedRecords, MAX_CATEGORY_BYTES, registry_key
+from ml.storage import MODEL_DIR
+
+ANOMALY_FILE = 'anomaly_states.registry'
+ANOMALY_MAGIC = b'EXPANO01'
+
+# Weight of the newest expense in the weighted mean and variance
+EWMA_ALPHA = float(os.environ.get('ML_ANOMALY_ALPHA', 0.1))
+# Robust and weighted z-scores above which an expense is flagged (Iglewicz and Hoaglin's 3.5)
+THRESHOLD = float(os.environ.get('ML_ANOMALY_THRESHOLD', 3.5))
+# Recent amounts the median and MAD are taken over
+WINDOW = 32
+# Expenses seen before any is flagged
+MIN_OBSERVATIONS = 8
+# The MAD of a normal distribution is 0.6745 standard deviations
+MAD_SCALE = 0.6745
+# Smallest spread, relative to the center: identical amounts would otherwise make any change infinitely unusual
+MIN_SPREAD = 0.01
+
+ANOMALY_RECORD = np.dtype([
+    ('version', '<u4'),  # odd while a writer is updating the record
+    ('used', 'u1'),
+    ('user_id', '<i8'),
+    ('category', f'S{MAX_CATEGORY_BYTES}'),
+    ('count', '<i8'),
+    ('mean', '<f8'),
+    ('variance', '<f8'),
+    ('window', '<f8', (WINDOW,))  # amount i is in slot i % WINDOW
+])
+
+
+def _spread(value, center):
+    return max(value, MIN_SPREAD * max(abs(center), 1.0))
+
+
+def _median(ordered):
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+
+def score_amounts(record, amounts):
+    """Score amounts in order against a state record, folding each in after it is scored.
+
+    Returns one {amount, score, ewma_z, expected, anomaly, direction,
+    observations} dict per amount; score, ewma_z and expected (the median)
+    are None for the first expense of a state. Past MIN_OBSERVATIONS, an
+    amount moves the weighted mean and variance by at most THRESHOLD
+    weighted standard deviations, so one outlier cannot mask the next.
+    """
+    # Plain floats: sorting a list of WINDOW floats is faster than NumPy calls on arrays this small
+    count = int(record['count'])
+    mean = float(record['mean'])
+    variance = float(record['variance'])
+    window = record['window'].tolist()
+    scores = []
+    for amount in np.asarray(amounts, dtype=np.float64).tolist():
+        result = {'amount': amount, 'score': None, 'ewma_z': None, 'expected': None, 'anomaly': False,
+                  'direction': None, 'observations': count}
+        std = _spread(variance ** 0.5, mean)
+        if count:
+            recent = window[:count] if count < WINDOW else window
+            median = _median(sorted(recent))
+            mad = _median(sorted([abs(x - median) for x in recent]))
+            score = MAD_SCALE * (amount - median) / _spread(mad, median)
+            ewma_z = (amount - mean) / std
+            anomaly = count >= MIN_OBSERVATIONS and abs(score) > THRESHOLD and abs(ewma_z) > THRESHOLD
+            result.update({
+                'score': round(score, 2),
+                'ewma_z': round(ewma_z, 2),
+                'expected': round(median, 2),
+                'anomaly': anomaly,
+                'direction': ('high' if score > 0 else 'low') if anomaly else None
+            })
+        scores.append(result)
+
+        # Exponentially weighted mean and variance (Finch's incremental form), with clipped steps
+        if count:
+            diff = amount - mean
+            if count >= MIN_OBSERVATIONS:
+                diff = min(max(diff, -THRESHOLD * std), THRESHOLD * std)
+            increment = EWMA_ALPHA * diff
+            mean += increment
+            variance = (1 - EWMA_ALPHA) * (variance + diff * increment)
+        else:
+            mean = amount
+        window[count % WINDOW] = amount
+        count += 1
+
+    record['count'] = count
+    record['mean'] = mean
+    record['variance'] = variance
+    record['window'] = window
+    return scores
+
+
+class AnomalyStore(MappedRecords):
+    """Anomaly scoring states of every (user_id, category) in a memory-mapped file.
+
+    Keys that do not fit a record (non-integer user ids, long categories)
+    are scored against an empty state and nothing is kept for them.
+    """
+
+    magic = ANOMALY_MAGIC
+    record = ANOMALY_RECORD
+
+    def __init__(self, path=None):
+        super().__init__(path or os.path.join(MODEL_DIR, ANOMALY_FILE))
+
+    def score(self, user_id, category, amounts, update=True):
+        """score_amounts of a (user_id, category)'s state; with update, the state keeps the amounts"""
+        key = registry_key(user_id, category)
+        scores = []
+
+        def fold(record):
+            scores.extend(score_amounts(record, amounts))
+            return record
+
+        if key is not None and update:
+            self._update(key, fold, create=True)
+        else:
+            record = self._read(key) if key is not None else None
+            fold(record if record is not None else np.zeros((), dtype=ANOMALY_RECORD))
+        return scores
+
+    def delete(self, user_id, category):
+        """Forget the state of a (user_id, category). Returns True if there was one"""
+        key = registry_key(user_id, category)
+        return key is not None and self._clear(key)
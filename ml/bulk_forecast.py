@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Next-period forecasts for every (user, category) of an expenses export.
+
+    python ml/bulk_forecast.py expenses.csv --output forecasts.csv [--workers N]
+
+Reads a CSV or Parquet export of the expenses table (user_id, category,
+amount and date columns) in chunks and works in two resumable phases:
+
+1. partition: rows are appended to one of --buckets files in the work
+   directory (<output>.work), chosen by their (user_id, category) group,
+   so no more than a chunk is ever held in memory;
+2. forecast: a process pool trains every group of a bucket with
+   train_expense_model, as /train does, and writes the bucket's rows to a
+   part file, renamed into place once complete.
+
+After a crash, running the same command again keeps the partitioned
+buckets and the finished parts and only forecasts the remaining buckets.
+The output is a CSV with the columns of ml_models, for bulk loading:
+
+    CREATE TEMP TABLE ml_models_load (LIKE ml_models INCLUDING DEFAULTS);
+    \\copy ml_models_load (user_id, model_type, categories, max_amount, metadata)
+        FROM 'forecasts.csv' CSV HEADER
+    DELETE FROM ml_models m USING ml_models_load l
+        WHERE m.user_id = l.user_id AND m.model_type = l.model_type;
+    INSERT INTO ml_models (user_id, model_type, categories, max_amount, metadata)
+        SELECT user_id, model_type, categories, max_amount, metadata FROM ml_models_load;
+
+Models are not saved to the ML service's model directory; the service
+keeps serving the models trained through /train.
+"""
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import logging
+import argparse
+import warnings
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# Allow importing the shared ml package when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.features import parse_dates, parse_amounts
+from ml.ingest import SortedHistory
+from ml.monthly import GRANULARITIES
+
+COLUMNS = ['user_id', 'category', 'amount', 'date']
+OUTPUT_COLUMNS = ['user_id', 'model_type', 'categories', 'max_amount', 'metadata']
+
+# Rows of the bucket files: group id, day number, amount
+RECORD = np.dtype([('group', '<i8'), ('day', '<i8'), ('amount', '<f8')])
+
+MANIFEST = 'manifest.json'
+GROUPS = 'groups.json'
+
+
+def progress(message):
+    print(f"[bulk_forecast] {message}", file=sys.stderr, flush=True)
+
+
+def read_chunks(path, chunk_rows):
+    """DataFrames of up to chunk_rows rows of the export's COLUMNS"""
+    if path.endswith(('.parquet', '.parq', '.pq')):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Reading Parquet exports needs pyarrow (pip install pyarrow)")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=COLUMNS):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+        yield from pd.read_csv(path, usecols=COLUMNS, chunksize=chunk_rows,
+                               dtype={'user_id': str, 'category': str, 'date': str})
+
+
+def bucket_path(work_dir, bucket):
+    return os.path.join(work_dir, f'bucket-{bucket:05d}.bin')
+
+
+def part_path(work_dir, bucket):
+    return os.path.join(work_dir, f'part-{bucket:05d}.csv')
+
+
+def partition(path, work_dir, buckets, chunk_rows):
+    """Phase 1: spread the export's rows over the bucket files by group.
+
+    Groups are numbered in order of first appearance and assigned to buckets
+    round-robin, which keeps the buckets about equally sized. Returns the
+    (user_id, category) of every group id and the number of rows kept.
+    """
+    import pandas as pd
+    group_ids = {}
+    keys = []
+    rows = skipped = 0
+    files = [open(bucket_path(work_dir, b), 'wb') for b in range(buckets)]
+    try:
+        for chunk in read_chunks(path, chunk_rows):
+            complete = chunk.dropna()
+            skipped += len(chunk) - len(complete)
+            if not len(complete):
+                continue
+            # Look up each distinct group of the chunk once
+            inverse, local = pd.MultiIndex.from_frame(complete[['user_id', 'category']].astype(str)).factorize()
+            ids = np.empty(len(local), dtype=np.int64)
+            for i, key in enumerate(local.tolist()):
+                group = group_ids.get(key)
+                if group is None:
+                    group = group_ids[key] = len(keys)
+                    keys.append(list(key))
+                ids[i] = group
+            records = np.empty(len(complete), dtype=RECORD)
+            records['group'] = ids[inverse]
+            records['day'] = parse_dates(complete['date'].to_numpy()).astype(np.int64)
+            records['amount'] = parse_amounts(complete['amount'].to_numpy())
+            for b in np.unique(records['group'] % buckets):
+                records[records['group'] % buckets == b].tofile(files[b])
+            rows += len(records)
+            progress(f"partitioned {rows:,} rows into {len(keys):,} groups")
+    finally:
+        for f in files:
+            f.close()
+    if skipped:
+        progress(f"skipped {skipped:,} rows without a user_id, category, amount or date")
+    return keys, rows
+
+
+def forecast_bucket(path, granularity):
+    """Phase 2, in a worker: (group id, /train result or error) for every group of a bucket file"""
+    from ml.training import train_expense_model
+    # Workers only report through the parent's progress lines
+    logging.disable(logging.WARNING)
+    warnings.simplefilter('ignore')
+
+    records = np.fromfile(path, dtype=RECORD)
+    if not len(records):
+        return []
+    order = np.lexsort((records['day'], records['group']))
+    records = records[order]
+    starts = np.flatnonzero(np.concatenate(([True], records['group'][1:] != records['group'][:-1])))
+    ends = np.append(starts[1:], len(records))
+    results = []
+    for start, end in zip(starts, ends):
+        group = records[start:end]
+        history = SortedHistory(group['day'].view('datetime64[D]').copy(), group['amount'].copy())
+        try:
+            result, _ = train_expense_model(history, granularity=granularity)
+            results.append((int(group['group'][0]), result, None))
+        except Exception as e:
+            results.append((int(group['group'][0]), None, str(e)))
+    return results
+
+
+def output_row(user_id, category, result, granularity, forecast_at):
+    """One ml_models row, in the shape routes/ml.js stores after /train"""
+    metadata = {
+        'model_type': result.get('model_type') or 'ml_model',
+        'features': result.get('features_used') or ['amount'],
+        'metrics': result.get('metrics') or {},
+        'training_time': result.get('training_time'),
+        'prediction': result.get('prediction'),
+        'accuracy': result.get('accuracy'),
+        'next_month': result.get('next_month'),
+        'granularity': granularity,
+        'forecast_at': forecast_at,
+        'source': 'bulk_forecast'
+    }
+    return [user_id, category, json.dumps([category]), result.get('max_amount'), json.dumps(metadata)]
+
+
+def write_part(work_dir, bucket, rows):
+    path = part_path(work_dir, bucket)
+    with open(path + '.tmp', 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    os.replace(path + '.tmp', path)
+
+
+def read_manifest(work_dir):
+    try:
+        with open(os.path.join(work_dir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, value):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(value, f)
+    os.replace(path + '.tmp', path)
+
+
+def run(args):
+    start = time.time()
+    stat = os.stat(args.input)
+    work_dir = args.work_dir or f'{args.output}.work'
+    # A run can only be resumed with the same input and settings
+    identity = {
+        'input': os.path.abspath(args.input),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'buckets': args.buckets,
+        'granularity': args.granularity
+    }
+
+    manifest = read_manifest(work_dir)
+    if manifest is not None and manifest.get('identity') == identity and manifest.get('partitioned'):
+        with open(os.path.join(work_dir, GROUPS)) as f:
+            keys = json.load(f)
+        progress(f"resuming: {manifest['rows']:,} rows in {len(keys):,} groups already partitioned")
+    else:
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.makedirs(work_dir)
+        write_json(os.path.join(work_dir, MANIFEST), {'identity': identity, 'partitioned': False})
+        keys, rows = partition(args.input, work_dir, args.buckets, args.chunk_rows)
+        write_json(os.path.join(work_dir, GROUPS), keys)
+        manifest = {'identity': identity, 'partitioned': True, 'rows': rows,
+                    'forecast_at': datetime.now().isoformat()}
+        write_json(os.path.join(work_dir, MANIFEST), manifest)
+
+    pending = [b for b in range(args.buckets) if not os.path.exists(part_path(work_dir, b))]
+    if len(pending) < args.buckets:
+        progress(f"{args.buckets - len(pending)} of {args.buckets} buckets already forecast")
+
+    done = args.buckets - len(pending)
+    groups = errors = 0
+    phase_start = time.time()
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = {pool.submit(forecast_bucket, bucket_path(work_dir, b), args.granularity): b for b in pending}
+        for future in as_completed(futures):
+            bucket = futures[future]
+            rows = []
+            for group, result, error in future.result():
+                user_id, category = keys[group]
+                if error is not None:
+                    errors += 1
+                    progress(f"user {user_id}, category {category} failed: {error}")
+                    continue
+                rows.append(output_row(user_id, category, result, args.granularity, manifest['forecast_at']))
+            write_part(work_dir, bucket, rows)
+            done += 1
+            groups += len(rows)
+            finished = done - (args.buckets - len(pending))
+            elapsed = time.time() - phase_start
+            remaining = elapsed / finished * (len(pending) - finished)
+            progress(f"{done}/{args.buckets} buckets, {groups:,} groups forecast, "
+                     f"{elapsed:.1f}s elapsed, ~{remaining:.0f}s left")
+
+    # Header and the parts, in bucket order, renamed into place in one step
+    with open(args.output + '.tmp', 'w', newline='') as out:
+        csv.writer(out).writerow(OUTPUT_COLUMNS)
+        for b in range(args.buckets):
+            with open(part_path(work_dir, b), newline='') as part:
+                shutil.copyfileobj(part, out)
+    os.replace(args.output + '.tmp', args.output)
+    if not args.keep_work:
+        shutil.rmtree(work_dir)
+
+    summary = {
+        'output': args.output,
+        'rows': manifest['rows'],
+        'groups': len(keys),
+        'forecast_this_run': groups,
+        'errors': errors,
+        'seconds': round(time.time() - start, 2)
+    }
+    progress(f"wrote {args.output} in {summary['seconds']}s")
+    print(json.dumps(summary))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('input', help='CSV or Parquet export with user_id, category, amount and date columns')
+    parser.add_argument('--output', required=True, help='CSV file to write, with the ml_models columns')
+    parser.add_argument('--work-dir', help='directory for buckets and finished parts (default: <output>.work)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--buckets', type=int, default=64, help='partitions of the groups (units of resume)')
+    parser.add_argument('--chunk-rows', type=int, default=500000, help='rows read from the export at a time')
+    parser.add_argument('--granularity', choices=GRANULARITIES, default='transaction')
+    parser.add_argument('--keep-work', action='store_true', help='keep the work directory after success')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
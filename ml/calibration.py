@@ -0,0 +1,111 @@
+"""Prediction intervals calibrated on validation residuals (split conformal).
+
+fit_best_model keeps the out-of-sample residuals (actual - predicted) of
+the model it chooses on its rolling-origin folds (see ml.selection). Their
+central INTERVAL_LEVEL quantiles, with split conformal's finite-sample
+correction, are two offsets that turn any later prediction into an interval
+[prediction + lower, prediction + upper]: serving one costs two additions,
+with no refits and no bootstrap.
+
+/train reports the offsets in metrics['interval']. The service keeps those
+of per-user models as fixed-width records in a memory-mapped file (see
+ml.registry.MappedRecords); category models shared across users carry
+theirs, in units of the user's mean. Predictions without offsets (the
+statistical forecast, too few residuals) get INTERVAL_Z standard deviations
+of the recent amounts either side instead.
+"""
+import os
+
+import numpy as np
+
+from ml.registry import MappedRecords, MAX_CATEGORY_BYTES, registry_key
+from ml.storage import MODEL_DIR
+
+# Intervals cover the central 80% of the errors
+INTERVAL_LEVEL = 0.8
+# Standard deviations either side of an uncalibrated interval (80% of a normal error)
+INTERVAL_Z = 1.2816
+
+CONFORMAL = 'conformal'
+SPREAD = 'spread'
+
+CALIBRATION_FILE = 'calibration.registry'
+CALIBRATION_MAGIC = b'EXPCAL01'
+
+CALIBRATION_RECORD = np.dtype([
+    ('version', '<u4'),  # odd while a writer is updating the record
+    ('used', 'u1'),
+    ('user_id', '<i8'),
+    ('category', f'S{MAX_CATEGORY_BYTES}'),
+    ('level', '<f8'),
+    ('lower', '<f8'),
+    ('upper', '<f8'),
+    ('residuals', '<i8')
+])
+
+
+def conformal_offsets(actual, predicted, level=INTERVAL_LEVEL):
+    """{level, lower, upper, residuals} of out-of-sample residuals, or None when too few.
+
+    lower and upper are the residuals of rank floor((n + 1) a) and
+    ceil((n + 1) (1 - a)) with a = (1 - level) / 2, which cover a new
+    residual with probability at least level when residuals are exchangeable.
+    """
+    residuals = np.sort(np.asarray(actual, dtype=np.float64) - np.asarray(predicted, dtype=np.float64))
+    n = len(residuals)
+    alpha = (1 - level) / 2
+    lower_rank = int(np.floor((n + 1) * alpha))
+    upper_rank = int(np.ceil((n + 1) * (1 - alpha)))
+    if lower_rank < 1 or upper_rank > n:
+        return None
+    return {
+        'level': level,
+        'lower': round(float(residuals[lower_rank - 1]), 4),
+        'upper': round(float(residuals[upper_rank - 1]), 4),
+        'residuals': n
+    }
+
+
+def interval_bounds(predictions, lower, upper, std):
+    """Vectorized (lower bounds, upper bounds, calibrated) of predictions.
+
+    lower/upper are the offsets of each prediction, NaN where it has none;
+    those get INTERVAL_Z std either side. Bounds are never negative.
+    """
+    predictions = np.asarray(predictions, dtype=np.float64)
+    calibrated = ~np.isnan(lower)
+    spread = INTERVAL_Z * np.nan_to_num(std, nan=0.0)
+    low = np.where(calibrated, predictions + np.nan_to_num(lower), predictions - spread)
+    high = np.where(calibrated, predictions + np.nan_to_num(upper), predictions + spread)
+    return np.maximum(low, 0.0), np.maximum(high, 0.0), calibrated
+
+
+class CalibrationStore(MappedRecords):
+    """Interval offsets of the per-user models, by (user_id, category)"""
+
+    magic = CALIBRATION_MAGIC
+    record = CALIBRATION_RECORD
+
+    def __init__(self, path=None):
+        super().__init__(path or os.path.join(MODEL_DIR, CALIBRATION_FILE))
+
+    def get(self, user_id, category):
+        """(lower, upper) offsets of a (user_id, category), or None"""
+        key = registry_key(user_id, category)
+        record = self._read(key) if key is not None else None
+        return (float(record['lower']), float(record['upper'])) if record is not None else None
+
+    def put(self, user_id, category, calibration):
+        """Store conformal_offsets. Returns False if the key does not fit a record"""
+        key = registry_key(user_id, category)
+        if key is None:
+            return False
+        record = np.zeros((), dtype=CALIBRATION_RECORD)
+        for name in ('level', 'lower', 'upper', 'residuals'):
+            record[name] = calibration[name]
+        self._store(key, record)
+        return True
+
+    def delete(self, user_id, category):
+        key = registry_key(user_id, category)
+        return key is not None and self._clear(key)
@@ -0,0 +1,148 @@
+import logging
+
+import numpy as np
+
+from ml.registry import linear_parts
+
+logger = logging.getLogger(__name__)
+
+# Largest difference from the sklearn prediction a compiled predictor may show
+RTOL = 1e-9
+ATOL = 1e-6
+
+
+class CompiledLinear:
+    """Linear model with the scaler folded in: X @ weights + bias on raw features"""
+
+    def __init__(self, feature_names, weights, bias):
+        self.feature_names_in_ = np.array(feature_names, dtype=object)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+
+    @classmethod
+    def from_model(cls, model):
+        """Fold a StandardScaler + linear model into one weight vector, or None"""
+        parts = linear_parts(model)
+        if parts is None:
+            return None
+        weights = parts.coef_ / parts.scale_
+        return cls(parts.feature_names_in_, weights, parts.intercept_ - weights @ parts.mean_)
+
+    def predict(self, X):
+        return np.asarray(X, dtype=np.float64) @ self.weights + self.bias
+
+
+class CompiledTrees:
+    """GradientBoostingRegressor (behind a StandardScaler) as flat node arrays.
+
+    The nodes of every tree are concatenated into contiguous arrays with
+    absolute child indexes, and all trees are walked together one depth level
+    at a time. Like sklearn, scaled features are rounded to float32 before
+    they are compared with the float64 thresholds, so the same leaves are
+    reached.
+    """
+
+    ARRAYS = ('mean', 'scale', 'feature', 'threshold', 'left', 'right', 'value', 'roots')
+
+    def __init__(self, feature_names, mean, scale, init, learning_rate, feature, threshold,
+                 left, right, value, roots, max_depth):
+        self.feature_names_in_ = np.array(feature_names, dtype=object)
+        self.mean = mean
+        self.scale = scale
+        self.init = float(init)
+        self.learning_rate = float(learning_rate)
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+
+    @classmethod
+    def from_model(cls, model):
+        """Flatten a fitted Pipeline(StandardScaler, GradientBoostingRegressor), or None"""
+        if not hasattr(model, 'named_steps') or len(model.named_steps) != 2:
+            return None
+        scaler, gb = model.named_steps.values()
+        estimators = getattr(gb, 'estimators_', None)
+        constant = getattr(getattr(gb, 'init_', None), 'constant_', None)
+        names = getattr(model, 'feature_names_in_', None)
+        if estimators is None or constant is None or names is None or not hasattr(scaler, 'scale_'):
+            return None
+
+        trees = [estimator.tree_ for estimator in estimators[:, 0]]
+        sizes = np.array([tree.node_count for tree in trees])
+        roots = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        feature = np.concatenate([tree.feature for tree in trees]).astype(np.int64)
+        left = np.concatenate([np.where(tree.children_left >= 0, tree.children_left + root, -1)
+                               for tree, root in zip(trees, roots)])
+        right = np.concatenate([np.where(tree.children_right >= 0, tree.children_right + root, -1)
+                                for tree, root in zip(trees, roots)])
+        return cls(
+            names,
+            np.asarray(scaler.mean_, dtype=np.float64),
+            np.asarray(scaler.scale_, dtype=np.float64),
+            np.ravel(constant)[0],
+            gb.learning_rate,
+            feature,
+            np.concatenate([tree.threshold for tree in trees]),
+            left,
+            right,
+            np.concatenate([tree.value[:, 0, 0] for tree in trees]),
+            roots,
+            max(tree.max_depth for tree in trees)
+        )
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        Z = ((X - self.mean) / self.scale).astype(np.float32).astype(np.float64)
+        rows = np.arange(len(Z))[:, None]
+        node = np.broadcast_to(self.roots, (len(Z), len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            feature = self.feature[node]
+            split = feature >= 0
+            go_left = Z[rows, np.where(split, feature, 0)] <= self.threshold[node]
+            node = np.where(split, np.where(go_left, self.left[node], self.right[node]), node)
+        return self.init + self.learning_rate * self.value[node].sum(axis=1)
+
+    def save(self, path):
+        """Write the node arrays to an .npz file (no pickling)"""
+        with open(path, 'wb') as f:
+            np.savez(f, feature_names=np.array(self.feature_names_in_, dtype=str),
+                     scalars=np.array([self.init, self.learning_rate, self.max_depth]),
+                     **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            init, learning_rate, max_depth = data['scalars']
+            arrays = {name: data[name] for name in cls.ARRAYS}
+            return cls(list(data['feature_names']), init=init, learning_rate=learning_rate,
+                       max_depth=max_depth, **arrays)
+
+
+def compile_model(model, X_check):
+    """Compiled predictor for a fitted pipeline, validated against sklearn on X_check.
+
+    Returns None when the model has no compiled form or the compiled
+    predictions differ from the pipeline's by more than the tolerance.
+    """
+    compiled = CompiledLinear.from_model(model) or CompiledTrees.from_model(model)
+    if compiled is None:
+        return None
+    expected = model.predict(X_check)
+    actual = compiled.predict(np.asarray(X_check, dtype=np.float64))
+    if not np.allclose(actual, expected, rtol=RTOL, atol=ATOL):
+        logger.warning(f"Compiled predictor differs from the pipeline by up to "
+                       f"{np.max(np.abs(actual - expected))}, not using it")
+        return None
+    return compiled
+
+
+def load_model_file(path):
+    """Load a saved model: compiled .npz node arrays or a joblib pickle"""
+    if path.endswith('.npz'):
+        return CompiledTrees.load(path)
+    import joblib
+    return joblib.load(path)
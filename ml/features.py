@@ -0,0 +1,196 @@
+import numpy as np
+
+# Feature set used by the per-user models, in training order
+DEFAULT_FEATURES = [
+    'month', 'day_of_month', 'is_weekend',
+    'days_since_first', 'seq', 'trend',
+    'prev_amount', 'rolling_mean_3'
+]
+
+# Forecasts are made for the date one "month" after the last expense
+NEXT_PERIOD_DAYS = 30
+
+
+def parse_dates(values):
+    """Parse ISO date strings (or date objects) into a datetime64[D] array"""
+    arr = np.asarray(values)
+    if arr.dtype.kind == 'M':
+        return arr.astype('datetime64[D]')
+    # Timestamps like 2025-05-01T00:00:00.000Z only need their date part
+    return arr.astype('U10').astype('datetime64[D]')
+
+
+def parse_amounts(values):
+    """Parse amounts (numbers or numeric strings) into a float64 array"""
+    return np.asarray(values, dtype=np.float64)
+
+
+def date_parts(dates):
+    """Month, day of month and weekend flag for a datetime64[D] array"""
+    months = dates.astype('datetime64[M]')
+    month = months.astype(np.int64) % 12 + 1
+    day_of_month = (dates - months).astype(np.int64) + 1
+    # 1970-01-01 was a Thursday (dayofweek 3)
+    day_of_week = (dates.astype(np.int64) + 3) % 7
+    is_weekend = (day_of_week >= 5).astype(np.int64)
+    return month, day_of_month, is_weekend
+
+
+def sorted_series(expenses):
+    """Dates and amounts of a list of {amount, date} rows, sorted by date"""
+    dates = parse_dates([row['date'] for row in expenses])
+    amounts = parse_amounts([row['amount'] for row in expenses])
+    order = np.argsort(dates, kind='stable')
+    return dates[order], amounts[order]
+
+
+def build_features(dates, amounts):
+    """Per-row training features for one date-sorted series, in a single pass.
+
+    Returns a dict of column arrays. Lag and rolling columns are NaN where
+    their window is incomplete; 'valid' marks the rows where every column is
+    defined (the rows pandas' dropna() used to keep).
+    """
+    n = len(amounts)
+    month, day_of_month, is_weekend = date_parts(dates)
+    seq = np.arange(n)
+
+    def shifted(k):
+        out = np.full(n, np.nan)
+        out[k:] = amounts[:n - k]
+        return out
+
+    prev_1, prev_2, prev_3 = shifted(1), shifted(2), shifted(3)
+    rolling_mean_3 = (amounts + prev_1 + prev_2) / 3
+    # Sample standard deviation of each 3-row window
+    rolling_std_3 = np.sqrt(((amounts - rolling_mean_3) ** 2 + (prev_1 - rolling_mean_3) ** 2 +
+                             (prev_2 - rolling_mean_3) ** 2) / 2)
+
+    return {
+        'month': month,
+        'year': dates.astype('datetime64[Y]').astype(np.int64) + 1970,
+        'day_of_month': day_of_month,
+        'is_weekend': is_weekend,
+        'days_since_first': (dates - dates[0]).astype(np.int64) if n else np.zeros(0, dtype=np.int64),
+        'seq': seq,
+        'trend': seq / max(1, n - 1),
+        'prev_amount': prev_1,
+        'prev_amount_2': prev_2,
+        'prev_amount_3': prev_3,
+        'rolling_mean_2': (amounts + prev_1) / 2,
+        'rolling_mean_3': rolling_mean_3,
+        'rolling_std_3': rolling_std_3,
+        'valid': seq >= 3
+    }
+
+
+def next_period_features(dates, amounts):
+    """Next-period features and statistics for one date-sorted series"""
+    columns = grouped_next_period(np.array([0, len(amounts)]), dates, amounts)
+    return {name: values[0] for name, values in columns.items()}
+
+
+def model_feature_names(model):
+    """Feature names a fitted model (or sklearn Pipeline) expects, in order"""
+    names = getattr(model, 'feature_names_in_', None)
+    if names is None and hasattr(model, 'named_steps'):
+        names = getattr(model.named_steps.get('model'), 'feature_names_in_', None)
+    return list(names) if names is not None else list(DEFAULT_FEATURES)
+
+
+def next_month_label(date):
+    """'%B %Y' label for a datetime64 value"""
+    return date.astype('datetime64[D]').astype(object).strftime('%B %Y')
+
+
+def group_expenses(groups, key='recent_expenses'):
+    """Concatenate the expenses of many groups into sorted flat arrays.
+
+    Returns (offsets, dates, amounts) where group i owns the slice
+    offsets[i]:offsets[i + 1] and each slice is sorted by date.
+    """
+    counts = np.array([len(g.get(key) or []) for g in groups], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    rows = [row for g in groups for row in (g.get(key) or [])]
+    dates = parse_dates([row['date'] for row in rows]) if rows else np.array([], dtype='datetime64[D]')
+    amounts = parse_amounts([row['amount'] for row in rows])
+    group_ids = np.repeat(np.arange(len(groups)), counts)
+    order = np.lexsort((dates, group_ids))
+    return offsets, dates[order], amounts[order]
+
+
+def grouped_next_period(offsets, dates, amounts):
+    """Next-period features and summary statistics for every group at once.
+
+    All groups must be non-empty. Returns a dict of per-group arrays: the
+    DEFAULT_FEATURES columns plus the statistics /predict uses for bounds,
+    confidence and the statistical fallback.
+    """
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    lasts = offsets[1:] - 1
+    idx = np.arange(len(amounts)) - np.repeat(starts, counts)  # position within group
+
+    sums = np.add.reduceat(amounts, starts)
+    mean = sums / counts
+    sq_dev = (amounts - np.repeat(mean, counts)) ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.add.reduceat(sq_dev, starts) / (counts - 1))  # NaN for one row, like pandas
+
+    # Mean of the last (up to) three amounts
+    tail_n = np.minimum(3, counts)
+    in_tail = idx >= np.repeat(counts - tail_n, counts)
+    tail_mean = np.add.reduceat(np.where(in_tail, amounts, 0.0), starts) / tail_n
+
+    # Linearly increasing recency weights (np.linspace(0.5, 1.0, n) per group)
+    denom = np.repeat(np.maximum(counts - 1, 1), counts)
+    weights = np.where(np.repeat(counts, counts) > 1, 0.5 + 0.5 * idx / denom, 0.5)
+    weighted_avg = np.add.reduceat(weights * amounts, starts) / np.add.reduceat(weights, starts)
+
+    # Least-squares slope of amount against position (np.polyfit(x, y, 1)[0])
+    x_mean = (counts - 1) / 2.0
+    x_dev = idx - np.repeat(x_mean, counts)
+    sxy = np.add.reduceat(x_dev * amounts, starts)
+    sxx = np.add.reduceat(x_dev * x_dev, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(counts >= 3, sxy / sxx, 0.0)
+
+    first_date = dates[starts]
+    last_date = dates[lasts]
+    next_date = last_date + np.timedelta64(NEXT_PERIOD_DAYS, 'D')
+    month, day_of_month, is_weekend = date_parts(next_date)
+
+    return {
+        'month': month,
+        'day_of_month': day_of_month,
+        'is_weekend': is_weekend,
+        'days_since_first': (next_date - first_date).astype(np.int64),
+        'seq': counts,
+        'trend': np.ones(len(counts)),
+        'prev_amount': amounts[lasts],
+        'rolling_mean_3': tail_mean,
+        'count': counts,
+        'mean': mean,
+        'std': std,
+        'min': np.minimum.reduceat(amounts, starts),
+        'max': np.maximum.reduceat(amounts, starts),
+        'weighted_avg': weighted_avg,
+        'slope': slope,
+        'next_date': next_date
+    }
+
+
+def feature_matrix(columns, names=DEFAULT_FEATURES):
+    """Stack feature columns into a (rows x features) float matrix.
+
+    Names missing from columns are filled with zeros.
+    """
+    size = len(next(iter(columns.values())))
+    return np.column_stack([np.asarray(columns[name], dtype=np.float64) if name in columns
+                            else np.zeros(size) for name in names])
+
+
+def feature_vector(features, names=DEFAULT_FEATURES):
+    """Values of one row of features in the given order (zeros for missing names)"""
+    return np.array([float(features.get(name, 0)) for name in names])
+
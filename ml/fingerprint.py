@@ -0,0 +1,149 @@
+"""Fingerprints of training input, saved next to the model trained on it.
+
+/train compares the fingerprint of a request's history with the one saved
+by the last training of the (user, category). An identical history is
+answered with the stored result instead of being refitted; a history that
+only appends a few expenses to it skips model reselection: the previously
+chosen model is refitted from scratch, with its hyperparameters, instead of
+comparing every candidate again. Nothing is fitted incrementally.
+
+A fingerprint is the row count, the last date and a hash of the rows in
+(date, amount) order, so the order rows with the same date arrive in does
+not matter. Appends are recognised by hashing the first `rows` rows of the
+new history, which must match the stored hash.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import numpy as np
+
+from ml.storage import ModelStorage, model_path
+
+logger = logging.getLogger(__name__)
+
+# Bump when the fingerprint or the training it stands for changes meaning
+FINGERPRINT_SCHEMA = 1
+
+# Appends of up to this many rows, and this share of the history, keep the previous model selection
+RESELECT_ROWS = 50
+RESELECT_FRACTION = 0.1
+
+# How a history compares with the last one trained on
+UNCHANGED = 'unchanged'
+APPENDED = 'appended'
+CHANGED = 'changed'
+
+
+def canonical_rows(dates, amounts):
+    """Dates as int64 days and amounts as float64, sorted by (date, amount)"""
+    days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    order = np.lexsort((amounts, days))
+    return days[order], amounts[order]
+
+
+def rows_hash(days, amounts):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(days).tobytes())
+    digest.update(np.ascontiguousarray(amounts).tobytes())
+    return digest.hexdigest()
+
+
+def history_fingerprint(dates, amounts, options):
+    """Fingerprint of a training history and the training options (e.g. granularity)"""
+    days, amounts = canonical_rows(dates, amounts)
+    return {
+        'schema': FINGERPRINT_SCHEMA,
+        'rows': int(len(days)),
+        'max_date': str(days[-1].astype('datetime64[D]')) if len(days) else None,
+        'hash': rows_hash(days, amounts),
+        'options': dict(options)
+    }
+
+
+def compare(previous, dates, amounts, options):
+    """UNCHANGED, APPENDED (a few rows after the previous history) or CHANGED"""
+    if previous is None or previous.get('schema') != FINGERPRINT_SCHEMA or previous.get('options') != options:
+        return CHANGED
+    days, amounts = canonical_rows(dates, amounts)
+    rows = previous['rows']
+    if len(days) < rows or rows_hash(days[:rows], amounts[:rows]) != previous['hash']:
+        return CHANGED
+    appended = len(days) - rows
+    if appended == 0:
+        return UNCHANGED
+    if appended <= RESELECT_ROWS and appended <= RESELECT_FRACTION * len(days):
+        return APPENDED
+    return CHANGED
+
+
+class FingerprintStore:
+    """Training fingerprints as JSON sidecars in MODEL_DIR, with counts of what /train did.
+
+    A sidecar holds the fingerprint, the /train result and the chosen
+    model's hyperparameters. It is removed whenever the served model
+    changes (see save_model), so it only ever describes the saved model.
+    Sidecars are written atomically through storage (a ModelStorage), so
+    processes training the same key concurrently never publish a mixed one.
+    """
+
+    OUTCOMES = ('skipped', 'reselection_skipped', 'retrained')
+
+    def __init__(self, storage=None):
+        self.storage = storage or ModelStorage()
+        self._counts = dict.fromkeys(self.OUTCOMES, 0)
+        self._lock = threading.Lock()
+
+    def path(self, user_id, category):
+        return model_path(user_id, category, prefix='fingerprint', ext='json')
+
+    def load(self, user_id, category):
+        """The sidecar of a (user, category), or None"""
+        try:
+            with open(self.path(user_id, category)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, user_id, category, fingerprint, result, hyperparameters, has_model):
+        path = self.path(user_id, category)
+        record = {
+            'fingerprint': fingerprint,
+            'result': result,
+            'hyperparameters': hyperparameters,
+            'has_model': has_model,
+            'saved_at': time.time()
+        }
+
+        def dump(tmp_path):
+            with open(tmp_path, 'w') as f:
+                json.dump(record, f)
+
+        try:
+            self.storage.write(path, dump)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not write training fingerprint {path}: {str(e)}")
+
+    def delete(self, user_id, category):
+        path = self.path(user_id, category)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def check(self, user_id, category, dates, amounts, options):
+        """(UNCHANGED/APPENDED/CHANGED, stored sidecar or None) for a history about to be trained on"""
+        record = self.load(user_id, category)
+        if record is None:
+            return CHANGED, None
+        return compare(record.get('fingerprint'), dates, amounts, options), record
+
+    def count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
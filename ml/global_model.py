@@ -0,0 +1,105 @@
+import numpy as np
+
+from ml.compiled import CompiledLinear, CompiledTrees
+from ml.features import date_parts
+
+# Features of the per-category models shared across users. Amount-valued
+# inputs are divided by the user's historical mean, which is also the unit
+# of the target, so users with very different spending share one model.
+GLOBAL_FEATURES = [
+    'month', 'day_of_month', 'is_weekend',
+    'prev_ratio', 'rolling_ratio_3', 'user_cv', 'log_user_mean'
+]
+
+# Pseudo-rows pulling a user's residual offset towards zero; users with a
+# few expenses get a small correction, long histories close to their mean
+OFFSET_SHRINKAGE = 5.0
+
+# user_id of the training jobs that fit a category model
+ALL_USERS = '*'
+
+
+def user_key(user_id):
+    return str(user_id)
+
+
+def user_scale(means, stds):
+    """(mean, scale) with a zero mean replaced by 1 and a NaN spread by 0"""
+    means = np.where(means > 0, means, 1.0)
+    return means, np.nan_to_num(stds, nan=0.0)
+
+
+def global_feature_rows(dates, prev_amounts, rolling_means, means, scales):
+    """GLOBAL_FEATURES matrix for expenses (or next periods) on the given dates"""
+    month, day_of_month, is_weekend = date_parts(dates)
+    return np.column_stack([
+        month, day_of_month, is_weekend,
+        prev_amounts / means, rolling_means / means,
+        scales / means, np.log1p(means)
+    ]).astype(np.float64)
+
+
+class GlobalCategoryModel:
+    """One model for a category, shared by every user.
+
+    The model predicts amounts in units of the user's historical mean. Users
+    seen in training keep three numbers (mean, scale, residual offset) in
+    sorted arrays; users it has never seen get their mean and scale from the
+    expenses they send and no offset, so cold-start users still get a model
+    forecast. calibration holds the conformal interval offsets of the
+    model's predictions, in units of the user's mean (see ml.calibration).
+    """
+
+    def __init__(self, category, model, user_ids, means, scales, offsets, calibration=None):
+        self.category = category
+        self.model = model
+        self.calibration = calibration
+        self.feature_names_in_ = np.array(GLOBAL_FEATURES, dtype=object)
+        keys = np.array([user_key(u) for u in user_ids], dtype=str)
+        order = np.argsort(keys, kind='stable')
+        self.user_keys = keys[order]
+        self.means = np.asarray(means, dtype=np.float64)[order]
+        self.scales = np.asarray(scales, dtype=np.float64)[order]
+        self.offsets = np.asarray(offsets, dtype=np.float64)[order]
+
+    @property
+    def users(self):
+        return len(self.user_keys)
+
+    def user_stats(self, user_id):
+        """(mean, scale, offset) of a user seen in training, or None"""
+        key = user_key(user_id)
+        i = np.searchsorted(self.user_keys, key)
+        if i < len(self.user_keys) and self.user_keys[i] == key:
+            return self.means[i], self.scales[i], self.offsets[i]
+        return None
+
+    def predict_ratio(self, X):
+        if isinstance(self.model, (CompiledLinear, CompiledTrees)):
+            return self.model.predict(X)
+        import pandas as pd
+        return self.model.predict(pd.DataFrame(X, columns=GLOBAL_FEATURES))
+
+    def interval_offsets(self, user_id, features):
+        """Calibrated (lower, upper) offsets of a user's forecast in amounts, or None"""
+        calibration = getattr(self, 'calibration', None)  # models saved before calibration
+        if calibration is None:
+            return None
+        stats = self.user_stats(user_id)
+        mean = stats[0] if stats is not None else user_scale(np.array([features['mean']]), np.array([0.0]))[0][0]
+        return calibration['lower'] * mean, calibration['upper'] * mean
+
+    def forecast(self, user_id, features):
+        """(prediction, cold_start) from next_period_features-style values of the recent expenses"""
+        stats = self.user_stats(user_id)
+        cold_start = stats is None
+        if cold_start:
+            mean, scale = user_scale(np.array([features['mean']]), np.array([features['std']]))
+            offset = 0.0
+        else:
+            mean, scale, offset = np.array([stats[0]]), np.array([stats[1]]), stats[2]
+        row = global_feature_rows(np.array([features['next_date']], dtype='datetime64[D]'),
+                                  np.array([features['prev_amount']]), np.array([features['rolling_mean_3']]),
+                                  mean, scale)
+        prediction = float(self.predict_ratio(row)[0] * mean[0] + offset)
+        return max(prediction, 0.0), cold_start
@@ -0,0 +1,245 @@
+"""Forecasts of several future periods in one call.
+
+Per-expense models predict one period (NEXT_PERIOD_DAYS) after the last
+expense from lag features of the amounts before it, so forecasting further
+out feeds each step's prediction back in as the next step's prev_amount and
+rolling_mean_3. Linear models do this in closed form: the lags make the
+steps a lower-triangular system that is solved for every step at once.
+Other models step through the horizon, predicting all their groups
+together at each step, with the lag columns updated as arrays.
+
+Every step carries an interval of INTERVAL_Z standard errors either side.
+The error of one step is the spread of the recent amounts, and it grows
+with the errors of the earlier steps that feed into it. Models with
+calibrated offsets (see ml.calibration) use those for the first step and
+widen them at the same rate instead.
+"""
+import numpy as np
+
+from ml.calibration import INTERVAL_Z
+from ml.compiled import CompiledLinear, CompiledTrees
+from ml.features import NEXT_PERIOD_DAYS, date_parts, model_feature_names, next_month_label
+from ml.global_model import GlobalCategoryModel, global_feature_rows, user_scale
+from ml.monthly import MonthlyForecaster
+
+# Most periods one request may ask for
+MAX_HORIZON = 12
+
+# Amounts the lag features look back over (prev_amount, rolling_mean_3)
+LAGS = 3
+
+
+def parse_horizon(value):
+    """Number of periods requested, or None when omitted; raises ValueError when invalid"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"horizon must be a whole number of periods, got {value!r}")
+    try:
+        horizon = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"horizon must be a whole number of periods, got {value!r}")
+    if not 1 <= horizon <= MAX_HORIZON:
+        raise ValueError(f"horizon must be between 1 and {MAX_HORIZON}")
+    return horizon
+
+
+def tail_amounts(offsets, amounts, means):
+    """(groups x LAGS) last amounts of each date-sorted group, oldest first.
+
+    Groups with fewer rows are padded with their mean, which leaves the
+    mean of the tail (the rolling_mean_3 of the next period) unchanged.
+    """
+    counts = np.diff(offsets)
+    lasts = offsets[1:] - 1
+    tail = np.repeat(np.asarray(means, dtype=np.float64)[:, None], LAGS, axis=1)
+    for k in range(LAGS):
+        has = counts > k
+        tail[has, LAGS - 1 - k] = amounts[lasts[has] - k]
+    return tail
+
+
+def step_dates(stats, horizon):
+    """(groups x horizon) dates of the forecast periods, NEXT_PERIOD_DAYS apart"""
+    steps = (np.arange(horizon) * NEXT_PERIOD_DAYS).astype('timedelta64[D]')
+    return stats['next_date'][:, None] + steps
+
+
+def step_features(stats, dates):
+    """DEFAULT_FEATURES other than the lags, as (groups x horizon) arrays"""
+    month, day_of_month, is_weekend = date_parts(dates)
+    first = stats['next_date'] - stats['days_since_first'].astype('timedelta64[D]')
+    counts = stats['seq'][:, None]
+    steps = np.arange(dates.shape[1])
+    return {
+        'month': month,
+        'day_of_month': day_of_month,
+        'is_weekend': is_weekend,
+        'days_since_first': (dates - first[:, None]).astype(np.int64),
+        'seq': counts + steps,
+        'trend': 1 + steps / np.maximum(counts - 1, 1)
+    }
+
+
+def bound_steps(predictions, rolling, stats):
+    """Pull unreasonable predictions (negative, or over twice the largest amount) back in range"""
+    unreasonable = (predictions < 0) | (predictions > stats['max'] * 2)
+    adjusted = 0.5 * stats['mean'] + 0.5 * rolling
+    adjusted = np.maximum(stats['min'] * 0.5, np.minimum(adjusted, stats['max'] * 1.5))
+    return np.where(unreasonable, adjusted, predictions)
+
+
+def linear_rollout(weights, bias, names, exog, tail):
+    """Closed-form forecasts of a linear model X @ weights + bias over every step.
+
+    With a the prev_amount weight and r the rolling_mean_3 weight, step h is
+    y[h] = c[h] + (a + r/3) y[h-1] + r/3 y[h-2] + r/3 y[h-3], where c is the
+    contribution of the other features and y before the first step is the
+    tail. Moving the earlier steps to the left side gives a lower-triangular
+    Toeplitz system (I - L) y = c + tail terms, solved for all groups in one
+    call. Returns (predictions, psi): psi[j] is how much an error at one step
+    moves the prediction j steps later.
+    """
+    groups, horizon = next(iter(exog.values())).shape
+    index = {name: i for i, name in enumerate(names)}
+    a = weights[index['prev_amount']] if 'prev_amount' in index else 0.0
+    r = weights[index['rolling_mean_3']] if 'rolling_mean_3' in index else 0.0
+    phi = np.array([a + r / 3, r / 3, r / 3])
+
+    rhs = np.full((groups, horizon), float(bias))
+    for name, weight in zip(names, weights):
+        if name in exog:
+            rhs += weight * exog[name]
+    system = np.eye(horizon)
+    for lag in range(1, LAGS + 1):
+        system -= phi[lag - 1] * np.eye(horizon, k=-lag)
+        # Lags that reach back before the first step read the tail
+        for h in range(min(lag, horizon)):
+            rhs[:, h] += phi[lag - 1] * tail[:, LAGS + h - lag]
+
+    predictions = np.linalg.solve(system, rhs.T).T
+    psi = np.linalg.solve(system, np.eye(horizon)[:, 0])
+    return predictions, psi
+
+
+def recursive_rollout(predict, horizon, tail):
+    """Step through the horizon; predict(step, prev_amount, rolling_mean_3) returns every group's prediction"""
+    tail = tail.copy()
+    predictions = np.empty((len(tail), horizon))
+    for h in range(horizon):
+        predictions[:, h] = predict(h, tail[:, -1], tail.mean(axis=1))
+        tail = np.column_stack((tail[:, 1:], predictions[:, h]))
+    return predictions
+
+
+def statistical_rollout(stats, horizon, max_amount=None):
+    """The statistical forecast of predict_groups, with its trend effect added once per step"""
+    mean = stats['mean']
+    max_amount = stats['max'] if max_amount is None else max_amount
+    trend_effect = np.minimum(0.2 * mean, np.abs(stats['slope'] * stats['count']))
+    trend_effect *= np.where(stats['slope'] > 0, 1, -1)
+    level = 0.7 * stats['weighted_avg'] + 0.3 * mean
+    predictions = level[:, None] + trend_effect[:, None] * np.arange(1, horizon + 1)
+    return np.maximum(stats['min'][:, None] * 0.5, np.minimum(predictions, max_amount[:, None] * 1.5))
+
+
+def forecast_horizon(model, stats, offsets, dates, amounts, horizon, user_ids=None, max_amount=None):
+    """Forecasts of the next horizon periods for groups served by one model.
+
+    stats is grouped_next_period's dict for the groups and group g owns
+    offsets[g]:offsets[g + 1] of the date-sorted arrays; model None is the
+    statistical forecast (max_amount optionally overrides its upper bound)
+    and GlobalCategoryModel needs the groups' user_ids. Returns (periods,
+    predictions, stderr) as (groups x horizon) arrays: the date each step
+    forecasts (its month for monthly models), the prediction and its
+    standard error.
+    """
+    groups = len(offsets) - 1
+    sigma = np.nan_to_num(stats['std'], nan=0.0)[:, None]
+    random_walk = np.sqrt(np.arange(1, horizon + 1))
+
+    if isinstance(model, MonthlyForecaster):
+        periods = np.empty((groups, horizon), dtype='datetime64[M]')
+        predictions = np.empty((groups, horizon))
+        stderr = np.empty((groups, horizon))
+        for g in range(groups):
+            rows = slice(offsets[g], offsets[g + 1])
+            predictions[g], periods[g], spread = model.forecast_steps(dates[rows], amounts[rows], horizon)
+            stderr[g] = spread * random_walk
+        return periods, predictions, stderr
+
+    periods = step_dates(stats, horizon)
+    tail = tail_amounts(offsets, amounts, stats['mean'])
+
+    if model is None:
+        if max_amount is not None:
+            max_amount = np.full(groups, float(max_amount))
+        return periods, statistical_rollout(stats, horizon, max_amount), sigma * random_walk
+
+    if isinstance(model, GlobalCategoryModel):
+        # Trained users keep their stats and offset; unseen users take them from their expenses
+        known = [model.user_stats(user_id) for user_id in user_ids]
+        cold_means, cold_scales = user_scale(stats['mean'], stats['std'])
+        means = np.array([s[0] if s is not None else m for s, m in zip(known, cold_means)])
+        scales = np.array([s[1] if s is not None else c for s, c in zip(known, cold_scales)])
+        user_offsets = np.array([s[2] if s is not None else 0.0 for s in known])
+
+        def predict(h, prev_amount, rolling_mean_3):
+            rows = global_feature_rows(periods[:, h], prev_amount, rolling_mean_3, means, scales)
+            return np.maximum(model.predict_ratio(rows) * means + user_offsets, 0.0)
+
+        return periods, recursive_rollout(predict, horizon, tail), sigma * random_walk
+
+    names = list(model_feature_names(model))
+    exog = step_features(stats, periods)
+    linear = model if isinstance(model, CompiledLinear) else CompiledLinear.from_model(model)
+    if linear is not None:
+        predictions, psi = linear_rollout(linear.weights, linear.bias, names, exog, tail)
+        # The closed form holds while no step needs bounding; groups where one does step through
+        rolling = np.concatenate((tail, predictions), axis=1)
+        rolling = np.stack([rolling[:, h:h + LAGS].mean(axis=1) for h in range(horizon)], axis=1)
+        bounded = bound_steps(predictions, rolling, {n: stats[n][:, None] for n in ('min', 'max', 'mean')})
+        if np.array_equal(bounded, predictions):
+            return periods, predictions, sigma * np.sqrt(np.cumsum(psi ** 2))
+
+    X = np.zeros((groups, len(names)))
+
+    def predict(h, prev_amount, rolling_mean_3):
+        for f, name in enumerate(names):
+            if name == 'prev_amount':
+                X[:, f] = prev_amount
+            elif name == 'rolling_mean_3':
+                X[:, f] = rolling_mean_3
+            elif name in exog:
+                X[:, f] = exog[name][:, h]
+        if isinstance(model, (CompiledLinear, CompiledTrees)):
+            predictions = model.predict(X)
+        else:
+            import pandas as pd
+            predictions = model.predict(pd.DataFrame(X, columns=names))
+        return bound_steps(np.asarray(predictions, dtype=np.float64), rolling_mean_3, stats)
+
+    return periods, recursive_rollout(predict, horizon, tail), sigma * random_walk
+
+
+def horizon_steps(periods, predictions, stderr, offsets=None):
+    """One {step, period, date, prediction, lower, upper} dict per step of one group.
+
+    offsets, the model's calibrated (lower, upper) one-step offsets, set the
+    first step's interval; later steps scale them as their stderr grows.
+    """
+    stderr = np.nan_to_num(stderr, nan=0.0)
+    if offsets is None:
+        lower, upper = -INTERVAL_Z * stderr, INTERVAL_Z * stderr
+    else:
+        steps = np.arange(1, len(stderr) + 1)
+        growth = stderr / stderr[0] if stderr[0] > 0 else np.sqrt(steps)
+        lower, upper = offsets[0] * growth, offsets[1] * growth
+    return [{
+        'step': h + 1,
+        'period': next_month_label(period),
+        'date': str(period.astype('datetime64[D]')),
+        'prediction': round(float(prediction), 2),
+        'lower': round(max(float(prediction + low), 0.0), 2),
+        'upper': round(max(float(prediction + high), 0.0), 2)
+    } for h, (period, prediction, low, high) in enumerate(zip(periods, predictions, lower, upper))]
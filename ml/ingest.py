@@ -0,0 +1,186 @@
+import json
+from array import array
+from collections import deque
+
+import numpy as np
+
+from ml.features import parse_dates, parse_amounts
+
+# Bytes read from a request body at a time; parsed rows never outlive their chunk
+DEFAULT_CHUNK_BYTES = 1024 * 1024
+
+
+class SortedHistory:
+    """Date-sorted dates (datetime64[D]) and amounts (float64) of one expense history.
+
+    Accepted by train_expense_model in place of a list of rows, and cheap to
+    send to a training worker: it pickles as two flat arrays.
+    """
+
+    __slots__ = ('dates', 'amounts')
+
+    def __init__(self, dates, amounts):
+        self.dates = dates
+        self.amounts = amounts
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getstate__(self):
+        return self.dates, self.amounts
+
+    def __setstate__(self, state):
+        self.dates, self.amounts = state
+
+
+class GroupedHistory:
+    """Expense histories of many users, sorted by date within each user.
+
+    User user_ids[i] owns dates/amounts[offsets[i]:offsets[i + 1]]. Used to
+    train the per-category models shared across users.
+    """
+
+    __slots__ = ('user_ids', 'offsets', 'dates', 'amounts')
+
+    def __init__(self, user_ids, offsets, dates, amounts):
+        self.user_ids = list(user_ids)
+        self.offsets = offsets
+        self.dates = dates
+        self.amounts = amounts
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def __getstate__(self):
+        return self.user_ids, self.offsets, self.dates, self.amounts
+
+    def __setstate__(self, state):
+        self.user_ids, self.offsets, self.dates, self.amounts = state
+
+
+class HistoryAccumulator:
+    """Folds chunks of {amount, date} rows into compact per-history state.
+
+    Rows are kept as packed day numbers and amounts (16 bytes per row)
+    alongside per-month counts and sums and the last three amounts. While the
+    rows arrive in date order, as the Node API sends them, no sort is needed
+    at the end; otherwise history() sorts once, stably, like sorted_series.
+    """
+
+    def __init__(self):
+        self._days = array('q')
+        self._amounts = array('d')
+        self._months = {}  # months since 1970-01 -> [count, sum]
+        self._last = deque(maxlen=3)
+        self._last_day = None
+        self.in_order = True
+
+    def __len__(self):
+        return len(self._amounts)
+
+    def extend(self, rows):
+        """Add a chunk of rows; raises ValueError on a row without a valid amount and date"""
+        if not rows:
+            return
+        try:
+            dates = parse_dates([row['date'] for row in rows])
+            amounts = parse_amounts([row['amount'] for row in rows])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Expense rows need an amount and a date: {str(e)}")
+        if np.isnat(dates).any():
+            raise ValueError("Expense rows need an amount and a date")
+        days = dates.astype(np.int64)
+
+        if self.in_order:
+            ordered = bool(np.all(days[1:] >= days[:-1]))
+            if not ordered or (self._last_day is not None and days[0] < self._last_day):
+                self.in_order = False
+        self._last_day = int(days[-1]) if self._last_day is None else max(self._last_day, int(days[-1]))
+        self._last.extend(amounts[-3:].tolist())
+
+        months = dates.astype('datetime64[M]').astype(np.int64)
+        first = months.min()
+        counts = np.bincount(months - first)
+        sums = np.bincount(months - first, weights=amounts)
+        for offset in np.flatnonzero(counts):
+            entry = self._months.setdefault(int(first + offset), [0, 0.0])
+            entry[0] += int(counts[offset])
+            entry[1] += float(sums[offset])
+
+        self._days.frombytes(days.tobytes())
+        self._amounts.frombytes(amounts.tobytes())
+
+    def history(self):
+        """The rows as a SortedHistory (views of the packed buffers when they arrived in order)"""
+        days = np.frombuffer(self._days, dtype=np.int64) if self._days else np.zeros(0, dtype=np.int64)
+        amounts = np.frombuffer(self._amounts, dtype=np.float64) if self._amounts else np.zeros(0)
+        dates = days.view('datetime64[D]')
+        if not self.in_order:
+            order = np.argsort(dates, kind='stable')
+            dates, amounts = dates[order], amounts[order]
+        return SortedHistory(dates, amounts)
+
+    def monthly(self):
+        """(months as datetime64[M], expense counts, amount totals), sorted by month"""
+        keys = sorted(self._months)
+        months = np.array(keys, dtype=np.int64).view('datetime64[M]')
+        counts = np.array([self._months[k][0] for k in keys], dtype=np.int64)
+        sums = np.array([self._months[k][1] for k in keys], dtype=np.float64)
+        return months, counts, sums
+
+    def last_amounts(self):
+        """The last (up to) three amounts in date order, oldest first"""
+        if self.in_order:
+            return list(self._last)
+        return self.history().amounts[-3:].tolist()
+
+
+def read_ndjson(stream, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Parse a newline-delimited JSON stream, yielding one list of objects per chunk read.
+
+    Blank lines are skipped; a malformed line raises ValueError with its line number.
+    """
+    line_number = 0
+    pending = b''
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            break
+        lines = (pending + data).split(b'\n')
+        pending = lines.pop()
+        objects = []
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                objects.append(_parse_line(line, line_number))
+        yield objects
+    if pending.strip():
+        yield [_parse_line(pending, line_number + 1)]
+
+
+def _parse_line(line, line_number):
+    try:
+        value = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Line {line_number} is not valid JSON: {str(e)}")
+    if not isinstance(value, dict):
+        raise ValueError(f"Line {line_number} is not a JSON object")
+    return value
+
+
+def ingest_ndjson(stream, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Read an NDJSON training body into (header, HistoryAccumulator).
+
+    The first line may be a header object without a 'date' (user_id,
+    category, wait, ...); every other line is one {amount, date} expense.
+    """
+    header = {}
+    accumulator = HistoryAccumulator()
+    first = True
+    for objects in read_ndjson(stream, chunk_bytes):
+        if first and objects:
+            if 'date' not in objects[0]:
+                header = objects.pop(0)
+            first = False
+        accumulator.extend(objects)
+    return header, accumulator
@@ -0,0 +1,351 @@
+import os
+import re
+import json
+import uuid
+import time
+import threading
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class QueueFullError(Exception):
+    """Raised when too many training jobs are already waiting"""
+
+
+def _train(expenses, options):
+    # sklearn and pandas are imported by the worker that trains, not by the
+    # serving process that only queues jobs
+    from ml.training import train_expense_model, train_category_model
+    if 'category_model' in options:
+        return train_category_model(expenses, options['category_model'])
+    return train_expense_model(expenses, **options)
+
+
+def _init_worker():
+    # Training workers yield the CPU to the processes serving predictions
+    if hasattr(os, 'nice'):
+        try:
+            os.nice(10)
+        except OSError:
+            pass
+
+
+class TrainingJobQueue:
+    """Runs /train jobs on a bounded process pool.
+
+    Jobs wait in this queue until a worker is free, so pending jobs can be
+    cancelled outright; a running job cannot be interrupted, but its result
+    is discarded. At most one job per (user_id, category) is queued or
+    running at a time and submitting another returns the existing job.
+    Finished jobs are kept (up to max_finished) so their status and result
+    can still be read. on_complete(job, artifacts) is called in this process
+    for every successful job that was not cancelled, so saving the models
+    happens next to the model cache it has to invalidate.
+
+    With a state_dir, every job is also written there as <job_id>.json when
+    its status changes, so several serving processes sharing the directory
+    can report (and request cancellation of) each other's jobs.
+    """
+
+    def __init__(self, max_workers=2, max_pending=32, max_finished=1000, on_complete=None, state_dir=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.on_complete = on_complete
+        self.state_dir = state_dir
+        self._closed = False
+        self._jobs = OrderedDict()  # job_id -> job dict
+        self._pending = deque()  # job ids waiting for a worker
+        self._inputs = {}  # job_id -> (expenses, options), until dispatched
+        self._futures = {}  # job_id -> Future of a running job
+        self._done = {}  # job_id -> Event set once the job is finished
+        self._active = {}  # (user_id, category) -> job_id
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return self._executor
+
+    def _discard_executor(self, executor):
+        # Called with the lock held. A pool whose worker died (OOM, SIGKILL) refuses every
+        # later submit; the next dispatch starts a new one
+        if self._executor is executor and executor is not None:
+            logger.warning("Training worker pool is broken, starting a new one")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _submit_job(self, job_id):
+        """(future, executor) running a pending job's inputs; a broken pool is replaced once"""
+        inputs = self._inputs.pop(job_id)
+        executor = self._get_executor()
+        try:
+            return executor.submit(_train, *inputs), executor
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            executor = self._get_executor()
+            return executor.submit(_train, *inputs), executor
+
+    def submit(self, user_id, category, expenses, **options):
+        """Queue a training job; options are passed on to train_expense_model. Returns (job, created)"""
+        key = (user_id, category)
+        with self._lock:
+            active_id = self._active.get(key)
+            if active_id is not None:
+                return dict(self._jobs[active_id]), False
+
+            if self._closed:
+                raise QueueFullError("Training queue is shut down")
+            if len(self._pending) >= self.max_pending:
+                raise QueueFullError(f"{len(self._pending)} training jobs already waiting")
+
+            job = self._new_job(user_id, category, len(expenses))
+            job_id = job['job_id']
+            self._active[key] = job_id
+            self._inputs[job_id] = (expenses, options)
+            self._pending.append(job_id)
+            self._done[job_id] = threading.Event()
+            self._publish(job)
+
+        logger.info(f"Queued training job {job_id} for user {user_id}, category {category}")
+        self._dispatch()
+        return self.get(job_id), True
+
+    def complete(self, user_id, category, rows, result, **fields):
+        """Record a finished job whose result was reused instead of trained. Returns (job, created)
+
+        Like submit, returns the queued or running job of the (user_id,
+        category) instead when there is one.
+        """
+        with self._lock:
+            active_id = self._active.get((user_id, category))
+            if active_id is not None:
+                return dict(self._jobs[active_id]), False
+            job = self._new_job(user_id, category, rows)
+            job.update(fields, started_at=job['submitted_at'], result=result)
+            self._close(job, SUCCEEDED)
+        logger.info(f"Recorded training job {job['job_id']} for user {user_id}, category {category} "
+                    f"without training")
+        return self.get(job['job_id']), True
+
+    def _new_job(self, user_id, category, rows):
+        # Called with the lock held
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'category': category,
+            'status': PENDING,
+            'rows': rows,
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'cancel_requested': False,
+            'result': None,
+            'error': None
+        }
+        self._jobs[job['job_id']] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        return self._read(job_id)
+
+    def wait(self, job_id, timeout):
+        """Block up to timeout seconds for a job to finish, then return its status"""
+        event = self._done.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        elif job_id not in self._jobs:
+            # Owned by another process: poll its state file
+            deadline = time.time() + timeout
+            job = self._read(job_id)
+            while job is not None and job['status'] in (PENDING, RUNNING) and time.time() < deadline:
+                time.sleep(0.2)
+                job = self._read(job_id)
+        return self.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job. Pending jobs are dropped; running jobs have their result discarded"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return self._request_cancel(job_id)
+            if job['status'] == PENDING:
+                self._pending.remove(job_id)
+                self._inputs.pop(job_id, None)
+                self._close(job, CANCELLED)
+                logger.info(f"Cancelled pending training job {job_id}")
+            elif job['status'] == RUNNING:
+                job['cancel_requested'] = True
+                self._publish(job)
+                logger.info(f"Training job {job_id} is running, its result will be discarded")
+            return dict(job)
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return {'max_workers': self.max_workers, 'max_pending': self.max_pending, 'jobs': counts}
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs: pending jobs are cancelled, running ones finish if wait"""
+        with self._lock:
+            self._closed = True
+            while self._pending:
+                job_id = self._pending.popleft()
+                self._inputs.pop(job_id, None)
+                self._jobs[job_id]['error'] = 'Training queue shut down'
+                self._close(self._jobs[job_id], CANCELLED)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+    def _dispatch(self):
+        """Hand pending jobs to the pool while there are idle workers"""
+        started = []
+        with self._lock:
+            while not self._closed and self._pending and len(self._futures) < self.max_workers:
+                job_id = self._pending.popleft()
+                job = self._jobs[job_id]
+                if self._cancel_marker_exists(job_id):
+                    self._inputs.pop(job_id, None)
+                    self._close(job, CANCELLED)
+                    continue
+                try:
+                    future, executor = self._submit_job(job_id)
+                except Exception as e:
+                    # Never leave a job running that no worker has: later /train calls would wait on it
+                    logger.error(f"Could not start training job {job_id}: {str(e)}", exc_info=True)
+                    job['error'] = f"Could not start training: {str(e) or type(e).__name__}"
+                    self._close(job, FAILED)
+                    continue
+                job['status'] = RUNNING
+                job['started_at'] = time.time()
+                self._futures[job_id] = future
+                self._publish(job)
+                started.append((job_id, future, executor))
+        # Outside the lock: a future that is already done runs its callback right away
+        for job_id, future, executor in started:
+            future.add_done_callback(lambda f, job_id=job_id, executor=executor: self._finish(job_id, f, executor))
+
+    def _finish(self, job_id, future, executor=None):
+        with self._lock:
+            job = self._jobs[job_id]
+            cancel_requested = job['cancel_requested'] or self._cancel_marker_exists(job_id)
+
+        result = error = artifacts = None
+        if future.cancelled():
+            # Dropped by a shutdown or by the replacement of a broken pool
+            status = CANCELLED
+            error = 'Training worker pool shut down'
+        elif future.exception() is not None:
+            status = FAILED
+            error = str(future.exception()) or type(future.exception()).__name__
+            logger.error(f"Training job {job_id} failed: {error}")
+            if isinstance(future.exception(), BrokenProcessPool):
+                with self._lock:
+                    self._discard_executor(executor)
+        else:
+            result, artifacts = future.result()
+            status = CANCELLED if cancel_requested else SUCCEEDED
+
+        # The job only reports success once the model has been saved
+        if status == SUCCEEDED and self.on_complete is not None:
+            try:
+                self.on_complete(dict(job, result=result), artifacts)
+            except Exception as e:
+                logger.error(f"Error completing training job {job_id}: {str(e)}", exc_info=True)
+                status = FAILED
+                error = str(e)
+
+        with self._lock:
+            job.update(result=result, error=error)
+            self._futures.pop(job_id, None)
+            self._close(job, status)
+        logger.info(f"Training job {job_id} finished with status {status}")
+        self._dispatch()
+
+    def _close(self, job, status):
+        # Called with the lock held
+        job['status'] = status
+        job['finished_at'] = time.time()
+        key = (job['user_id'], job['category'])
+        if self._active.get(key) == job['job_id']:
+            del self._active[key]
+        done = self._done.pop(job['job_id'], None)
+        if done is not None:
+            done.set()
+        self._publish(job)
+        finished = [job_id for job_id, j in self._jobs.items()
+                    if j['status'] in (SUCCEEDED, FAILED, CANCELLED)]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+            self._unpublish(job_id)
+
+    # Shared job state, only used with a state_dir
+
+    def _state_path(self, job_id, ext='json'):
+        # job ids come from request URLs; only accept the ids this queue creates
+        if self.state_dir is None or not re.fullmatch(r'[0-9a-f]{32}', job_id):
+            return None
+        return os.path.join(self.state_dir, f'{job_id}.{ext}')
+
+    def _publish(self, job):
+        path = self._state_path(job['job_id'])
+        if path is None:
+            return
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(job, f)
+            os.replace(path + '.tmp', path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not write state of training job {job['job_id']}: {str(e)}")
+
+    def _unpublish(self, job_id):
+        for ext in ('json', 'cancel'):
+            path = self._state_path(job_id, ext)
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def _read(self, job_id):
+        path = self._state_path(job_id)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _request_cancel(self, job_id):
+        """Ask the process that owns a job to cancel it"""
+        job = self._read(job_id)
+        if job is not None and job['status'] in (PENDING, RUNNING):
+            open(self._state_path(job_id, 'cancel'), 'w').close()
+            job['cancel_requested'] = True
+            logger.info(f"Requested cancellation of training job {job_id} owned by another process")
+        return job
+
+    def _cancel_marker_exists(self, job_id):
+        path = self._state_path(job_id, 'cancel')
+        return path is not None and os.path.exists(path)
@@ -0,0 +1,137 @@
+import time
+import threading
+from bisect import bisect_left
+
+# Upper bounds (seconds) of the latency histogram buckets, from 100us to 1 minute
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class StageTimer:
+    """Splits the time of one request into named stages.
+
+    lap(stage) charges the time since the previous lap (or since the timer
+    was created) to that stage; time for the same (stage, model_type) adds
+    up, so a batch records one total per stage rather than one per group.
+    """
+
+    def __init__(self):
+        self.stages = {}  # (stage, model_type) -> seconds
+        self._last = time.perf_counter()
+
+    def lap(self, stage, model_type=''):
+        now = time.perf_counter()
+        self.add(stage, now - self._last, model_type)
+        self._last = now
+
+    def add(self, stage, seconds, model_type=''):
+        key = (stage, model_type)
+        self.stages[key] = self.stages.get(key, 0.0) + seconds
+
+    def skip(self):
+        """Start the next stage now, leaving the time since the last lap uncharged"""
+        self._last = time.perf_counter()
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Index of the first bucket the value fits in; len(buckets) is +Inf
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[i] += 1
+            entry[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        with self._lock:
+            for label_values, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(bounds, entry):
+                    cumulative += count
+                    labels = _labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {entry[-1]}')
+                lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """Counters and histograms rendered in the Prometheus text format.
+
+    Collectors are callables returning (name, type, help, [(labels dict,
+    value), ...]) tuples; they are called at render time, for values that
+    are already counted elsewhere (e.g. the model cache counters).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_labels(tuple(labels), tuple(labels.values()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,102 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+import joblib
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """Bounded LRU cache of models loaded from disk.
+
+    Entries are keyed by file path and remember the (mtime, size) of the file
+    they were loaded from, so a model rewritten on disk is reloaded on the next
+    lookup. The byte budget uses the on-disk size as an estimate of the
+    in-memory size of the unpickled model.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=256 * 1024 * 1024, loader=joblib.load):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._entries = OrderedDict()  # path -> (fingerprint, model, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, path):
+        """Return the model stored at path, or None if the file does not exist"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return None
+
+        fingerprint = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return entry[1]
+                # File changed on disk since it was cached
+                self._remove(path)
+                self.invalidations += 1
+            self.misses += 1
+
+        model = self._loader(path)
+        self.put(path, model, fingerprint, st.st_size)
+        return model
+
+    def put(self, path, model, fingerprint, size):
+        """Insert a loaded model, evicting least recently used entries as needed"""
+        if size > self.max_bytes or self.max_entries <= 0:
+            logger.info(f"Model {path} ({size} bytes) exceeds cache budget, not caching")
+            return
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+            self._entries[path] = (fingerprint, model, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                evicted, _ = next(iter(self._entries.items()))
+                self._remove(evicted)
+                self.evictions += 1
+                logger.info(f"Evicted model {evicted} from cache")
+
+    def invalidate(self, path):
+        """Drop a cached model, e.g. after /train writes a new file"""
+        with self._lock:
+            if path in self._entries:
+                self._remove(path)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
+
+    def _remove(self, path):
+        _, _, size = self._entries.pop(path)
+        self._bytes -= size
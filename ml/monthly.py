@@ -0,0 +1,214 @@
+import numpy as np
+
+from ml.compiled import CompiledLinear, CompiledTrees
+
+# Feature set of the monthly models, in training order. Row t describes
+# calendar month t from the months before it; the target is its total.
+MONTHLY_FEATURES = [
+    'month_of_year', 'months_since_first',
+    'prev_total', 'prev_total_2', 'rolling_total_3', 'prev_count'
+]
+
+# Months of totals a forecaster keeps to build the features of the next month
+TAIL_MONTHS = 3
+
+GRANULARITIES = ('transaction', 'month')
+
+
+def month_ids(dates):
+    """Months since 1970-01 of a datetime64 array"""
+    return dates.astype('datetime64[M]').astype(np.int64)
+
+
+def grouped_monthly_totals(offsets, dates, amounts):
+    """Calendar-month totals for every group of date-sorted expenses at once.
+
+    Group i owns dates[offsets[i]:offsets[i + 1]] and must be non-empty.
+    Every month from a group's first to its last is included, with zeros for
+    months without expenses. Returns (month_offsets, totals) where group i
+    owns rows month_offsets[i]:month_offsets[i + 1] of the totals arrays
+    'month' (datetime64[M]), 'count', 'sum', 'mean' and 'max'.
+    """
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    months = month_ids(dates)
+    first = months[starts]
+    spans = months[offsets[1:] - 1] - first + 1
+    month_offsets = np.concatenate(([0], np.cumsum(spans)))
+
+    # Row of each expense in the flat array of all groups' months
+    rows = np.repeat(month_offsets[:-1] - first, counts) + months
+    size = int(month_offsets[-1])
+    count = np.bincount(rows, minlength=size)
+    total = np.bincount(rows, weights=amounts, minlength=size)
+    # Expenses are sorted by date, so each month's rows are contiguous
+    month_starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    largest = np.zeros(size)
+    if len(amounts):
+        largest[rows[month_starts]] = np.maximum.reduceat(amounts, month_starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, 0.0)
+
+    group_first = np.repeat(first, spans)
+    position = np.arange(size) - np.repeat(month_offsets[:-1], spans)
+    return month_offsets, {
+        'month': (group_first + position).astype('datetime64[M]'),
+        'count': count,
+        'sum': total,
+        'mean': mean,
+        'max': largest
+    }
+
+
+def monthly_totals(dates, amounts):
+    """Calendar-month totals of one date-sorted series (see grouped_monthly_totals)"""
+    if not len(amounts):
+        empty = np.zeros(0)
+        return {'month': np.array([], dtype='datetime64[M]'), 'count': empty.astype(np.int64),
+                'sum': empty, 'mean': empty, 'max': empty}
+    return grouped_monthly_totals(np.array([0, len(amounts)]), dates, amounts)[1]
+
+
+def build_monthly_features(totals):
+    """MONTHLY_FEATURES for every month of one series of totals.
+
+    Lag columns are NaN where their window is incomplete; 'valid' marks the
+    months with a full three-month history.
+    """
+    sums = totals['sum'].astype(np.float64)
+    n = len(sums)
+    seq = np.arange(n)
+
+    def shifted(values, k):
+        out = np.full(n, np.nan)
+        out[k:] = values[:n - k]
+        return out
+
+    prev_1, prev_2, prev_3 = shifted(sums, 1), shifted(sums, 2), shifted(sums, 3)
+    return {
+        'month_of_year': month_ids(totals['month']) % 12 + 1,
+        'months_since_first': seq,
+        'prev_total': prev_1,
+        'prev_total_2': prev_2,
+        'rolling_total_3': (prev_1 + prev_2 + prev_3) / 3,
+        'prev_count': shifted(totals['count'].astype(np.float64), 1),
+        'valid': seq >= TAIL_MONTHS
+    }
+
+
+def next_monthly_features(month_id, months_since_first, tail_sums, tail_counts):
+    """MONTHLY_FEATURES of month month_id from the trailing months before it (oldest first)"""
+    # Months before the first one count as empty
+    tail = tail_sums[-TAIL_MONTHS:]
+    sums = np.zeros(TAIL_MONTHS)
+    sums[TAIL_MONTHS - len(tail):] = tail
+    return {
+        'month_of_year': month_id % 12 + 1,
+        'months_since_first': months_since_first,
+        'prev_total': sums[-1],
+        'prev_total_2': sums[-2],
+        'rolling_total_3': sums.mean(),
+        'prev_count': float(tail_counts[-1]) if len(tail_counts) else 0.0
+    }
+
+
+class MonthlyForecaster:
+    """A model fitted on monthly totals, with the trailing months it forecasts from.
+
+    /predict only sends a handful of recent expenses, too few to rebuild
+    monthly lags, so the forecaster keeps the totals of the last TAIL_MONTHS
+    months of its training history. forecast() folds in the expenses dated
+    after the last one it has seen and predicts the total of the following
+    calendar month, bounded the same way training bounds it.
+
+    Only the expenses a request sends are folded in. When they do not reach
+    back to the last training date (covers() is False), expenses added in
+    between are missing and the recent monthly totals are undercounted;
+    /predict flags those forecasts with partial_month.
+    """
+
+    def __init__(self, model, totals, last_date):
+        self.model = model
+        self.feature_names_in_ = np.array(MONTHLY_FEATURES, dtype=object)
+        self.first_month = int(month_ids(totals['month'][:1])[0])
+        self.tail_month = int(month_ids(totals['month'][-1:])[0])
+        self.tail_sums = totals['sum'][-TAIL_MONTHS:].astype(np.float64).copy()
+        self.tail_counts = totals['count'][-TAIL_MONTHS:].astype(np.int64).copy()
+        self.last_date = np.datetime64(last_date, 'D')
+        self.mean_total = float(totals['sum'].mean())
+        self.max_total = float(totals['sum'].max())
+        self.min_total = float(totals['sum'].min())
+
+    def _folded_tail(self, dates, amounts):
+        """(totals, counts, last month) of the trailing months, with newer expenses folded in"""
+        sums = list(self.tail_sums)
+        counts = list(self.tail_counts)
+        tail_month = self.tail_month
+        if dates is not None and len(dates):
+            new = dates > self.last_date
+            if new.any():
+                new_months = month_ids(dates[new])
+                for month, amount in zip(new_months.tolist(), amounts[new].tolist()):
+                    while month > tail_month:
+                        tail_month += 1
+                        sums.append(0.0)
+                        counts.append(0)
+                    sums[-1 - (tail_month - month)] += amount
+                    counts[-1 - (tail_month - month)] += 1
+        return sums, counts, tail_month
+
+    def next_features(self, dates=None, amounts=None):
+        """(feature dict, forecast month) after folding in expenses newer than the training data"""
+        sums, counts, tail_month = self._folded_tail(dates, amounts)
+        features = next_monthly_features(tail_month + 1, tail_month + 1 - self.first_month, sums, counts)
+        return features, np.datetime64(tail_month + 1, 'M')
+
+    def _predict(self, features):
+        row = np.array([[float(features[name]) for name in MONTHLY_FEATURES]])
+        if isinstance(self.model, (CompiledLinear, CompiledTrees)):
+            prediction = float(self.model.predict(row)[0])
+        else:
+            import pandas as pd
+            prediction = float(self.model.predict(pd.DataFrame(row, columns=MONTHLY_FEATURES))[0])
+        return bound_total(prediction, features, self.min_total, self.max_total, self.mean_total)
+
+    def covers(self, dates=None):
+        """Whether expenses reach back to the training data, so every newer expense is among them"""
+        return dates is not None and len(dates) > 0 and dates.min() <= self.last_date
+
+    def spread(self, dates=None, amounts=None):
+        """Standard deviation of the trailing months' totals, with newer expenses folded in"""
+        sums, _, _ = self._folded_tail(dates, amounts)
+        return float(np.std(sums[-TAIL_MONTHS:]))
+
+    def forecast(self, dates=None, amounts=None):
+        """(predicted total, forecast month as datetime64[M])"""
+        features, month = self.next_features(dates, amounts)
+        return self._predict(features), month
+
+    def forecast_steps(self, dates, amounts, horizon):
+        """(totals, months, spread) of the next horizon calendar months.
+
+        Each forecast total is fed back as the next month's lags; the
+        expense counts of forecast months are taken as the recent average.
+        spread is the standard deviation of the trailing months' totals.
+        """
+        spread = self.spread(dates, amounts)
+        sums, counts, tail_month = self._folded_tail(dates, amounts)
+        count = float(np.mean(counts[-TAIL_MONTHS:])) if counts else 0.0
+        totals = []
+        for month in range(tail_month + 1, tail_month + 1 + horizon):
+            total = self._predict(next_monthly_features(month, month - self.first_month, sums, counts))
+            totals.append(total)
+            sums.append(total)
+            counts.append(count)
+        months = np.arange(tail_month + 1, tail_month + 1 + horizon).astype('datetime64[M]')
+        return np.array(totals), months, spread
+
+
+def bound_total(prediction, features, min_total, max_total, mean_total):
+    """Pull an unreasonable monthly forecast (negative, or over twice the largest month) back in range"""
+    if prediction < 0 or prediction > max_total * 2:
+        adjusted = 0.5 * mean_total + 0.5 * features['rolling_total_3']
+        prediction = max(min_total * 0.5, min(adjusted, max_total * 1.5))
+    return prediction
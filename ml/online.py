@@ -0,0 +1,127 @@
+import numpy as np
+
+from ml.features import DEFAULT_FEATURES, build_features, feature_matrix
+from ml.registry import StandardizedLinearModel
+
+# 'trend' is seq / (n - 1) and changes for every row whenever a row is added,
+# so incrementally updated models use the other features only
+ONLINE_FEATURES = [name for name in DEFAULT_FEATURES if name != 'trend']
+
+# Rows needed before the lag features (prev_amount_3, rolling_std_3) are complete
+LAG_ROWS = 3
+
+# Pipelines these model types were fitted with can be replaced by an online model
+LINEAR_MODEL_TYPES = {'linear': 0.0, 'robust_linear': 0.0, 'simple_linear': 0.0, 'ridge': 1.0}
+
+
+class OutOfOrderError(Exception):
+    """Raised when observed rows are older than the rows already folded in"""
+
+
+class OnlineLinearModel(StandardizedLinearModel):
+    """StandardScaler + Ridge/LinearRegression fitted from running statistics.
+
+    Keeps the row count, means and centered co-moment matrices of the
+    features and target, merged batch by batch (Chan et al.), so adding rows
+    costs O(new rows) and the coefficients solve a k x k system. On the same
+    rows it reproduces Pipeline([StandardScaler(), Ridge(alpha)]) (alpha=0
+    for LinearRegression). It also keeps the last LAG_ROWS expenses so the
+    lag features of new rows can be computed without the history.
+    """
+
+    def __init__(self, feature_names=ONLINE_FEATURES, alpha=1.0):
+        k = len(feature_names)
+        super().__init__(feature_names, np.zeros(k), np.ones(k), np.zeros(k), 0.0)
+        self.alpha = alpha
+        # Whether this model replaces the saved pipeline as /observe updates it
+        self.serving = False
+        self.n_samples_ = 0
+        self.x_mean_ = np.zeros(k)
+        self.y_mean_ = 0.0
+        self.xx_ = np.zeros((k, k))
+        self.xy_ = np.zeros(k)
+        # Series state: rows seen so far, first date and the last LAG_ROWS rows
+        self.rows_seen = 0
+        self.first_date = None
+        self.recent_dates = np.array([], dtype='datetime64[D]')
+        self.recent_amounts = np.array([], dtype=np.float64)
+
+    @classmethod
+    def from_history(cls, dates, amounts, alpha=1.0):
+        """Fit on a full date-sorted history"""
+        model = cls(alpha=alpha)
+        model.observe(dates, amounts)
+        return model
+
+    @property
+    def last_date(self):
+        return self.recent_dates[-1] if len(self.recent_dates) else None
+
+    def observe(self, dates, amounts):
+        """Fold new date-sorted rows into the model. Returns the rows used for fitting"""
+        if len(amounts) == 0:
+            return 0
+        if self.last_date is not None and dates[0] < self.last_date:
+            raise OutOfOrderError(f"Rows from {dates[0]} are older than the last observed date {self.last_date}")
+
+        # Prepend the remembered rows so lag features of the new rows are complete
+        all_dates = np.concatenate((self.recent_dates, dates))
+        all_amounts = np.concatenate((self.recent_amounts, amounts))
+        offset = self.rows_seen - len(self.recent_amounts)
+        if self.first_date is None:
+            self.first_date = dates[0]
+
+        columns = build_features(all_dates, all_amounts)
+        columns['seq'] = columns['seq'] + offset
+        columns['days_since_first'] = (all_dates - self.first_date).astype(np.int64)
+        new_rows = np.arange(len(all_amounts)) >= len(self.recent_amounts)
+        fit_rows = new_rows & (columns['seq'] >= LAG_ROWS)
+
+        if fit_rows.any():
+            names = list(self.feature_names_in_)
+            self.partial_fit(feature_matrix(columns, names)[fit_rows], all_amounts[fit_rows])
+
+        self.rows_seen += len(amounts)
+        self.recent_dates = all_dates[-LAG_ROWS:]
+        self.recent_amounts = all_amounts[-LAG_ROWS:]
+        return int(fit_rows.sum())
+
+    def partial_fit(self, X, y):
+        """Merge the statistics of a batch of rows and re-solve the coefficients"""
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        n_b = len(y)
+        x_mean_b = X.mean(axis=0)
+        y_mean_b = y.mean()
+        xc = X - x_mean_b
+        xx_b = xc.T @ xc
+        xy_b = xc.T @ (y - y_mean_b)
+
+        n_a = self.n_samples_
+        n = n_a + n_b
+        dx = x_mean_b - self.x_mean_
+        dy = y_mean_b - self.y_mean_
+        self.xx_ += xx_b + np.outer(dx, dx) * n_a * n_b / n
+        self.xy_ += xy_b + dx * dy * n_a * n_b / n
+        self.x_mean_ += dx * n_b / n
+        self.y_mean_ += dy * n_b / n
+        self.n_samples_ = n
+        self._solve()
+        return self
+
+    def _solve(self):
+        n = self.n_samples_
+        scale = np.sqrt(np.diag(self.xx_) / n)
+        # Constant features are left unscaled, as StandardScaler does
+        scale[scale < 10 * np.finfo(np.float64).eps] = 1.0
+        zz = self.xx_ / np.outer(scale, scale)
+        zy = self.xy_ / scale
+        if self.alpha > 0:
+            coef = np.linalg.solve(zz + self.alpha * np.eye(len(zy)), zy)
+        else:
+            coef = np.linalg.lstsq(zz, zy, rcond=None)[0]
+        self.mean_ = self.x_mean_.copy()
+        self.scale_ = scale
+        self.coef_ = coef
+        self.intercept_ = self.y_mean_
+
@@ -1,14 +1,227 @@
 #!/usr/bin/env python3
+"""Next-month expense prediction for one (user, category).
+
+One-shot:   python ml/predict.py '<input json>' ['<params json>']
+Streaming:  python ml/predict.py --serve
+
+In --serve mode the process stays up and reads one JSON request per line
+from stdin: the input object with optional "id", "user_id" and "category"
+fields, and an optional "horizon" (number of periods to forecast, listed
+with intervals under "horizon" in the result). It writes one JSON result
+per line to stdout, in request order, carrying the request's "id", so
+callers can pipeline requests. Every result has the lower and upper bounds
+of an 80% prediction interval (see ml.calibration). Imports and loaded
+models stay warm between requests.
+"""
 import sys
 import json
 import os
 import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-import joblib
 
-# Directory for storing models
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saved_models')
+# Allow importing the shared ml package when run as a script
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml.storage import MODEL_DIR, model_path as saved_model_path, global_model_path
+from ml.registry import ModelRegistry, REGISTRY_FILE
+from ml.calibration import CalibrationStore, CALIBRATION_FILE, INTERVAL_LEVEL, CONFORMAL, SPREAD, interval_bounds
+from ml.model_cache import ModelCache
+from ml.compiled import CompiledLinear, CompiledTrees, load_model_file
+from ml.features import (sorted_series, next_period_features, feature_vector, model_feature_names,
+                         next_month_label, grouped_next_period)
+from ml.horizon import parse_horizon, forecast_horizon, horizon_steps
+from ml.monthly import MonthlyForecaster, MONTHLY_FEATURES
+from ml.global_model import GlobalCategoryModel, GLOBAL_FEATURES
+
+# Category models shared by all users: 'fallback', 'prefer' or 'off' (as in ml_service.py)
+GLOBAL_MODELS = os.environ.get('ML_GLOBAL_MODELS', 'fallback')
+
+class SavedModels:
+    """Lookup of saved models, kept open across requests in --serve mode"""
+
+    def __init__(self):
+        self.registry = None
+        self.calibrations = None
+        self.cache = ModelCache(loader=load_model_file)
+
+    def get(self, user_id, category):
+        if GLOBAL_MODELS == 'prefer':
+            model = self._load(global_model_path(category))
+            if model is not None:
+                return model
+        model = self.get_own(user_id, category)
+        if model is None and GLOBAL_MODELS == 'fallback':
+            model = self._load(global_model_path(category))
+        return model
+
+    def _load(self, path):
+        try:
+            return self.cache.get(path)
+        except Exception as e:
+            print(f"Error loading model: {str(e)}", file=sys.stderr)
+            return None
+
+    def get_own(self, user_id, category):
+        # Linear models are registry records (folded into one weight vector);
+        # tree models are compiled node arrays, with the joblib pipeline as fallback
+        registry_path = os.path.join(MODEL_DIR, REGISTRY_FILE)
+        if self.registry is None and os.path.exists(registry_path):
+            self.registry = ModelRegistry(registry_path)
+        if self.registry is not None:
+            model = CompiledLinear.from_model(self.registry.get(user_id, category))
+            if model is not None:
+                return model
+        for path in (saved_model_path(user_id, category, prefix='compiled', ext='npz'),
+                     saved_model_path(user_id, category)):
+            model = self._load(path)
+            if model is not None:
+                return model
+        return None
+
+    def interval_offsets(self, user_id, category):
+        # Conformal offsets /train stored for the per-user model
+        calibration_path = os.path.join(MODEL_DIR, CALIBRATION_FILE)
+        if self.calibrations is None and os.path.exists(calibration_path):
+            self.calibrations = CalibrationStore(calibration_path)
+        return self.calibrations.get(user_id, category) if self.calibrations is not None else None
+
+def predict_payload(data, user_id=None, category=None, models=None):
+    """Prediction result for one input object ({recent_expenses, model})"""
+    recent_expenses = data['recent_expenses']
+    model_data = data['model']
+    horizon = parse_horizon(data.get('horizon'))
+    
+    # Try to load a saved model first if user_id and category are provided
+    model = None
+    offsets = None
+    if user_id and category:
+        models = models or SavedModels()
+        model = models.get(user_id, category)
+    
+    # Sorted arrays of dates and amounts, and the features of the next period
+    dates, amounts = sorted_series(recent_expenses)
+    features = next_period_features(dates, amounts)
+    
+    # Calculate confidence based on data variability
+    avg_amount = features['mean']
+    std_dev = features['std']
+    coefficient_of_variation = std_dev / avg_amount if avg_amount > 0 else 1
+    confidence = max(0, min(100, 100 * (1 - coefficient_of_variation)))
+    
+    # Get next month string
+    next_month = next_month_label(features['next_date'])
+    
+    # Category models are shared across users, in units of the user's mean
+    if isinstance(model, GlobalCategoryModel):
+        prediction, cold_start = model.forecast(user_id, features)
+        offsets = model.interval_offsets(user_id, features)
+        result = {
+            'prediction': round(float(prediction), 2),
+            'confidence': round(float(confidence), 2),
+            'next_month': next_month,
+            'model_type': 'global_model',
+            'features_used': list(GLOBAL_FEATURES),
+            'cold_start': cold_start
+        }
+    
+    # Monthly models forecast the total of the next calendar month
+    elif isinstance(model, MonthlyForecaster):
+        prediction, month = model.forecast(dates, amounts)
+        offsets = models.interval_offsets(user_id, category)
+        # Uncalibrated intervals spread like the monthly totals, not single expenses
+        std_dev = model.spread(dates, amounts)
+        result = {
+            'prediction': round(float(prediction), 2),
+            'confidence': round(float(confidence), 2),
+            'next_month': next_month_label(month),
+            'model_type': 'saved_model',
+            'features_used': list(MONTHLY_FEATURES),
+            'granularity': 'month',
+            'partial_month': not model.covers(dates)
+        }
+    
+    # If we have a saved model, use it for prediction
+    elif model:
+        # Get feature names from the model pipeline
+        model_features = model_feature_names(model)
+        
+        # Make prediction (missing features are filled with zeros)
+        row = [feature_vector(features, model_features)]
+        if isinstance(model, (CompiledLinear, CompiledTrees)):
+            prediction = model.predict(row)[0]
+        else:
+            prediction = model.predict(pd.DataFrame(row, columns=model_features))[0]
+        offsets = models.interval_offsets(user_id, category)
+        
+        # Return result
+        result = {
+            'prediction': round(float(prediction), 2),
+            'confidence': round(float(confidence), 2),
+            'next_month': next_month,
+            'model_type': 'saved_model',
+            'features_used': list(model_features)
+        }
+        
+    else:
+        # Use a fallback statistical approach if no model is available
+        max_amount = float(model_data.get('max_amount', features['max']))
+        
+        # Weighted average (more recent expenses have higher weight) and
+        # least-squares slope (trend) of the recent amounts
+        weighted_avg = features['weighted_avg']
+        trend = features['slope']
+        
+        # Prediction with trend adjustment
+        prediction = 0.7 * weighted_avg + 0.3 * avg_amount
+        
+        # Add trend effect (limited to prevent extreme predictions)
+        trend_effect = min(0.2 * avg_amount, abs(trend * len(amounts))) * (1 if trend > 0 else -1)
+        prediction += trend_effect
+        
+        # Ensure prediction is within reasonable bounds
+        min_amount = features['min']
+        prediction = max(min_amount * 0.5, min(prediction, max_amount * 1.5))
+        
+        result = {
+            'prediction': round(float(prediction), 2),
+            'confidence': round(float(confidence), 2),
+            'next_month': next_month,
+            'model_type': 'statistical',
+            'features_used': ['amount', 'weights', 'trend']
+        }
+    
+    # Calibrated interval when the model has offsets, the spread of the amounts (or monthly totals) otherwise
+    lower, upper, calibrated = interval_bounds(
+        [prediction], np.array([offsets[0] if offsets else np.nan]),
+        np.array([offsets[1] if offsets else np.nan]), np.array([std_dev]))
+    result.update({
+        'lower': round(float(lower[0]), 2),
+        'upper': round(float(upper[0]), 2),
+        'interval_level': INTERVAL_LEVEL,
+        'interval_method': CONFORMAL if calibrated[0] else SPREAD
+    })
+    
+    # Convert NaN to null for JSON compatibility
+    for key, value in result.items():
+        if isinstance(value, float) and (np.isnan(value) or np.isinf(value)):
+            result[key] = None
+    
+    if horizon is not None:
+        offsets = np.array([0, len(amounts)])
+        max_amount = None if model else float(model_data.get('max_amount', features['max']))
+        periods, predictions, stderr = forecast_horizon(model, grouped_next_period(offsets, dates, amounts),
+                                                        offsets, dates, amounts, horizon, [user_id], max_amount)
+        result['horizon'] = horizon_steps(periods[0], predictions[0], stderr[0], offsets)
+    
+    return result
+
+def error_result(e):
+    return {
+        'prediction': 0,
+        'confidence': 50.0,
+        'error': str(e),
+        'next_month': 'Error'
+    }
 
 def predict_next_expense():
     try:
@@ -24,180 +237,29 @@ def predict_next_expense():
             user_id = params.get('user_id')
             category = params.get('category')
         
-        recent_expenses = data['recent_expenses']
-        model_data = data['model']
-        
-        # Try to load a saved model first if user_id and category are provided
-        model = None
-        if user_id and category:
-            model_path = os.path.join(MODEL_DIR, f'model_{user_id}_{category.replace(" ", "_")}.joblib')
-            if os.path.exists(model_path):
-                try:
-                    model = joblib.load(model_path)
-                except Exception as e:
-                    print(f"Error loading model: {str(e)}", file=sys.stderr)
-        
-        # Convert expenses to DataFrame
-        df = pd.DataFrame(recent_expenses)
-        df['date'] = pd.to_datetime(df['date'])
-        df['amount'] = pd.to_numeric(df['amount'])
-        
-        # If we have a saved model, use it for prediction
-        if model:
-            # Extract features
-            df['month'] = df['date'].dt.month
-            df['day_of_month'] = df['date'].dt.day
-            df['day_of_week'] = df['date'].dt.dayofweek
-            df['is_weekend'] = df['day_of_week'].apply(lambda x: 1 if x >= 5 else 0)
-            
-            # Sort by date
-            df = df.sort_values('date')
-            
-            # Calculate days since first expense
-            first_date = df['date'].min()
-            df['days_since_first'] = (df['date'] - first_date).dt.days
-            
-            # Add sequence
-            df['seq'] = range(len(df))
-            
-            # Add rolling statistics
-            df['rolling_mean_3'] = df['amount'].rolling(window=min(3, len(df))).mean()
-            df['prev_amount'] = df['amount'].shift(1)
-            
-            # Fill missing values due to rolling calculations
-            df = df.fillna(method='bfill').fillna(method='ffill')
-            
-            # Get next month date
-            last_date = df['date'].max()
-            next_month_date = last_date + timedelta(days=30)
-            
-            # Create features for prediction
-            next_month_features = {
-                'month': next_month_date.month,
-                'day_of_month': next_month_date.day,
-                'is_weekend': 1 if next_month_date.weekday() >= 5 else 0,
-                'days_since_first': (next_month_date - first_date).days,
-                'seq': df['seq'].max() + 1,
-                'trend': (df['seq'].max() + 1) / (df['seq'].max() + 1),
-                'prev_amount': df['amount'].iloc[-1],
-                'rolling_mean_3': df['amount'].tail(min(3, len(df))).mean()
-            }
-            
-            # Get feature names from the model pipeline
-            model_features = []
-            try:
-                # For sklearn pipelines
-                model_step = model.named_steps.get('model')
-                if hasattr(model_step, 'feature_names_in_'):
-                    model_features = model_step.feature_names_in_
-            except:
-                # If can't determine features, use a default set
-                model_features = [
-                    'month', 'day_of_month', 'is_weekend',
-                    'days_since_first', 'seq', 'trend',
-                    'prev_amount', 'rolling_mean_3'
-                ]
-            
-            # Filter only the features the model expects
-            pred_features = {k: v for k, v in next_month_features.items() if k in model_features}
-            
-            # Create DataFrame for prediction
-            pred_df = pd.DataFrame([pred_features])
-            
-            # Handle missing features by adding zeros
-            for feature in model_features:
-                if feature not in pred_df.columns:
-                    pred_df[feature] = 0
-            
-            # Ensure columns are in the correct order
-            pred_df = pred_df[model_features]
-            
-            # Make prediction
-            prediction = model.predict(pred_df)[0]
-            
-            # Calculate confidence based on model accuracy and data variability
-            avg_amount = df['amount'].mean()
-            std_dev = df['amount'].std()
-            coefficient_of_variation = std_dev / avg_amount if avg_amount > 0 else 1
-            confidence = max(0, min(100, 100 * (1 - coefficient_of_variation)))
-            
-            # Get next month string
-            next_month = next_month_date.strftime('%B %Y')
-            
-            # Return result
-            result = {
-                'prediction': round(float(prediction), 2),
-                'confidence': round(float(confidence), 2),
-                'next_month': next_month,
-                'model_type': 'saved_model',
-                'features_used': list(model_features)
-            }
-            
-        else:
-            # Use a fallback statistical approach if no model is available
-            # Sort by date
-            df = df.sort_values('date')
-            
-            # Calculate basic statistics
-            avg_amount = df['amount'].mean()
-            max_amount = float(model_data.get('max_amount', df['amount'].max()))
-            
-            # Weighted average (more recent expenses have higher weight)
-            weights = np.linspace(0.5, 1.0, len(df))
-            weighted_avg = np.average(df['amount'], weights=weights)
-            
-            # Simple trend analysis
-            if len(df) >= 3:
-                x = np.arange(len(df))
-                y = df['amount'].values
-                coeffs = np.polyfit(x, y, 1)
-                trend = coeffs[0]  # Slope indicates trend
-            else:
-                trend = 0
-            
-            # Prediction with trend adjustment
-            prediction = 0.7 * weighted_avg + 0.3 * avg_amount
-            
-            # Add trend effect (limited to prevent extreme predictions)
-            trend_effect = min(0.2 * avg_amount, abs(trend * len(df))) * (1 if trend > 0 else -1)
-            prediction += trend_effect
-            
-            # Ensure prediction is within reasonable bounds
-            min_amount = df['amount'].min()
-            prediction = max(min_amount * 0.5, min(prediction, max_amount * 1.5))
-            
-            # Calculate confidence
-            std_dev = df['amount'].std()
-            coefficient_of_variation = std_dev / avg_amount if avg_amount > 0 else 1
-            confidence = max(0, min(100, 100 * (1 - coefficient_of_variation)))
-            
-            # Get next month date
-            last_date = df['date'].max()
-            next_month_date = last_date + timedelta(days=30)
-            next_month = next_month_date.strftime('%B %Y')
-            
-            result = {
-                'prediction': round(float(prediction), 2),
-                'confidence': round(float(confidence), 2),
-                'next_month': next_month,
-                'model_type': 'statistical',
-                'features_used': ['amount', 'weights', 'trend']
-            }
-        
-        # Convert NaN to null for JSON compatibility
-        for key, value in result.items():
-            if isinstance(value, float) and (np.isnan(value) or np.isinf(value)):
-                result[key] = None
-        
-        print(json.dumps(result))
+        print(json.dumps(predict_payload(data, user_id, category)))
         
     except Exception as e:
-        print(json.dumps({
-            'prediction': 0,
-            'confidence': 50.0,
-            'error': str(e),
-            'next_month': 'Error'
-        }))
+        print(json.dumps(error_result(e)))
+
+def serve(stdin=sys.stdin, stdout=sys.stdout):
+    """Answer newline-delimited JSON requests until stdin is closed"""
+    models = SavedModels()
+    for line in stdin:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            data = json.loads(line)
+            request_id = data.get('id')
+            result = predict_payload(data, data.get('user_id'), data.get('category'), models)
+        except Exception as e:
+            result = error_result(e)
+        stdout.write(json.dumps(dict(result, id=request_id)) + '\n')
+        stdout.flush()
 
 if __name__ == "__main__":
-    predict_next_expense()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == '--serve':
+        serve()
+    else:
+        predict_next_expense()
@@ -0,0 +1,222 @@
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import fnmatch
+import logging
+import threading
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+
+class _RequestCounter:
+    """WSGI middleware counting the requests a worker has handled"""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        # Requests are handled in threads
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.count += 1
+        return self.app(environ, start_response)
+
+
+class PreforkServer:
+    """Serve a WSGI app from N forked worker processes sharing one socket.
+
+    The parent binds the socket and calls preload() (imports, warmup, loading
+    hot models), then forks the workers, so the memory holding the loaded
+    models is shared copy-on-write instead of duplicated per worker. gc is
+    frozen before forking so collections in the workers do not touch (and
+    copy) those pages.
+
+    Each worker handles requests in threads, so one blocked in /train waiting
+    for its training job does not hold up predictions, and exits after
+    max_requests (plus up to max_requests_jitter, so workers do not restart
+    together), once its requests in progress are done; the parent replaces
+    workers that exit. SIGHUP, or a change to the files in watch_dir that
+    match watch_patterns (every file when None) noticed every
+    reload_interval seconds, reloads gracefully:
+    preload() runs again in the parent, a new set of workers is forked and
+    the old ones finish their current request and exit. SIGTERM/SIGINT stop
+    the workers the same way, killing them after graceful_timeout seconds.
+    """
+
+    def __init__(self, app, host='0.0.0.0', port=5000, workers=2, max_requests=0, max_requests_jitter=0,
+                 reload_interval=0, watch_dir=None, watch_patterns=None, graceful_timeout=30, backlog=128,
+                 preload=None, worker_exit=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.reload_interval = reload_interval
+        self.watch_dir = watch_dir
+        self.watch_patterns = watch_patterns
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.preload = preload
+        self.worker_exit = worker_exit
+        self._socket = None
+        self._children = {}  # pid -> generation
+        self._generation = 0
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self._socket.listen(self.backlog)
+        # Workers all wait on the socket; the ones that lose the race to accept get EAGAIN
+        self._socket.setblocking(False)
+
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, '_reload', True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, '_stopping', True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, '_stopping', True))
+
+        self._load()
+        logger.info(f"Serving on {self.host}:{self.port} with {self.workers} workers")
+        self._spawn_workers()
+        watched = self._watch_signature()
+        next_check = time.time() + self.reload_interval
+
+        while not self._stopping:
+            self._reap()
+            if self.reload_interval > 0 and time.time() >= next_check:
+                next_check = time.time() + self.reload_interval
+                signature = self._watch_signature()
+                if signature != watched:
+                    logger.info(f"Files in {self.watch_dir} changed, reloading")
+                    self._reload = True
+            if self._reload:
+                self._reload = False
+                watched = self._watch_signature()
+                self.reload()
+            time.sleep(0.5)
+
+        logger.info("Stopping workers")
+        self._stop_workers(list(self._children))
+        self._socket.close()
+
+    def reload(self):
+        """Preload again and replace every worker, letting old ones finish their request"""
+        old = list(self._children)
+        self._load()
+        self._spawn_workers()
+        self._stop_workers(old, wait=False)
+
+    def _load(self):
+        start_time = time.time()
+        if self.preload is not None:
+            self.preload()
+        import gc
+        gc.collect()
+        # Objects created so far are never collected, so workers leave their pages shared
+        gc.freeze()
+        logger.info(f"Preloaded in {round(time.time() - start_time, 3)}s")
+
+    def _spawn_workers(self):
+        self._generation += 1
+        for _ in range(self.workers):
+            self._spawn()
+
+    def _spawn(self):
+        max_requests = 0
+        if self.max_requests > 0:
+            max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._worker(max_requests)
+            except Exception:
+                logger.exception("Worker failed")
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self._children[pid] = self._generation
+        logger.info(f"Started worker {pid}")
+
+    def _worker(self, max_requests):
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        random.seed()
+
+        counter = _RequestCounter(self.app)
+        server = make_server(self.host, self.port, counter, threaded=True, fd=self._socket.fileno())
+        # Request threads are joined by server_close(), so a stopping worker finishes them first
+        server.daemon_threads = False
+        # Wake up regularly to notice SIGTERM
+        server.timeout = 1
+        while not stopping and (max_requests <= 0 or counter.count < max_requests):
+            server.handle_request()
+        server.server_close()
+
+        if max_requests > 0 and counter.count >= max_requests:
+            logger.info(f"Worker {os.getpid()} handled {counter.count} requests, exiting")
+        if self.worker_exit is not None:
+            self.worker_exit()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self._children.pop(pid, None)
+            if generation is None:
+                continue
+            logger.info(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}")
+            # Replace workers of the current generation that exit on their own
+            if generation == self._generation and not self._stopping:
+                self._spawn()
+
+    def _stop_workers(self, pids, wait=True):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self._children.pop(pid, None)
+        if not wait:
+            # _reap() collects them from the main loop once they exit
+            return
+        deadline = time.time() + self.graceful_timeout
+        while any(pid in self._children for pid in pids) and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in pids:
+            if pid in self._children:
+                logger.warning(f"Worker {pid} did not stop in {self.graceful_timeout}s, killing it")
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self._children.pop(pid, None)
+
+    def _watched(self, name):
+        return self.watch_patterns is None or any(fnmatch.fnmatchcase(name, p) for p in self.watch_patterns)
+
+    def _watch_signature(self):
+        """Latest modification time and number of the watched files in watch_dir"""
+        if self.watch_dir is None or not os.path.isdir(self.watch_dir):
+            return None
+        latest, count = 0, 0
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and self._watched(entry.name):
+                    latest = max(latest, entry.stat().st_mtime_ns)
+                    count += 1
+        return latest, count
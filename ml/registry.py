@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""Compact registry of linear-family models.
+
+A fitted StandardScaler + LinearRegression/Ridge pipeline is only a few
+arrays: scaler mean and scale, coefficients, intercept and feature names.
+The registry stores those as fixed-width records in one memory-mapped file
+indexed by (user_id, category), so loading a model is an O(1) slice of the
+mapping instead of opening and unpickling one joblib file per model. Models
+that do not fit in a record (tree ensembles, unknown features, non-integer
+user ids) keep using joblib files.
+
+Existing joblib models can be moved into the registry with:
+
+    python -m ml.registry migrate [--remove]
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+import threading
+import logging
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process locking only
+    fcntl = None
+
+from ml.features import DEFAULT_FEATURES
+from ml.storage import MODEL_DIR
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_FILE = 'linear_models.registry'
+MAGIC = b'EXPREG02'
+MAX_FEATURES = 16
+MAX_CATEGORY_BYTES = 48
+INITIAL_CAPACITY = 1024
+# Attempts at a consistent read of a record that a writer is updating
+READ_RETRIES = 1000
+
+# Feature names are stored as indexes into this vocabulary (append only)
+FEATURE_VOCAB = DEFAULT_FEATURES + [
+    'year', 'prev_amount_2', 'prev_amount_3', 'rolling_mean_2', 'rolling_std_3'
+]
+_FEATURE_IDS = {name: i for i, name in enumerate(FEATURE_VOCAB)}
+
+HEADER_SIZE = 64
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('record_size', '<u4'),
+    ('reserved', '<u4'),
+    ('capacity', '<u8'),
+    ('count', '<u8')
+])
+
+RECORD = np.dtype([
+    ('version', '<u4'),  # odd while a writer is updating the record
+    ('used', 'u1'),
+    ('n_features', 'u1'),
+    ('feature_ids', 'u1', (MAX_FEATURES,)),
+    ('user_id', '<i8'),
+    ('category', f'S{MAX_CATEGORY_BYTES}'),
+    ('mean', '<f8', (MAX_FEATURES,)),
+    ('scale', '<f8', (MAX_FEATURES,)),
+    ('coef', '<f8', (MAX_FEATURES,)),
+    ('intercept', '<f8'),
+    ('saved_at', '<f8')  # time.time() when put() saved the model; the storage budgets use it as its last use
+])
+
+# Registry files written before records had a saved time; opening one upgrades it
+MAGIC_V1 = b'EXPREG01'
+RECORD_V1 = np.dtype([(name, RECORD.fields[name][0]) for name in RECORD.names if name != 'saved_at'])
+
+
+class StandardizedLinearModel:
+    """Linear model on standardized features: ((X - mean) / scale) @ coef + intercept"""
+
+    def __init__(self, feature_names, mean, scale, coef, intercept):
+        self.feature_names_in_ = np.array(feature_names, dtype=object)
+        self.mean_ = np.asarray(mean, dtype=np.float64)
+        self.scale_ = np.asarray(scale, dtype=np.float64)
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = float(intercept)
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return ((X - self.mean_) / self.scale_) @ self.coef_ + self.intercept_
+
+
+def linear_parts(model):
+    """StandardizedLinearModel equivalent of a fitted model, or None if it has none.
+
+    Accepts a Pipeline of StandardScaler and a linear estimator, or any
+    object that already exposes mean_/scale_/coef_/intercept_.
+    """
+    if hasattr(model, 'named_steps'):
+        steps = list(model.named_steps.values())
+        if len(steps) != 2:
+            return None
+        scaler, estimator = steps
+        if not (hasattr(scaler, 'mean_') and hasattr(scaler, 'scale_')):
+            return None
+        coef = np.ravel(getattr(estimator, 'coef_', np.array([])))
+        intercept = getattr(estimator, 'intercept_', None)
+        names = getattr(model, 'feature_names_in_', None)
+        if intercept is None or names is None or np.ndim(intercept) != 0 or len(coef) != len(names):
+            return None
+        return StandardizedLinearModel(names, scaler.mean_, scaler.scale_, coef, intercept)
+    if all(hasattr(model, attr) for attr in ('feature_names_in_', 'mean_', 'scale_', 'coef_', 'intercept_')):
+        return StandardizedLinearModel(model.feature_names_in_, model.mean_, model.scale_,
+                                       model.coef_, model.intercept_)
+    return None
+
+
+def registry_key(user_id, category):
+    """(int user_id, encoded category) or None if the key does not fit a record"""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    category = str(category).replace(' ', '_').encode('utf-8')
+    if len(category) > MAX_CATEGORY_BYTES or category.endswith(b'\0'):
+        return None
+    return user_id, category
+
+
+class MappedRecords:
+    """Fixed-width records keyed by (user_id, category) in a memory-mapped file.
+
+    The file is a 64-byte header followed by `capacity` records, of which
+    the first `count` have been allocated. Slots are never moved, so each
+    process keeps a dict index from key to slot and only scans slots that
+    other processes appended since its last look. Records are updated in
+    place under a per-record version counter, so readers never see a
+    half-written record. Subclasses set `magic` and `record` (a dtype with
+    version, used, user_id and category fields).
+    """
+
+    magic = MAGIC
+    record = RECORD
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}
+        self._indexed = 0
+        self._capacity = 0
+        self._records = None
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            with self._file_lock():
+                if not os.path.exists(self.path):
+                    header = np.zeros(1, dtype=HEADER)
+                    header['magic'] = self.magic
+                    header['record_size'] = self.record.itemsize
+                    header['capacity'] = INITIAL_CAPACITY
+                    tmp_path = f'{self.path}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+                        f.truncate(HEADER_SIZE + INITIAL_CAPACITY * self.record.itemsize)
+                    os.replace(tmp_path, self.path)
+
+        self._header = np.memmap(self.path, dtype=HEADER, mode='r+', shape=(1,))
+        if self._header['magic'][0] != self.magic or self._header['record_size'][0] != self.record.itemsize:
+            raise ValueError(f"{self.path} is not a {type(self).__name__} file of this version")
+        self._map_records()
+
+    def _map_records(self):
+        self._capacity = int(self._header['capacity'][0])
+        self._records = np.memmap(self.path, dtype=self.record, mode='r+', offset=HEADER_SIZE,
+                                  shape=(self._capacity,))
+
+    def _file_lock(self):
+        return _FileLock(f'{self.path}.lock')
+
+    def _sync(self):
+        """Pick up slots appended and capacity grown by other processes (lock held)"""
+        if int(self._header['capacity'][0]) != self._capacity:
+            self._map_records()
+        count = int(self._header['count'][0])
+        if count > self._indexed:
+            block = self._records[self._indexed:count]
+            for slot, key in enumerate(zip(block['user_id'].tolist(), block['category'].tolist()), self._indexed):
+                self._index[key] = slot
+            self._indexed = count
+
+    def _read(self, key):
+        """A consistent copy of the used record of a registry_key, or None"""
+        with self._lock:
+            self._sync()
+            slot = self._index.get(key)
+            records = self._records
+        if slot is None:
+            return None
+
+        versions = records['version']
+        for _ in range(READ_RETRIES):
+            before = int(versions[slot])
+            if before % 2 == 0:
+                record = records[slot].copy()
+                if int(versions[slot]) == before:
+                    break
+        else:
+            logger.warning(f"Record of user {key[0]}, category {key[1].decode('utf-8')} is being rewritten, skipping")
+            return None
+        return record if record['used'] else None
+
+    def _store(self, key, record):
+        """Write a record for a registry_key, allocating a slot if it has none"""
+        with self._lock, self._file_lock():
+            self._sync()
+            self._put(key, record)
+
+    def _put(self, key, record):
+        # Both locks held
+        record['used'] = 1
+        record['user_id'], record['category'] = key
+        slot = self._index.get(key)
+        if slot is not None:
+            self._write(slot, record)
+            return
+        slot = self._indexed
+        if slot >= self._capacity:
+            self._grow()
+        # Write the record before publishing the slot to other processes
+        self._write(slot, record)
+        self._header['count'][0] = slot + 1
+        self._index[key] = slot
+        self._indexed = slot + 1
+
+    def _update(self, key, change, create=False):
+        """Rewrite the used record of a registry_key as change(copy) returns it; None if it has none.
+
+        With create, a key without a record gets change(empty record). The
+        file lock is held from read to write, so updates from other
+        processes are not lost. Nothing is written if change raises.
+        """
+        with self._lock, self._file_lock():
+            self._sync()
+            slot = self._index.get(key)
+            if slot is None or not self._records['used'][slot]:
+                if not create:
+                    return None
+                record = change(np.zeros((), dtype=self.record))
+                self._put(key, record)
+                return record
+            record = change(self._records[slot].copy())
+            self._write(slot, record)
+            return record
+
+    def _clear(self, key):
+        """Mark the record of a registry_key unused. Returns True if one existed"""
+        with self._lock, self._file_lock():
+            self._sync()
+            slot = self._index.get(key)
+            if slot is None or not self._records['used'][slot]:
+                return False
+            record = self._records[slot].copy()
+            record['used'] = 0
+            self._write(slot, record)
+        return True
+
+    def keys(self):
+        """(user_id, category) of every used record"""
+        with self._lock:
+            self._sync()
+            used = self._records['used'][:self._indexed]
+            return [(user_id, category.decode('utf-8')) for (user_id, category), slot in self._index.items()
+                    if used[slot]]
+
+    def usage(self):
+        with self._lock:
+            self._sync()
+            return {
+                'records': int(self._records['used'][:self._indexed].sum()),
+                'slots': self._indexed,
+                'capacity': self._capacity,
+                'file_bytes': HEADER_SIZE + self._capacity * self.record.itemsize
+            }
+
+    def flush(self):
+        with self._lock:
+            self._records.flush()
+            self._header.flush()
+
+    def _write(self, slot, record):
+        versions = self._records['version']
+        version = int(versions[slot]) + 1
+        versions[slot] = version  # odd: readers retry until the write is done
+        record['version'] = version
+        self._records[slot] = record
+        versions[slot] = version + 1
+
+    def _grow(self):
+        capacity = max(INITIAL_CAPACITY, self._capacity * 2)
+        self._records.flush()
+        with open(self.path, 'r+b') as f:
+            f.truncate(HEADER_SIZE + capacity * self.record.itemsize)
+        self._header['capacity'][0] = capacity
+        self._map_records()
+        logger.info(f"Grew {self.path} to {capacity} records")
+
+
+def _upgrade_v1(path):
+    """Rewrite a registry file of the first version, using its modification time as every saved time"""
+    with _FileLock(f'{path}.lock'):
+        header = np.fromfile(path, dtype=HEADER, count=1)
+        if len(header) == 0 or header['magic'][0] != MAGIC_V1:
+            return
+        capacity = int(header['capacity'][0])
+        old = np.fromfile(path, dtype=RECORD_V1, count=capacity, offset=HEADER_SIZE)
+        records = np.zeros(capacity, dtype=RECORD)
+        for name in RECORD_V1.names:
+            records[name][:len(old)] = old[name]
+        records['saved_at'] = os.path.getmtime(path)
+        header['magic'] = MAGIC
+        header['record_size'] = RECORD.itemsize
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+            f.write(records.tobytes())
+        os.replace(tmp_path, path)
+    logger.info(f"Upgraded {path} to records with a saved time")
+
+
+class ModelRegistry(MappedRecords):
+    """Fixed-width records of linear models in a memory-mapped file (see MappedRecords)"""
+
+    def __init__(self, path=None):
+        self.hits = 0
+        self.misses = 0
+        path = path or os.path.join(MODEL_DIR, REGISTRY_FILE)
+        if os.path.exists(path):
+            _upgrade_v1(path)
+        super().__init__(path)
+
+    def get(self, user_id, category):
+        """The registered model of a (user_id, category), or None"""
+        key = registry_key(user_id, category)
+        record = self._read(key) if key is not None else None
+        if record is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        n = int(record['n_features'])
+        names = [FEATURE_VOCAB[i] for i in record['feature_ids'][:n]]
+        return StandardizedLinearModel(names, record['mean'][:n], record['scale'][:n],
+                                       record['coef'][:n], record['intercept'])
+
+    def put(self, user_id, category, model):
+        """Store a linear model. Returns False if it cannot be represented as a record"""
+        key = registry_key(user_id, category)
+        parts = linear_parts(model)
+        if key is None or parts is None:
+            return False
+        names = list(parts.feature_names_in_)
+        if len(names) > MAX_FEATURES or any(name not in _FEATURE_IDS for name in names):
+            return False
+
+        n = len(names)
+        record = np.zeros((), dtype=RECORD)
+        record['n_features'] = n
+        record['feature_ids'][:n] = [_FEATURE_IDS[name] for name in names]
+        record['mean'][:n] = parts.mean_
+        record['scale'][:n] = parts.scale_
+        record['coef'][:n] = parts.coef_
+        record['intercept'] = parts.intercept_
+        record['saved_at'] = time.time()
+        self._store(key, record)
+        return True
+
+    def delete(self, user_id, category):
+        """Mark the record of a (user_id, category) unused. Returns True if one existed"""
+        key = registry_key(user_id, category)
+        return key is not None and self._clear(key)
+
+    def saved_times(self):
+        """{(user_id, category): time its model was saved} of every registered model"""
+        with self._lock:
+            self._sync()
+            records = self._records[:self._indexed]
+            used = records['used'].tolist()
+            saved_at = records['saved_at'].tolist()
+            return {(user_id, category.decode('utf-8')): saved_at[slot]
+                    for (user_id, category), slot in self._index.items() if used[slot]}
+
+    def stats(self):
+        return dict(self.usage(), hits=self.hits, misses=self.misses)
+
+
+class _FileLock:
+    """Exclusive lock on a side file, so writers in other processes wait"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._file = open(self.path, 'a')
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def migrate(model_dir=MODEL_DIR, remove=False):
+    """Move linear pipelines saved as model_<user>_<category>.joblib into the registry"""
+    import joblib
+
+    registry = ModelRegistry(os.path.join(model_dir, REGISTRY_FILE))
+    moved = skipped = 0
+    for path in sorted(glob.glob(os.path.join(model_dir, 'model_*.joblib'))):
+        user_id, _, category = os.path.basename(path)[len('model_'):-len('.joblib')].partition('_')
+        try:
+            model = joblib.load(path)
+        except Exception as e:
+            logger.warning(f"Skipping {path}: {str(e)}")
+            skipped += 1
+            continue
+        if registry.put(user_id, category, model):
+            moved += 1
+            if remove:
+                os.remove(path)
+        else:
+            skipped += 1
+    registry.flush()
+    return moved, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the linear model registry')
+    parser.add_argument('command', choices=['migrate', 'stats'])
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--remove', action='store_true', help='delete joblib files once migrated')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        moved, skipped = migrate(args.model_dir, args.remove)
+        print(f"Moved {moved} linear models into the registry, kept {skipped} joblib files")
+    else:
+        print(ModelRegistry(os.path.join(args.model_dir, REGISTRY_FILE)).stats())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main()
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ml.compiled import CompiledLinear
+
+logger = logging.getLogger(__name__)
+
+# Part of every key; bump it when the prediction code changes what it returns
+KEY_SCHEMA = b'predict-v1'
+
+# The on-disk table is pruned every this many writes
+PRUNE_EVERY = 256
+
+
+def model_version(model):
+    """Content hash of a model ('statistical' for None), memoized on the object.
+
+    Keys built from it change whenever the served model changes, in any
+    process, and stay the same when a retrain produces an identical model.
+    """
+    if model is None:
+        return 'statistical'
+    if isinstance(model, CompiledLinear):
+        # Rebuilt from the registry on every lookup, and only a few numbers
+        digest = hashlib.blake2b(model.weights.tobytes(), digest_size=16)
+        digest.update(np.float64(model.bias).tobytes())
+        digest.update('\0'.join(model.feature_names_in_).encode())
+        return digest.hexdigest()
+    version = getattr(model, '_content_version', None)
+    if version is None:
+        version = hashlib.blake2b(pickle.dumps(model, protocol=4), digest_size=16).hexdigest()
+        try:
+            model._content_version = version
+        except AttributeError:
+            pass
+    return version
+
+
+class ResultCache:
+    """Prediction results keyed by (model version, normalized recent expenses).
+
+    The key hashes the date-sorted expense dates (as days) and amounts, so
+    differently formatted or ordered copies of the same history share an
+    entry. Entries expire after ttl seconds and the least recently used are
+    evicted beyond max_entries. Keys are also indexed by (user_id, category)
+    so a retrain can drop exactly the entries of its model. With a path,
+    entries are written through to a SQLite file shared by every process
+    using it, and looked up there on a memory miss.
+    """
+
+    def __init__(self, max_entries=10000, ttl=1800, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()  # key -> (expires_at, result, owner)
+        self._owners = {}  # (user_id, category) -> set of keys
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    @staticmethod
+    def key(version, dates, amounts):
+        digest = hashlib.blake2b(KEY_SCHEMA, digest_size=20)
+        digest.update(version.encode())
+        digest.update(np.ascontiguousarray(dates, dtype='datetime64[D]').view(np.int64).tobytes())
+        digest.update(np.ascontiguousarray(amounts, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """A copy of the cached result, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(entry[1])
+                self._remove(key)
+            if self.path is not None:
+                row = self._connection().execute(
+                    'SELECT expires_at, result, user_id, category FROM results WHERE key = ? AND expires_at > ?',
+                    (key, now)).fetchone()
+                if row is not None:
+                    result = json.loads(row[1])
+                    self._insert(key, row[0], result, (json.loads(row[2]), json.loads(row[3])))
+                    self.hits += 1
+                    return dict(result)
+            self.misses += 1
+            return None
+
+    def put(self, key, result, user_id=None, category=None):
+        expires_at = time.time() + self.ttl
+        owner = (user_id, category)
+        with self._lock:
+            self._insert(key, expires_at, dict(result), owner)
+            if self.path is not None:
+                db = self._connection()
+                db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                           (key, expires_at, json.dumps(result), json.dumps(user_id), json.dumps(category)))
+                self._writes += 1
+                if self._writes % PRUNE_EVERY == 0:
+                    self._prune()
+
+    def invalidate(self, user_id, category):
+        """Drop every result computed with the model of a (user_id, category)"""
+        with self._lock:
+            keys = self._owners.pop((user_id, category), set())
+            for key in keys:
+                self._entries.pop(key, None)
+            if self.path is not None:
+                self._connection().execute('DELETE FROM results WHERE user_id = ? AND category = ?',
+                                           (json.dumps(user_id), json.dumps(category)))
+            self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            if self.path is not None:
+                self._connection().execute('DELETE FROM results')
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'persistent': self.path is not None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None
+            }
+
+    def _insert(self, key, expires_at, result, owner):
+        # Called with the lock held
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, result, owner)
+        self._owners.setdefault(owner, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, owner = self._entries.pop(key)
+        keys = self._owners.get(owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._owners[owner]
+
+    def _connection(self):
+        # One connection per process: a connection opened before a fork is not reused
+        if self._db is None or self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires_at REAL, '
+                             'result TEXT, user_id TEXT, category TEXT)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS results_owner ON results (user_id, category)')
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _prune(self):
+        """Drop expired rows, then the soonest-expiring ones beyond max_entries"""
+        db = self._connection()
+        db.execute('DELETE FROM results WHERE expires_at <= ?', (time.time(),))
+        db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY expires_at DESC '
+                   'LIMIT -1 OFFSET ?)', (self.max_entries,))
@@ -0,0 +1,193 @@
+"""Model selection by rolling-origin validation, within a time budget.
+
+Candidates are scored on folds that each train on the rows before an origin
+and test on the block of rows right after it, so a model is never scored on
+rows older than the ones it was fitted on. The folds' test blocks tile the
+most recent rows, and the mean absolute error over them picks the winner.
+
+Every (candidate, fold) fit runs on a thread pool: NumPy's least squares and
+sklearn's tree building release the GIL, and training already runs in worker
+processes, which a nested process pool would only oversubscribe. The cheap
+candidates are submitted first and each candidate's most recent fold first.
+
+An expensive candidate (gradient boosting) is abandoned as soon as it scores
+no better than the best cheap candidate on the folds both have finished: its
+queued folds are cancelled and its fits in progress stop at their next
+boosting stage. Whatever is unfinished when the budget runs out is abandoned
+the same way, and the winner is picked from the folds that did finish.
+"""
+import os
+import time
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Seconds one training may spend scoring candidates, and threads it may use
+SELECTION_BUDGET = float(os.environ.get('ML_SELECTION_BUDGET', 10.0))
+SELECTION_WORKERS = int(os.environ.get('ML_SELECTION_WORKERS', min(4, os.cpu_count() or 1)))
+
+FOLDS = 3
+# Fewest rows a fold trains on
+MIN_TRAIN_ROWS = 5
+
+# Status of a candidate in the selection report
+COMPLETED = 'completed'
+ABANDONED = 'abandoned'
+OUT_OF_BUDGET = 'out_of_budget'
+FAILED = 'failed'
+
+
+def rolling_origin_folds(n, folds=FOLDS, test_rows=None, min_train=MIN_TRAIN_ROWS):
+    """(train_end, test_end) of up to `folds` folds over n time-ordered rows, most recent first.
+
+    A fold trains on rows [0, train_end) and tests on [train_end, test_end);
+    test blocks are test_rows long (by default n / (folds + 1)) and end at
+    the last row. Folds that would train on fewer than min_train rows are dropped.
+    """
+    size = max(1, test_rows or n // (folds + 1))
+    bounds = []
+    for i in range(folds):
+        test_end = n - i * size
+        train_end = test_end - size
+        if train_end < min_train:
+            break
+        bounds.append((train_end, test_end))
+    return bounds
+
+
+def _stop_monitor(stop):
+    # GradientBoostingRegressor calls this after every stage and stops fitting once it returns True
+    return lambda i, estimator, local_vars: stop.is_set()
+
+
+def _fit_fold(build, X, y, fold, stop):
+    """Fit one candidate on a fold's training rows; (test predictions, seconds), or None when stopped"""
+    start = time.perf_counter()
+    train_end, test_end = fold
+    pipeline = build()
+    fit_params = {}
+    if 'monitor' in inspect.signature(pipeline.named_steps['model'].fit).parameters:
+        fit_params['model__monitor'] = _stop_monitor(stop)
+    pipeline.fit(X.iloc[:train_end], y[:train_end], **fit_params)
+    if stop.is_set():
+        return None
+    return pipeline.predict(X.iloc[train_end:test_end]), time.perf_counter() - start
+
+
+def _mean_mae(scores, folds):
+    return float(np.mean([scores[f] for f in folds]))
+
+
+def select_model(candidates, X, y, expensive=(), folds=FOLDS, test_rows=None, min_train=MIN_TRAIN_ROWS,
+                 budget=SELECTION_BUDGET, workers=SELECTION_WORKERS):
+    """Pick a candidate by rolling-origin validation.
+
+    candidates maps names to functions returning an unfitted pipeline (with
+    a 'model' step), in order of preference on ties; X (a DataFrame) and y
+    must be in time order. Returns (name, report, predictions): report has
+    the chosen name, the folds, and per candidate its status, fold MAEs and
+    seconds spent; predictions maps each scored candidate to the (actual,
+    predicted) amounts of the test rows it finished. name is None when no
+    fold finished (too few rows, or no budget).
+    """
+    start = time.perf_counter()
+    bounds = rolling_origin_folds(len(y), folds, test_rows, min_train)
+    cheap = [name for name in candidates if name not in expensive]
+    order = cheap + [name for name in candidates if name in expensive]
+    stops = {name: threading.Event() for name in order}
+    status = dict.fromkeys(order, COMPLETED)
+    scores = {name: {} for name in order}  # fold index -> MAE
+    fold_predictions = {name: {} for name in order}
+    seconds = dict.fromkeys(order, 0.0)
+
+    def abandon(name, reason):
+        stops[name].set()
+        status[name] = reason
+        for future, (owner, _) in futures.items():
+            if owner == name:
+                future.cancel()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    futures = {}
+    for name in order:
+        for f, fold in enumerate(bounds):
+            futures[executor.submit(_fit_fold, candidates[name], X, y, fold, stops[name])] = (name, f)
+
+    pending = set(futures)
+    try:
+        while pending:
+            remaining = start + budget - time.perf_counter()
+            if remaining <= 0:
+                for name in order:
+                    if status[name] == COMPLETED and any(futures[p][0] == name for p in pending):
+                        logger.warning(f"Selection budget of {budget}s spent, abandoning {name}")
+                        abandon(name, OUT_OF_BUDGET)
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, f = futures[future]
+                if future.cancelled() or stops[name].is_set():
+                    continue
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    logger.warning(f"{name} model failed on fold {f}: {str(e)}")
+                    abandon(name, FAILED)
+                    continue
+                predictions, fit_seconds = outcome
+                train_end, test_end = bounds[f]
+                scores[name][f] = float(np.mean(np.abs(y[train_end:test_end] - predictions)))
+                fold_predictions[name][f] = predictions
+                seconds[name] += fit_seconds
+
+            # Abandon expensive candidates that do not beat a finished cheap one
+            finished = [name for name in cheap if status[name] == COMPLETED and len(scores[name]) == len(bounds)]
+            for name in order:
+                if not finished or name in cheap or status[name] != COMPLETED or not scores[name]:
+                    continue
+                shared = list(scores[name])
+                best_cheap = min(_mean_mae(scores[c], shared) for c in finished)
+                if _mean_mae(scores[name], shared) >= best_cheap:
+                    logger.info(f"Abandoning {name}: no better than the cheap models after {len(shared)} folds")
+                    abandon(name, ABANDONED)
+            pending = {p for p in pending if not stops[futures[p][0]].is_set()}
+    finally:
+        # Stopped fits end at their next stage; nothing waits for them
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # The winner on the folds every remaining candidate finished
+    eligible = [name for name in order if status[name] in (COMPLETED, OUT_OF_BUDGET) and scores[name]]
+    chosen = None
+    if eligible:
+        shared = set.intersection(*(set(scores[name]) for name in eligible))
+        chosen = min(eligible, key=lambda name: (
+            _mean_mae(scores[name], shared or scores[name]), order.index(name)))
+
+    report = {
+        'chosen': chosen,
+        'folds': [list(fold) for fold in bounds],
+        'budget_seconds': budget,
+        'seconds': round(time.perf_counter() - start, 4),
+        'candidates': {name: {
+            'status': status[name],
+            'fold_mae': [round(scores[name][f], 4) if f in scores[name] else None for f in range(len(bounds))],
+            'mean_mae': round(_mean_mae(scores[name], scores[name]), 4) if scores[name] else None,
+            'seconds': round(seconds[name], 4)
+        } for name in order}
+    }
+    predictions = {}
+    for name in order:
+        done_folds = sorted(fold_predictions[name])
+        if done_folds:
+            predictions[name] = (
+                np.concatenate([y[bounds[f][0]:bounds[f][1]] for f in done_folds]),
+                np.concatenate([fold_predictions[name][f] for f in done_folds])
+            )
+    logger.info(f"Selected {chosen} in {report['seconds']}s: "
+                f"{ {name: info['mean_mae'] for name, info in report['candidates'].items()} }")
+    return chosen, report, predictions
@@ -0,0 +1,171 @@
+"""Per-(user, category) feature state, so /predict needs no expense history.
+
+The next-period features of a history only depend on a few numbers: its
+first date and row count, its mean and spread, and its last few expenses.
+A FeatureState keeps exactly those, with the mean and sum of squared
+deviations kept up to date by Welford's algorithm. /train seeds the state
+from the whole history, /observe folds each new expense in with an O(1)
+update, and /predict builds the features of a (user, category) sent without
+expenses from its state alone.
+
+States are fixed-width records in one memory-mapped file next to the model
+registry (see ml.registry.MappedRecords), shared by every worker process.
+"""
+import os
+
+import numpy as np
+
+from ml.online import OutOfOrderError
+from ml.registry import MappedRecords, MAX_CATEGORY_BYTES, registry_key
+from ml.storage import MODEL_DIR
+
+STATE_FILE = 'feature_states.registry'
+STATE_MAGIC = b'EXPSTA01'
+
+# Expenses kept per state: the recent expenses the Node API sends to /predict
+RECENT_ROWS = 5
+
+STATE_RECORD = np.dtype([
+    ('version', '<u4'),  # odd while a writer is updating the record
+    ('used', 'u1'),
+    ('n_recent', 'u1'),
+    ('user_id', '<i8'),
+    ('category', f'S{MAX_CATEGORY_BYTES}'),
+    ('count', '<i8'),
+    ('first_day', '<i8'),
+    ('mean', '<f8'),
+    ('m2', '<f8'),
+    ('recent_days', '<i8', (RECENT_ROWS,)),
+    ('recent_amounts', '<f8', (RECENT_ROWS,))
+])
+
+
+class FeatureState:
+    """Row count, first date, running mean and M2, and the last RECENT_ROWS expenses of a history"""
+
+    __slots__ = ('count', 'first_day', 'mean', 'm2', 'recent_days', 'recent_amounts')
+
+    def __init__(self, count, first_day, mean, m2, recent_days, recent_amounts):
+        self.count = int(count)
+        self.first_day = int(first_day)
+        self.mean = float(mean)
+        self.m2 = float(m2)
+        self.recent_days = np.asarray(recent_days, dtype=np.int64)
+        self.recent_amounts = np.asarray(recent_amounts, dtype=np.float64)
+
+    @classmethod
+    def from_history(cls, dates, amounts):
+        """State of a non-empty date-sorted history"""
+        days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+        amounts = np.asarray(amounts, dtype=np.float64)
+        mean = amounts.mean()
+        return cls(len(amounts), days[0], mean, np.sum((amounts - mean) ** 2),
+                   days[-RECENT_ROWS:], amounts[-RECENT_ROWS:])
+
+    @classmethod
+    def from_record(cls, record):
+        n = int(record['n_recent'])
+        return cls(record['count'], record['first_day'], record['mean'], record['m2'],
+                   record['recent_days'][:n], record['recent_amounts'][:n])
+
+    def to_record(self, record):
+        n = len(self.recent_amounts)
+        record['n_recent'] = n
+        record['count'] = self.count
+        record['first_day'] = self.first_day
+        record['mean'] = self.mean
+        record['m2'] = self.m2
+        record['recent_days'][:n] = self.recent_days
+        record['recent_amounts'][:n] = self.recent_amounts
+        return record
+
+    @property
+    def std(self):
+        # Sample standard deviation, NaN for one row like pandas
+        return np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else np.nan
+
+    @property
+    def recent_dates(self):
+        return self.recent_days.view('datetime64[D]')
+
+    def append(self, dates, amounts):
+        """Fold new date-sorted rows in, one O(1) Welford update each"""
+        days = np.asarray(dates, dtype='datetime64[D]').astype(np.int64)
+        if len(days) and len(self.recent_days) and days[0] < self.recent_days[-1]:
+            raise OutOfOrderError(f"Rows from {dates[0]} are older than the last observed date "
+                                  f"{self.recent_dates[-1]}")
+        for amount in np.asarray(amounts, dtype=np.float64).tolist():
+            self.count += 1
+            delta = amount - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (amount - self.mean)
+        self.recent_days = np.concatenate((self.recent_days, days))[-RECENT_ROWS:]
+        self.recent_amounts = np.concatenate((self.recent_amounts, amounts))[-RECENT_ROWS:]
+        return self
+
+    def version(self):
+        """Identifies the whole-history numbers, for result cache keys (the recent rows are hashed separately)"""
+        return f'{self.count}:{self.first_day}:{self.mean!r}:{self.m2!r}'
+
+
+def apply_states(stats, positions, states):
+    """Replace the whole-history columns of grouped_next_period stats with the states'.
+
+    stats computed from the states' recent expenses already hold the lag
+    features, bounds and recent trend; seq, days_since_first, mean and std
+    describe the whole history, as the model was trained on it.
+    """
+    # seq and count are one array; count stays the number of recent expenses
+    for name in ('seq', 'days_since_first', 'mean', 'std'):
+        stats[name] = stats[name].copy()
+    for k, state in zip(positions, states):
+        stats['seq'][k] = state.count
+        stats['days_since_first'][k] = stats['next_date'][k].astype(np.int64) - state.first_day
+        stats['mean'][k] = state.mean
+        stats['std'][k] = state.std
+
+
+class FeatureStateStore(MappedRecords):
+    """FeatureStates of every (user_id, category) in a memory-mapped file.
+
+    Keys that do not fit a record (non-integer user ids, long categories)
+    have no state; their predictions need the recent expenses.
+    """
+
+    magic = STATE_MAGIC
+    record = STATE_RECORD
+
+    def __init__(self, path=None):
+        super().__init__(path or os.path.join(MODEL_DIR, STATE_FILE))
+
+    def get(self, user_id, category):
+        """The FeatureState of a (user_id, category), or None"""
+        key = registry_key(user_id, category)
+        record = self._read(key) if key is not None else None
+        return FeatureState.from_record(record) if record is not None else None
+
+    def put(self, user_id, category, state):
+        """Store a state. Returns False if the key does not fit a record"""
+        key = registry_key(user_id, category)
+        if key is None:
+            return False
+        self._store(key, state.to_record(np.zeros((), dtype=STATE_RECORD)))
+        return True
+
+    def append(self, user_id, category, dates, amounts):
+        """Fold new rows into a stored state; the updated state, or None if there is none.
+
+        Raises OutOfOrderError, leaving the state as it was, for rows older
+        than the last one folded in.
+        """
+        key = registry_key(user_id, category)
+        if key is None:
+            return None
+        record = self._update(key, lambda record: FeatureState.from_record(record).append(dates, amounts)
+                              .to_record(record))
+        return FeatureState.from_record(record) if record is not None else None
+
+    def delete(self, user_id, category):
+        """Forget the state of a (user_id, category). Returns True if there was one"""
+        key = registry_key(user_id, category)
+        return key is not None and self._clear(key)
@@ -0,0 +1,519 @@
+"""Where the ML service keeps its models, and the manager that bounds that storage.
+
+Artifacts of a (user, category) are files named <prefix>_<user>_<category>.<ext>
+in MODEL_DIR: the served pipeline (model), its compiled node arrays
+(compiled), the online model /observe updates (online) and the training
+fingerprint (fingerprint). ModelStorage:
+
+- writes them atomically, to a temporary file renamed over the old one, so
+  readers in any process see the old or the new file, never a partial one;
+- keeps the last KEEP_VERSIONS versions of each model file in
+  versions/<file name>/<mtime in ns>, which can be restored;
+- records when a key's models were last served, as the access time of its
+  files (written at most every TOUCH_INTERVAL seconds per key);
+- compacts the directory, in the background every COMPACT_INTERVAL seconds
+  or on request: it removes temporary files of writes that died, compiled
+  arrays without their pipeline, versions of files that are gone, the
+  models of keys that no longer exist (when the caller says which exist)
+  and, only when a legacy directory is given, the *.joblib files the first
+  version of the service saved there, then evicts the least recently
+  used keys while the files are over the MAX_BYTES / MAX_MODELS budgets or
+  the disk has less than MIN_FREE_BYTES free, and reports the bytes reclaimed.
+
+Models served from records in memory-mapped files (ml.registry) count
+towards MAX_MODELS like the others, last used when they were saved, and are
+dropped through the on_remove callback; the record files themselves have a
+fixed size and are not part of the byte budgets.
+
+    python -m ml.storage usage
+    python -m ml.storage compact [--dry-run] [--legacy-dir models]
+    python -m ml.storage versions <file name>
+    python -m ml.storage restore <file name> <version>
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: compactions of several processes are not serialized
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Directory for storing models (can be overridden with ML_MODEL_DIR)
+MODEL_DIR = os.environ.get(
+    'ML_MODEL_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'saved_models')
+)
+
+# Directory of models saved by the first version of the service, which nothing loads any more.
+# Compaction only deletes its *.joblib files when this is set
+LEGACY_MODEL_DIR = os.environ.get('ML_LEGACY_MODEL_DIR') or None
+
+# Earlier versions kept of each model file
+KEEP_VERSIONS = int(os.environ.get('ML_MODEL_VERSIONS', 2))
+# Budgets of the per-(user, category) files and their versions (0: unlimited)
+MAX_BYTES = int(os.environ.get('ML_STORAGE_MAX_BYTES', 0))
+MAX_MODELS = int(os.environ.get('ML_STORAGE_MAX_MODELS', 0))
+# Free space to keep on the model directory's file system
+MIN_FREE_BYTES = int(os.environ.get('ML_STORAGE_MIN_FREE_BYTES', 0))
+# Seconds between background compactions (0: only on request)
+COMPACT_INTERVAL = float(os.environ.get('ML_STORAGE_COMPACT_INTERVAL', 3600))
+
+# A key's last use is written to its files at most this often
+TOUCH_INTERVAL = 300
+# Temporary files older than this are left over from writes that died
+TMP_MAX_AGE = 3600
+
+VERSIONS_DIR = 'versions'
+LOCK_FILE = 'storage.lock'
+# Written after each compaction, so the other worker processes skip theirs
+COMPACTED_FILE = 'storage.compacted'
+
+# (prefix, extension) of the files of a (user, category)
+KEY_FILES = (('model', 'joblib'), ('compiled', 'npz'), ('online', 'joblib'), ('fingerprint', 'json'))
+
+
+def model_filename(user_id, category, prefix='model', ext='joblib'):
+    """File name used for a (user, category) artifact in MODEL_DIR"""
+    return f'{prefix}_{user_id}_{str(category).replace(" ", "_")}.{ext}'
+
+
+def model_path(user_id, category, prefix='model', ext='joblib'):
+    """Absolute path of a (user, category) artifact in MODEL_DIR"""
+    return os.path.join(MODEL_DIR, model_filename(user_id, category, prefix, ext))
+
+
+def global_model_path(category, ext='joblib'):
+    """Absolute path of the model of a category shared by all users"""
+    return os.path.join(MODEL_DIR, f'global_{str(category).replace(" ", "_")}.{ext}')
+
+
+def storage_key(user_id, category):
+    """(user, category) as the file names spell them"""
+    return str(user_id), str(category).replace(' ', '_')
+
+
+def parse_filename(name):
+    """(prefix, storage_key) of a (user, category) file name, or None"""
+    for prefix, ext in KEY_FILES:
+        if name.startswith(f'{prefix}_') and name.endswith(f'.{ext}'):
+            user_id, sep, category = name[len(prefix) + 1:-len(ext) - 1].partition('_')
+            if sep and user_id and category:
+                return prefix, (user_id, category)
+    return None
+
+
+class ModelStorage:
+    """Atomic writes, versions, last-use tracking and compaction of a model directory.
+
+    on_remove(user_id, category, deleted) is called for every key whose
+    files compaction removed: deleted is True for keys that no longer
+    exist, False for keys evicted to meet the budgets. record_keys()
+    returns the keys of models and states kept outside files, so keys that
+    no longer exist are found there too, and record_models() the
+    {(user_id, category): saved time} of the models served from records, so
+    the budgets and eviction cover them. legacy_dir, None by default, is a
+    directory outside model_dir whose *.joblib files compaction deletes.
+    """
+
+    def __init__(self, model_dir=None, keep_versions=KEEP_VERSIONS, max_bytes=MAX_BYTES, max_models=MAX_MODELS,
+                 min_free_bytes=MIN_FREE_BYTES, legacy_dir=None, on_remove=None, record_keys=None,
+                 record_models=None):
+        self.model_dir = model_dir or MODEL_DIR
+        self.keep_versions = keep_versions
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.min_free_bytes = min_free_bytes
+        self.legacy_dir = legacy_dir
+        self.on_remove = on_remove
+        self.record_keys = record_keys
+        self.record_models = record_models
+        self.last_report = None
+        self._touched = {}
+        self._lock = threading.Lock()
+        self._thread_pid = None
+
+    # Writes and versions
+
+    def write(self, path, dump, versioned=False):
+        """Write a file atomically: dump(temporary path), then rename it over path.
+
+        With versioned, the file it replaces is kept as a version.
+        """
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            dump(tmp_path)
+            if versioned and self.keep_versions > 0:
+                self._keep_version(path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if versioned:
+            self._prune_versions(self._version_dir(path), self.keep_versions)
+
+    def _version_dir(self, path):
+        return os.path.join(self.model_dir, VERSIONS_DIR, os.path.basename(path))
+
+    def _keep_version(self, path):
+        try:
+            version = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        directory = self._version_dir(path)
+        os.makedirs(directory, exist_ok=True)
+        target = os.path.join(directory, str(version))
+        try:
+            # A second name for the old file; the rename below only replaces the first
+            os.link(path, target)
+        except FileExistsError:
+            pass
+        except OSError:
+            shutil.copy2(path, target)
+
+    def _prune_versions(self, directory, keep):
+        """Remove all but the newest keep versions in a version directory"""
+        try:
+            names = sorted(os.listdir(directory), key=int)
+        except (FileNotFoundError, ValueError):
+            return
+        for name in names[:max(0, len(names) - keep)]:
+            self._remove(os.path.join(directory, name))
+        if keep == 0:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def versions(self, path):
+        """[{version, bytes, saved_at}] of the versions kept of a file, newest first"""
+        directory = self._version_dir(path)
+        try:
+            names = sorted(os.listdir(directory), key=int, reverse=True)
+        except (FileNotFoundError, ValueError):
+            return []
+        return [{
+            'version': int(name),
+            'bytes': os.path.getsize(os.path.join(directory, name)),
+            'saved_at': int(name) / 1e9
+        } for name in names]
+
+    def restore(self, path, version):
+        """Make a kept version the current file again (the current one becomes a version)"""
+        source = os.path.join(self._version_dir(path), str(int(version)))
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"No version {version} of {os.path.basename(path)}")
+        self.write(path, lambda tmp_path: shutil.copyfile(source, tmp_path), versioned=True)
+
+    # Last use
+
+    def touch(self, user_id, category):
+        """Note that a key's model was served, for eviction by last use"""
+        key = storage_key(user_id, category)
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(key, 0) < TOUCH_INTERVAL:
+                return
+            self._touched[key] = now
+        for prefix, ext in KEY_FILES:
+            path = os.path.join(self.model_dir, model_filename(key[0], key[1], prefix, ext))
+            try:
+                # Access time only: the model cache and reloads go by the modification time
+                os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+            except OSError:
+                pass
+
+    # Compaction
+
+    def _scan(self):
+        """(files by key, other files, temporary files) of the model directory"""
+        keys, other, temporary = {}, [], []
+        with os.scandir(self.model_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    temporary.append((entry.path, st.st_size, st.st_mtime))
+                    continue
+                parsed = parse_filename(entry.name)
+                if parsed is None:
+                    other.append((entry.path, st.st_size))
+                    continue
+                prefix, key = parsed
+                keys.setdefault(key, {})[prefix] = (entry.path, st.st_size, max(st.st_atime, st.st_mtime))
+        return keys, other, temporary
+
+    def _last_use(self, keys, skip=()):
+        """{key: last use} of every served model: the keys with files and the models kept as records"""
+        last_use = {key: max(use for _, _, use in files.values()) for key, files in keys.items()}
+        if self.record_models is not None:
+            for (user_id, category), saved_at in self.record_models().items():
+                key = storage_key(user_id, category)
+                if key not in skip:
+                    last_use[key] = max(last_use.get(key, 0), saved_at)
+        return last_use
+
+    def _scan_versions(self):
+        """{file name: [(version path, bytes)] oldest first} of the version directories"""
+        versions = {}
+        root = os.path.join(self.model_dir, VERSIONS_DIR)
+        if not os.path.isdir(root):
+            return versions
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                with os.scandir(entry.path) as files:
+                    kept = [(f.path, f.stat().st_size) for f in files if f.is_file() and f.name.isdigit()]
+                versions[entry.name] = sorted(kept, key=lambda item: int(os.path.basename(item[0])))
+        return versions
+
+    def _remove(self, path):
+        """Delete a file; the bytes it held (0 if it was already gone)"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def usage(self):
+        """Files, bytes and budgets of the model directory"""
+        keys, other, temporary = self._scan()
+        versions = self._scan_versions()
+        key_bytes = sum(size for files in keys.values() for _, size, _ in files.values())
+        version_bytes = sum(size for kept in versions.values() for _, size in kept)
+        return {
+            'models': len(self._last_use(keys)),
+            'model_bytes': key_bytes,
+            'versions': sum(len(kept) for kept in versions.values()),
+            'version_bytes': version_bytes,
+            'other_bytes': sum(size for _, size in other),
+            'temporary_files': len(temporary),
+            'free_bytes': shutil.disk_usage(self.model_dir).free,
+            'budgets': {
+                'max_bytes': self.max_bytes,
+                'max_models': self.max_models,
+                'min_free_bytes': self.min_free_bytes,
+                'keep_versions': self.keep_versions
+            },
+            'last_compaction': self.last_report
+        }
+
+    def compact(self, live_keys=None, dry_run=False):
+        """One compaction pass; a report of what was removed, or None if another process is compacting.
+
+        live_keys, the (user_id, category) pairs that still exist, lets it
+        remove the models of the ones that do not; without it only files
+        that nothing can load are removed before the budgets are applied.
+        With dry_run nothing is removed.
+        """
+        lock = self._try_lock()
+        if lock is False:
+            return None
+        try:
+            return self._compact(live_keys, dry_run)
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def _try_lock(self):
+        if fcntl is None:
+            return None
+        f = open(os.path.join(self.model_dir, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        return f
+
+    def _compact(self, live_keys, dry_run):
+        start = time.time()
+        removed = dict.fromkeys(('temporary', 'orphan_compiled', 'deleted_keys', 'versions', 'legacy',
+                                  'evicted_keys'), 0)
+        reclaimed = {'bytes': 0}
+        keys, _, temporary = self._scan()
+        versions = self._scan_versions()
+        dropped = set()
+
+        def remove(path, size):
+            if not dry_run:
+                size = self._remove(path)
+            reclaimed['bytes'] += size
+
+        def drop_key(key, deleted):
+            dropped.add(key)
+            for path, size, _ in keys.pop(key, {}).values():
+                remove(path, size)
+            for prefix, ext in KEY_FILES:
+                for path, size in versions.pop(model_filename(key[0], key[1], prefix, ext), []):
+                    remove(path, size)
+            if not dry_run and self.on_remove is not None:
+                self.on_remove(key[0], key[1], deleted)
+
+        # Writes that died before their rename
+        for path, size, mtime in temporary:
+            if start - mtime > TMP_MAX_AGE:
+                remove(path, size)
+                removed['temporary'] += 1
+
+        # Compiled arrays are only loaded next to their pipeline
+        for key, files in list(keys.items()):
+            if 'compiled' in files and 'model' not in files:
+                remove(*files.pop('compiled')[:2])
+                removed['orphan_compiled'] += 1
+                if not files:
+                    del keys[key]
+
+        # Keys of deleted users and categories
+        if live_keys is not None:
+            live = set(storage_key(user_id, category) for user_id, category in live_keys)
+            known = set(keys)
+            if self.record_keys is not None:
+                known.update(storage_key(user_id, category) for user_id, category in self.record_keys())
+            for key in sorted(known - live):
+                drop_key(key, deleted=True)
+                removed['deleted_keys'] += 1
+
+        # Versions of files that are gone, and beyond the number kept
+        for name in list(versions):
+            if not os.path.exists(os.path.join(self.model_dir, name)):
+                for path, size in versions.pop(name):
+                    remove(path, size)
+                    removed['versions'] += 1
+                if not dry_run:
+                    shutil.rmtree(self._version_dir(name), ignore_errors=True)
+            elif len(versions[name]) > self.keep_versions:
+                extra = len(versions[name]) - self.keep_versions
+                for path, size in versions[name][:extra]:
+                    remove(path, size)
+                    removed['versions'] += 1
+                versions[name] = versions[name][extra:]
+
+        # Pipelines of the first version of the service
+        if self.legacy_dir and os.path.isdir(self.legacy_dir):
+            with os.scandir(self.legacy_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith('.joblib'):
+                        remove(entry.path, entry.stat().st_size)
+                        removed['legacy'] += 1
+
+        # Budgets: the oldest versions go first, then the least recently used keys
+        stored = {'bytes': sum(size for files in keys.values() for _, size, _ in files.values()) +
+                  sum(size for kept in versions.values() for _, size in kept)}
+        # Removals so far are already free, unless this is a dry run
+        free = shutil.disk_usage(self.model_dir).free + (reclaimed['bytes'] if dry_run else 0)
+        freed_before = reclaimed['bytes']
+        last_use = self._last_use(keys, skip=dropped)
+
+        def over_budget(count_models=True):
+            return bool(self.max_bytes and stored['bytes'] > self.max_bytes
+                        or count_models and self.max_models and len(last_use) > self.max_models
+                        or self.min_free_bytes and free + reclaimed['bytes'] - freed_before < self.min_free_bytes)
+
+        oldest_versions = sorted(((int(os.path.basename(path)), path, size)
+                                  for kept in versions.values() for path, size in kept), reverse=True)
+        while oldest_versions and over_budget(count_models=False):
+            _, path, size = oldest_versions.pop()
+            remove(path, size)
+            stored['bytes'] -= size
+            removed['versions'] += 1
+        versions = {}  # every version left belongs to a key, and goes with it
+        by_last_use = sorted(last_use, key=last_use.get, reverse=True)
+        while by_last_use and over_budget():
+            key = by_last_use.pop()
+            del last_use[key]
+            before = reclaimed['bytes']
+            drop_key(key, deleted=False)
+            stored['bytes'] -= reclaimed['bytes'] - before
+            removed['evicted_keys'] += 1
+
+        with self._lock:
+            self._touched = {key: t for key, t in self._touched.items() if start - t < TOUCH_INTERVAL}
+
+        report = {
+            'dry_run': dry_run,
+            'removed': removed,
+            'reclaimed_bytes': reclaimed['bytes'],
+            'models': len(last_use),
+            'seconds': round(time.time() - start, 4),
+            'compacted_at': start
+        }
+        if not dry_run:
+            self.last_report = report
+            with open(os.path.join(self.model_dir, COMPACTED_FILE), 'w') as f:
+                json.dump(report, f)
+        logger.info(f"Compacted {self.model_dir}: removed {removed}, "
+                    f"reclaimed {reclaimed['bytes']} bytes in {report['seconds']}s")
+        return report
+
+    def start_compaction(self, interval=COMPACT_INTERVAL):
+        """Compact every interval seconds in a daemon thread of this process (once per process).
+
+        Every worker process may run one; a worker skips its pass when
+        another one compacted less than interval seconds ago.
+        """
+        if interval <= 0 or self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._compaction_loop, args=(interval,), name='storage-compaction',
+                         daemon=True).start()
+
+    def _compaction_loop(self, interval):
+        marker = os.path.join(self.model_dir, COMPACTED_FILE)
+        while True:
+            try:
+                last = os.path.getmtime(marker) if os.path.exists(marker) else 0
+                wait = last + interval - time.time()
+                if wait <= 0:
+                    self.compact()
+                    wait = interval
+            except Exception as e:
+                logger.error(f"Storage compaction failed: {str(e)}", exc_info=True)
+                wait = interval
+            time.sleep(wait)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect the saved model directory and restore model versions')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('usage', help='files, bytes and budgets of the model directory')
+    compact = commands.add_parser('compact', help='one compaction pass with the configured budgets')
+    compact.add_argument('--dry-run', action='store_true', help='report what would be removed')
+    compact.add_argument('--legacy-dir', default=LEGACY_MODEL_DIR,
+                         help='also delete the *.joblib files of the first version of the service there')
+    versions = commands.add_parser('versions', help='versions kept of a model file')
+    versions.add_argument('file')
+    restore = commands.add_parser('restore', help='make a kept version the current model file')
+    restore.add_argument('file')
+    restore.add_argument('version', type=int)
+    args = parser.parse_args()
+
+    storage = ModelStorage(args.model_dir, legacy_dir=getattr(args, 'legacy_dir', None))
+    path = os.path.join(args.model_dir, os.path.basename(getattr(args, 'file', '')))
+    if args.command == 'usage':
+        print(json.dumps(storage.usage(), indent=2))
+    elif args.command == 'compact':
+        report = storage.compact(dry_run=args.dry_run)
+        if report is None:
+            sys.exit("Another process is compacting the model directory")
+        print(json.dumps(report, indent=2))
+    elif args.command == 'versions':
+        print(json.dumps(storage.versions(path), indent=2))
+    else:
+        try:
+            storage.restore(path, args.version)
+        except FileNotFoundError as e:
+            sys.exit(str(e))
+        print(f"Restored version {args.version} of {os.path.basename(path)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+import logging
+import time
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import Ridge, LinearRegression
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
+from sklearn.base import clone
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+
+from ml.online import OnlineLinearModel, LINEAR_MODEL_TYPES
+from ml.compiled import compile_model
+from ml.metrics import StageTimer
+from ml.selection import FOLDS, select_model
+from ml.ingest import SortedHistory
+from ml.calibration import conformal_offsets
+from ml.fingerprint import history_fingerprint
+from ml.state_store import FeatureState
+from ml.global_model import GLOBAL_FEATURES, OFFSET_SHRINKAGE, GlobalCategoryModel, user_scale, global_feature_rows
+from ml.monthly import MONTHLY_FEATURES, GRANULARITIES, MonthlyForecaster, monthly_totals, build_monthly_features
+from ml.features import (DEFAULT_FEATURES, NEXT_PERIOD_DAYS, sorted_series, build_features,
+                         next_period_features, feature_matrix, feature_vector, next_month_label)
+
+logger = logging.getLogger(__name__)
+
+
+def train_expense_model(expenses, granularity='transaction', previous_selection=None):
+    """Fit the best model for one (user, category) expense history.
+
+    expenses is a list of {amount, date} rows or a SortedHistory (what the
+    NDJSON /train body is folded into). granularity 'transaction' fits
+    per-expense amounts; 'month' fits calendar-month totals instead (see
+    train_monthly_model). previous_selection, the hyperparameters saved by a
+    previous training, skips model selection and refits only that model (see
+    fit_best_model).
+    Returns (result, artifacts) where result is the /train response payload
+    and artifacts holds what should be saved: 'model', the fitted pipeline (or
+    None when there was too little data and the result is a plain average),
+    'compiled', its pure NumPy equivalent (None if it has none), 'online',
+    the incrementally updatable model seeded for /observe, 'fingerprint'
+    and 'hyperparameters', what the next /train compares with and reuses
+    the selection of, 'state', the FeatureState /predict serves the history's features
+    from, and 'timings', the seconds spent per (stage, model_type).
+    Runs in training worker processes, so it has no side effects: saving the
+    artifacts is left to the caller.
+    """
+    start_time = time.time()
+    timer = StageTimer()
+    
+    if isinstance(expenses, SortedHistory):
+        dates, amounts = expenses.dates, expenses.amounts
+    else:
+        dates, amounts = sorted_series(expenses)
+    timer.lap('parse')
+    next_date = dates[-1] + np.timedelta64(NEXT_PERIOD_DAYS, 'D')
+    
+    logger.info(f"Data loaded: {len(amounts)} rows")
+    
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}, expected one of {GRANULARITIES}")
+    fingerprint = history_fingerprint(dates, amounts, {'granularity': granularity})
+    timer.lap('fingerprint')
+    state = FeatureState.from_history(dates, amounts)
+    timer.lap('state')
+    if granularity == 'month':
+        result, artifacts = train_monthly_model(dates, amounts, timer, start_time, previous_selection)
+        artifacts['fingerprint'] = fingerprint
+        artifacts['state'] = state
+        return result, artifacts
+    
+    # Check if we have enough data
+    if len(amounts) < 5:
+        logger.warning("Not enough data for ML model")
+        result = {
+            'prediction': round(float(amounts.mean()), 2),
+            'accuracy': 50.0,  # Low accuracy due to limited data
+            'max_amount': float(amounts.max()),
+            'model_type': 'average',
+            'next_month': next_month_label(next_date),
+            'features_used': ['amount'],
+            'error': 'Not enough data for advanced models',
+            'training_time': round(time.time() - start_time, 2)
+        }
+        online = OnlineLinearModel.from_history(dates, amounts)
+        timer.lap('online_fit')
+        return result, {'model': None, 'compiled': None, 'online': online, 'fingerprint': fingerprint,
+                        'hyperparameters': None, 'state': state, 'timings': timer.stages}
+    
+    logger.info("Extracting features")
+    columns = build_features(dates, amounts)
+    # Rows whose lag features are complete (all but the first three)
+    valid = columns['valid']
+    timer.lap('features')
+    
+    if valid.sum() < 3:
+        logger.warning("Not enough data after feature engineering")
+        # Not enough data after creating lag features
+        result = {
+            'prediction': round(float(amounts.mean()), 2),
+            'accuracy': 60.0,
+            'max_amount': float(amounts.max()),
+            'model_type': 'average_with_trend',
+            'next_month': next_month_label(next_date),
+            'features_used': ['amount', 'trend'],
+            'error': 'Limited data after feature engineering',
+            'training_time': round(time.time() - start_time, 2)
+        }
+        online = OnlineLinearModel.from_history(dates, amounts)
+        timer.lap('online_fit')
+        return result, {'model': None, 'compiled': None, 'online': online, 'fingerprint': fingerprint,
+                        'hyperparameters': None, 'state': state, 'timings': timer.stages}
+    
+    # Features to use
+    features = list(DEFAULT_FEATURES)
+    logger.info(f"Using features: {features}")
+    
+    # Prepare data for modeling (named columns so the pipeline records feature names)
+    X = pd.DataFrame(feature_matrix(columns, features)[valid], columns=features)
+    y = amounts[valid]
+    timer.lap('dataframe')
+    
+    best_model, best_model_name, accuracy, metrics = fit_best_model(X, y, timer, previous_selection)
+    
+    # Create next month features
+    next_features = next_period_features(dates, amounts)
+    pred_df = pd.DataFrame([feature_vector(next_features, features)], columns=features)
+    
+    # Make prediction
+    logger.info("Making prediction")
+    prediction = best_model.predict(pred_df)[0]
+    timer.lap('predict', best_model_name)
+    
+    # Ensure prediction is reasonable (not negative, not extreme)
+    min_amount = next_features['min']
+    max_amount = next_features['max']
+    avg_amount = next_features['mean']
+    
+    # If prediction seems unreasonable, adjust it
+    if prediction < 0 or prediction > max_amount * 2:
+        logger.warning(f"Prediction {prediction} seems unreasonable, adjusting")
+        # Use a weighted average of prediction and recent values
+        adjusted_prediction = 0.5 * avg_amount + 0.5 * next_features['rolling_mean_3']
+        prediction = max(min_amount * 0.5, min(adjusted_prediction, max_amount * 1.5))
+        logger.info(f"Adjusted prediction to {prediction}")
+
+    # Calculate confidence based on model performance and data consistency
+    confidence_score = min(100, max(0, accuracy))
+    
+    # Format next month
+    next_month = next_month_label(next_features['next_date'])
+    
+    # Return results
+    result = {
+        'prediction': round(float(prediction), 2),
+        'accuracy': round(float(confidence_score), 2),
+        'max_amount': float(max_amount),
+        'model_type': best_model_name,
+        'next_month': next_month,
+        'features_used': features,
+        'metrics': metrics,
+        'training_time': round(time.time() - start_time, 2)
+    }
+    
+    # Sufficient statistics for /observe; they serve predictions only when the
+    # chosen model is from the linear family they reproduce
+    online = OnlineLinearModel.from_history(dates, amounts, alpha=LINEAR_MODEL_TYPES.get(best_model_name, 1.0))
+    online.serving = best_model_name in LINEAR_MODEL_TYPES
+    timer.lap('online_fit')
+    
+    # Scaler folded into linear coefficients, or trees flattened to node arrays;
+    # only used if it reproduces the pipeline on the training rows
+    compiled = compile_model(best_model, X)
+    timer.lap('compile', best_model_name)
+    
+    logger.info(f"Training complete in {round(time.time() - start_time, 2)} seconds")
+    return result, {'model': best_model, 'compiled': compiled, 'online': online, 'fingerprint': fingerprint,
+                    'hyperparameters': model_hyperparameters(best_model, best_model_name), 'state': state,
+                    'timings': timer.stages}
+
+
+def train_monthly_model(dates, amounts, timer, start_time, previous_selection=None):
+    """Fit the best model on the calendar-month totals of a date-sorted history.
+
+    Fitting costs O(months) rather than O(expenses). The prediction is the
+    total of the calendar month after the last expense; the saved model is a
+    MonthlyForecaster, which carries the trailing months it forecasts from.
+    The last month counts as observed even if it is still in progress.
+    """
+    totals = monthly_totals(dates, amounts)
+    columns = build_monthly_features(totals)
+    # Months with three months of history before them
+    valid = columns['valid']
+    sums = totals['sum']
+    next_month = next_month_label(totals['month'][-1] + 1)
+    timer.lap('features')
+    
+    logger.info(f"Aggregated {len(amounts)} rows into {len(sums)} months")
+    
+    # The transaction-level online model only seeds /observe; it never
+    # replaces a monthly model
+    online = OnlineLinearModel.from_history(dates, amounts)
+    online.serving = False
+    timer.lap('online_fit')
+    
+    if valid.sum() < 3:
+        logger.warning("Not enough months for a monthly model")
+        result = {
+            'prediction': round(float(sums.mean()), 2),
+            'accuracy': 50.0,
+            'max_amount': float(sums.max()),
+            'model_type': 'monthly_average',
+            'next_month': next_month,
+            'features_used': ['monthly_total'],
+            'error': 'Not enough months for a monthly model',
+            'granularity': 'month',
+            'months': len(sums),
+            'training_time': round(time.time() - start_time, 2)
+        }
+        return result, {'model': None, 'compiled': None, 'online': online, 'hyperparameters': None,
+                        'timings': timer.stages}
+    
+    features = list(MONTHLY_FEATURES)
+    X = pd.DataFrame(feature_matrix(columns, features)[valid], columns=features)
+    y = sums[valid]
+    timer.lap('dataframe')
+    
+    best_model, best_model_name, accuracy, metrics = fit_best_model(X, y, timer, previous_selection)
+    
+    # The forecaster evaluates the compiled model when there is one, so
+    # loading it does not need sklearn
+    compiled = compile_model(best_model, X)
+    timer.lap('compile', best_model_name)
+    forecaster = MonthlyForecaster(compiled if compiled is not None else best_model, totals, dates[-1])
+    prediction, _ = forecaster.forecast()
+    timer.lap('predict', best_model_name)
+    
+    result = {
+        'prediction': round(float(prediction), 2),
+        'accuracy': round(float(min(100, max(0, accuracy))), 2),
+        'max_amount': float(sums.max()),
+        'model_type': f'monthly_{best_model_name}',
+        'next_month': next_month,
+        'features_used': features,
+        'metrics': metrics,
+        'granularity': 'month',
+        'months': len(sums),
+        'training_time': round(time.time() - start_time, 2)
+    }
+    
+    logger.info(f"Monthly training complete in {round(time.time() - start_time, 2)} seconds")
+    return result, {'model': forecaster, 'compiled': None, 'online': online,
+                    'hyperparameters': model_hyperparameters(best_model, best_model_name),
+                    'timings': timer.stages}
+
+
+def train_category_model(history, category):
+    """Fit one model for a category on the histories of all its users.
+
+    history is a GroupedHistory. Each user's amounts are divided by their
+    historical mean, so the model learns the shape of spending shared by the
+    category; per-user offsets are the (shrunk) mean residuals of each
+    user's rows. Returns (result, artifacts) like train_expense_model, with
+    a GlobalCategoryModel as the model.
+    """
+    start_time = time.time()
+    timer = StageTimer()
+    
+    counts = np.diff(history.offsets)
+    user_ids = [u for u, n in zip(history.user_ids, counts) if n > 0]
+    counts = counts[counts > 0]
+    dates, amounts = history.dates, history.amounts
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    logger.info(f"Data loaded: {len(amounts)} rows from {len(user_ids)} users")
+    
+    # Per-user mean and spread over the whole history
+    mean = np.add.reduceat(amounts, starts) / counts if len(counts) else np.zeros(0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(np.add.reduceat((amounts - np.repeat(mean, counts)) ** 2, starts) / (counts - 1)) \
+            if len(counts) else np.zeros(0)
+    means, scales = user_scale(mean, std)
+    
+    # Lags of the three previous expenses of the same user (the next-period
+    # features /predict builds from the recent expenses)
+    position = np.arange(len(amounts)) - np.repeat(starts, counts)
+    prev_amount = np.full(len(amounts), np.nan)
+    prev_amount[1:] = amounts[:-1]
+    cumulative = np.concatenate(([0.0], np.cumsum(amounts)))
+    rolling_mean_3 = np.full(len(amounts), np.nan)
+    rolling_mean_3[3:] = (cumulative[3:-1] - cumulative[:-4]) / 3
+    valid = position >= 3
+    
+    row_means = np.repeat(means, counts)
+    X_all = global_feature_rows(dates, prev_amount, rolling_mean_3, row_means, np.repeat(scales, counts))[valid]
+    y = amounts[valid] / row_means[valid]
+    timer.lap('features')
+    
+    if len(y) < 10:
+        logger.warning("Not enough data for a category model")
+        result = {
+            'category': category,
+            'users': len(user_ids),
+            'rows': len(amounts),
+            'error': 'Not enough data across users for a category model',
+            'training_time': round(time.time() - start_time, 2)
+        }
+        return result, {'model': None, 'compiled': None, 'online': None, 'timings': timer.stages,
+                        'category_model': True}
+    
+    features = list(GLOBAL_FEATURES)
+    X = pd.DataFrame(X_all, columns=features)
+    timer.lap('dataframe')
+    
+    # Rows are grouped by user; validation puts them in date order
+    best_model, best_model_name, accuracy, metrics = fit_best_model(X, y, timer, dates=dates[valid])
+    compiled = compile_model(best_model, X)
+    timer.lap('compile', best_model_name)
+    
+    # Shrunk mean residual (in amounts) of every user's rows
+    model = GlobalCategoryModel(category, compiled if compiled is not None else best_model,
+                                user_ids, means, scales, np.zeros(len(user_ids)))
+    residuals = (y - model.predict_ratio(X_all)) * row_means[valid]
+    owner = np.repeat(np.arange(len(user_ids)), counts)[valid]
+    totals = np.bincount(owner, weights=residuals, minlength=len(user_ids))
+    fitted_rows = np.bincount(owner, minlength=len(user_ids))
+    model = GlobalCategoryModel(category, model.model, user_ids, means, scales,
+                                totals / (fitted_rows + OFFSET_SHRINKAGE), calibration=metrics.get('interval'))
+    timer.lap('offsets', best_model_name)
+    
+    result = {
+        'category': category,
+        'users': len(user_ids),
+        'rows': len(amounts),
+        'model_type': f'global_{best_model_name}',
+        'accuracy': round(float(min(100, max(0, accuracy))), 2),
+        'features_used': features,
+        'metrics': metrics,
+        'training_time': round(time.time() - start_time, 2)
+    }
+    
+    logger.info(f"Category model for {category} trained in {round(time.time() - start_time, 2)} seconds")
+    return result, {'model': model, 'compiled': None, 'online': None, 'timings': timer.stages,
+                    'category_model': True}
+
+
+# Candidates abandoned during selection once the cheaper ones score better
+EXPENSIVE_MODELS = ('gradient_boosting',)
+
+
+def candidate_models():
+    """Estimators fit_best_model chooses from, by model name, cheapest first"""
+    return {
+        'linear': LinearRegression(),
+        'ridge': Ridge(alpha=1.0),
+        'gradient_boosting': GradientBoostingRegressor(n_estimators=50, max_depth=3)
+    }
+
+
+def model_hyperparameters(pipeline, name):
+    """{model_type, params} of a fitted pipeline's estimator, as saved to skip the next reselection"""
+    params = pipeline.named_steps['model'].get_params()
+    return {
+        'model_type': name,
+        'params': {k: v for k, v in params.items() if v is None or isinstance(v, (bool, int, float, str))}
+    }
+
+
+def scaled_pipeline(model):
+    """An unfitted scaler + model pipeline around a copy of an estimator"""
+    return Pipeline([
+        ('scaler', StandardScaler()),
+        ('model', clone(model))
+    ])
+
+
+def held_out_r2(actual, predicted):
+    """R^2 of out-of-sample predictions; 0 when the actual amounts do not vary"""
+    total = np.sum((actual - actual.mean()) ** 2)
+    if total == 0:
+        return 0.0
+    return 1 - np.sum((actual - predicted) ** 2) / total
+
+
+def fit_best_model(X, y, timer, previous_selection=None, dates=None):
+    """Fit the candidate pipelines on a feature DataFrame and keep the best.
+
+    Candidates are compared by rolling-origin validation (see ml.selection)
+    over the rows in time order: as given, or sorted by dates when the rows
+    are not. The winner is then refitted on every row.
+    With previous_selection (model_hyperparameters of an earlier fit on a
+    prefix of the same history) there is no selection: only that candidate
+    is refitted from scratch, with the same hyperparameters, and scored on
+    the most recent fold alone.
+    Returns (model, model_name, accuracy, metrics); metrics are scored on
+    the winner's test folds when there are enough rows, 'interval' holds
+    the conformal offsets of its residuals there, and 'selection' the fold
+    scores and seconds of every candidate.
+    """
+    if dates is not None:
+        order = np.argsort(dates, kind='stable')
+        X_ordered, y_ordered = X.iloc[order], y[order]
+    else:
+        X_ordered, y_ordered = X, y
+    
+    logger.info("Training models")
+    # Choose model based on data size
+    if len(y) >= 10:
+        # Try different models, or only the one chosen last time
+        models = candidate_models()
+        folds = FOLDS
+        if previous_selection is not None and previous_selection.get('model_type') in models:
+            name = previous_selection['model_type']
+            models = {name: models[name].set_params(**previous_selection.get('params', {}))}
+            folds = 1
+            logger.info(f"Skipping reselection: refitting the previous {name} model")
+        
+        candidates = {name: partial(scaled_pipeline, model) for name, model in models.items()}
+        best_model_name, selection, predictions = select_model(
+            candidates, X_ordered, y_ordered, expensive=EXPENSIVE_MODELS, folds=folds)
+        for name, info in selection['candidates'].items():
+            timer.add('select', info['seconds'], name)
+        timer.skip()
+        if best_model_name is None:
+            # No fold finished within the budget: fall back to the first (cheapest) candidate
+            best_model_name = next(iter(models))
+        best_model = candidates[best_model_name]()
+        held_out = predictions.get(best_model_name)
+        
+        # If all models perform poorly, use a simpler approach
+        if held_out is not None and held_out_r2(*held_out) < 0:
+            logger.warning("All models performed poorly, using robust linear model")
+            best_model = scaled_pipeline(LinearRegression())
+            best_model_name = 'robust_linear'
+            held_out = predictions.get('linear')
+    else:
+        logger.info("Using simple linear model due to limited data")
+        # For small datasets, use a simple model, scored on its last fifth
+        best_model_name = 'simple_linear'
+        candidates = {best_model_name: partial(scaled_pipeline, LinearRegression())}
+        _, selection, predictions = select_model(candidates, X_ordered, y_ordered, folds=1,
+                                                 test_rows=max(1, len(y) // 5), min_train=3)
+        timer.add('select', selection['candidates'][best_model_name]['seconds'], best_model_name)
+        timer.skip()
+        best_model = candidates[best_model_name]()
+        held_out = predictions.get(best_model_name)
+    
+    best_model.fit(X, y)
+    timer.lap('fit', best_model_name)
+    
+    # Evaluate model
+    logger.info("Evaluating model")
+    train_pred = best_model.predict(X)
+    mae_train = mean_absolute_error(y, train_pred)
+    
+    has_test_data = held_out is not None
+    if has_test_data:
+        y_test, test_pred = held_out
+        mae_test = mean_absolute_error(y_test, test_pred)
+        rmse_test = np.sqrt(mean_squared_error(y_test, test_pred))
+        r2 = held_out_r2(y_test, test_pred)
+        accuracy = max(0, min(100, 100 * (1 - mae_test / y_test.mean())))
+    else:
+        # Too few rows for a fold: in-sample scores
+        rmse_test = np.sqrt(mean_squared_error(y, train_pred))
+        r2 = r2_score(y, train_pred)
+        accuracy = max(0, min(100, 100 * (1 - mae_train / y.mean())))
+    timer.lap('score', best_model_name)
+    
+    selection['chosen'] = best_model_name
+    metrics = {
+        'mae_train': round(float(mae_train), 2),
+        'mae_test': round(float(mae_test), 2) if has_test_data else None,
+        'rmse_test': round(float(rmse_test), 2) if has_test_data else None,
+        'r2': round(float(r2), 4),
+        # Offsets of calibrated prediction intervals (see ml.calibration)
+        'interval': conformal_offsets(*held_out) if has_test_data else None,
+        'selection': selection
+    }
+    
+    # Filter out None values
+    metrics = {k: v for k, v in metrics.items() if v is not None}
+    return best_model, best_model_name, accuracy, metrics
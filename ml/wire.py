@@ -0,0 +1,136 @@
+"""Binary columnar framing for expense payloads.
+
+A frame is a small JSON header followed by raw little-endian column
+buffers, so expense amounts and dates travel as float64 and int64 arrays
+and are decoded with np.frombuffer instead of being parsed row by row:
+
+    8 bytes   magic b'EXPCOL1\\0'
+    4 bytes   header length (uint32 LE), 4 bytes reserved
+    header    UTF-8 JSON, padded with spaces to a multiple of 8 bytes
+    columns   one buffer per entry of header['columns'] ([name, dtype,
+              length]), in order, each padded to a multiple of 8 bytes
+
+Expense frames carry an 'amount' (<f8) and a 'date' (<i8, days since
+1970-01-01) column. The header holds the request's other fields; a batch
+header lists its groups with the number of rows each owns, in column order.
+"""
+import json
+import struct
+
+import numpy as np
+
+CONTENT_TYPE = 'application/vnd.expense-columns'
+MAGIC = b'EXPCOL1\0'
+PREFIX = struct.Struct('<8sII')
+ALIGN = 8
+
+
+class FrameError(ValueError):
+    """Raised for a body that is not a well-formed frame"""
+
+
+def _padding(size):
+    return -size % ALIGN
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+def encode(header, columns):
+    """Frame a JSON-serializable header and a dict of 1-D arrays"""
+    arrays = [(name, np.ascontiguousarray(values)) for name, values in columns.items()]
+    for name, values in arrays:
+        if values.dtype.byteorder == '>':
+            raise FrameError(f"Column {name} is big-endian")
+    header = dict(header, columns=[[name, values.dtype.newbyteorder('<').str, len(values)]
+                                   for name, values in arrays])
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * _padding(len(header_bytes))
+    parts = [PREFIX.pack(MAGIC, len(header_bytes), 0), header_bytes]
+    for _, values in arrays:
+        data = values.tobytes()
+        parts.append(data + b'\0' * _padding(len(data)))
+    return b''.join(parts)
+
+
+def decode(body):
+    """(header, {name: array}) of a frame; the arrays are read-only views of body"""
+    if len(body) < PREFIX.size:
+        raise FrameError("Frame is shorter than its prefix")
+    magic, header_size, _ = PREFIX.unpack_from(body)
+    if magic != MAGIC:
+        raise FrameError("Not an expense column frame")
+    offset = PREFIX.size + header_size
+    if offset > len(body):
+        raise FrameError("Frame header is truncated")
+    try:
+        header = json.loads(bytes(body[PREFIX.size:offset]))
+    except ValueError as e:
+        raise FrameError(f"Invalid frame header: {str(e)}")
+    if not isinstance(header, dict) or not isinstance(header.get('columns'), list):
+        raise FrameError("Frame header has no list of columns")
+    columns = {}
+    for spec in header.pop('columns'):
+        if not isinstance(spec, list) or len(spec) != 3 or not isinstance(spec[0], str):
+            raise FrameError(f"Invalid column {spec!r}, expected [name, dtype, length]")
+        name, dtype, length = spec
+        if not _is_count(length):
+            raise FrameError(f"Column {name} has an invalid length {length!r}")
+        try:
+            dtype = np.dtype(dtype)
+        except (TypeError, ValueError):
+            raise FrameError(f"Column {name} has an invalid dtype {dtype!r}")
+        if dtype.hasobject:
+            raise FrameError(f"Column {name} has an object dtype")
+        size = dtype.itemsize * length
+        if offset + size > len(body):
+            raise FrameError(f"Column {name} is truncated")
+        columns[name] = np.frombuffer(body, dtype=dtype, count=length, offset=offset)
+        offset += size + _padding(size)
+    return header, columns
+
+
+def encode_expenses(header, dates, amounts, groups=None):
+    """Frame expenses; groups, if given, is the header's list of {..., 'rows': n}"""
+    dates = np.asarray(dates, dtype='datetime64[D]').astype('<i8')
+    if groups is not None:
+        header = dict(header, groups=groups)
+    return encode(header, {'amount': np.asarray(amounts, dtype='<f8'), 'date': dates})
+
+
+def decode_expenses(body):
+    """Decode an expense frame into (header, offsets, dates, amounts).
+
+    Group i owns offsets[i]:offsets[i + 1] (a frame without 'groups' is one
+    group) and each group's rows are sorted by date like group_expenses
+    does. Rows that already arrive in order are returned as views of body.
+    """
+    header, columns = decode(body)
+    try:
+        amounts = columns['amount'].astype(np.float64, copy=False)
+        dates = columns['date'].astype(np.int64, copy=False).view('datetime64[D]')
+    except KeyError as e:
+        raise FrameError(f"Expense frame has no {str(e)} column")
+    except (TypeError, ValueError) as e:
+        raise FrameError(f"Expense frame column has the wrong type: {str(e)}")
+    if len(amounts) != len(dates):
+        raise FrameError("Expense frame columns differ in length")
+    groups = header.get('groups')
+    if groups is not None and not (isinstance(groups, list) and
+                                   all(isinstance(g, dict) and _is_count(g.get('rows', 0)) for g in groups)):
+        raise FrameError("Expense frame groups must be objects with a non-negative number of rows")
+    counts = np.array([g.get('rows', 0) for g in groups] if groups is not None else [len(amounts)],
+                      dtype=np.int64)
+    if counts.sum() != len(amounts):
+        raise FrameError("Group row counts do not add up to the column length")
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # Sort each group by date unless the whole frame is already in order
+    group_ids = np.repeat(np.arange(len(counts)), counts)
+    in_order = np.ones(len(dates), dtype=bool)
+    in_order[1:] = (dates[1:] >= dates[:-1]) | (group_ids[1:] != group_ids[:-1])
+    if not in_order.all():
+        order = np.lexsort((dates, group_ids))
+        dates, amounts = dates[order], amounts[order]
+    return header, offsets, dates, amounts
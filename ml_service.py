@@ -1,17 +1,36 @@
-from flask import Flask, request, jsonify
+import time
+# Cold-start time is measured from here, so it includes the imports below
+STARTED_AT = time.time()
+
+from flask import Flask, Response, request, jsonify, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 import numpy as np
-import pandas as pd
-from sklearn.linear_model import Ridge, LinearRegression
-from sklearn.ensemble import  GradientBoostingRegressor
-from sklearn.preprocessing import StandardScaler
-from sklearn.pipeline import Pipeline
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 import joblib
 import os
+import glob
 from datetime import datetime, timedelta
 import logging
-import time
+import threading
+
+from ml.storage import MODEL_DIR, LEGACY_MODEL_DIR, ModelStorage, model_path as saved_model_path, global_model_path
+from ml.model_cache import ModelCache
+from ml.registry import ModelRegistry
+from ml.jobs import TrainingJobQueue, QueueFullError, SUCCEEDED, FAILED, CANCELLED
+from ml.online import OutOfOrderError
+from ml.compiled import CompiledLinear, CompiledTrees, load_model_file
+from ml.metrics import MetricsRegistry, StageTimer
+from ml.result_cache import ResultCache, model_version
+from ml.ingest import ingest_ndjson, SortedHistory, GroupedHistory, DEFAULT_CHUNK_BYTES
+from ml.fingerprint import FingerprintStore, UNCHANGED, APPENDED
+from ml.state_store import FeatureState, FeatureStateStore, apply_states
+from ml.calibration import CalibrationStore, INTERVAL_LEVEL, CONFORMAL, SPREAD, interval_bounds
+from ml.anomaly import AnomalyStore
+from ml.horizon import parse_horizon, forecast_horizon, horizon_steps
+from ml.global_model import GlobalCategoryModel, GLOBAL_FEATURES, ALL_USERS, user_key
+from ml import wire
+from ml.monthly import MonthlyForecaster, MONTHLY_FEATURES, GRANULARITIES
+from ml.features import (DEFAULT_FEATURES, sorted_series, model_feature_names, next_month_label,
+                         group_expenses, grouped_next_period, feature_matrix, parse_amounts)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
@@ -20,275 +39,450 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# Directory for storing models
-MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saved_models')
 os.makedirs(MODEL_DIR, exist_ok=True)
 
+# Latency histograms and counters served by /metrics. Labels use the Flask
+# endpoint name (e.g. predict, predict_batch, train_model)
+metrics = MetricsRegistry()
+request_seconds = metrics.histogram('ml_request_seconds', 'Request latency in seconds', ['endpoint', 'status'])
+stage_seconds = metrics.histogram('ml_stage_seconds', 'Time spent in each stage of a request or training job',
+                                  ['endpoint', 'stage', 'model_type'])
+requests_total = metrics.counter('ml_requests_total', 'Requests handled', ['endpoint', 'status'])
+errors_total = metrics.counter('ml_errors_total', 'Requests answered with an error status or exception',
+                               ['endpoint', 'status'])
+predictions_total = metrics.counter('ml_predictions_total', 'Forecasts returned', ['endpoint', 'model_type'])
+expenses_scored_total = metrics.counter('ml_expenses_scored_total', 'Expenses scored for anomalies by whether '
+                                        'they were flagged', ['anomaly'])
+
+def request_timer():
+    """Stage timer of the current request (a throwaway one outside requests)"""
+    if has_request_context() and 'timer' in g:
+        return g.timer
+    return StageTimer()
+
+def observe_stages(endpoint, stages):
+    for (stage, model_type), seconds in stages.items():
+        stage_seconds.observe(seconds, endpoint, stage, model_type)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Charges JSON parsing and serialization to the parse_json/serialize stages"""
+
+    def loads(self, s, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().loads(s, **kwargs)
+        finally:
+            request_timer().add('parse_json', time.perf_counter() - start)
+
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            request_timer().add('serialize', time.perf_counter() - start)
+
+app.json = TimedJSONProvider(app)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timer = StageTimer()
+
+@app.before_request
+def start_storage_compaction():
+    # Started by the first request of each process: prefork workers must not inherit the thread
+    model_storage.start_compaction()
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.endpoint or 'unknown'
+    status = str(response.status_code)
+    request_seconds.observe(time.perf_counter() - g.request_start, endpoint, status)
+    requests_total.inc(endpoint, status)
+    if response.status_code >= 400:
+        errors_total.inc(endpoint, status)
+    observe_stages(endpoint, g.timer.stages)
+    return response
+
+@app.teardown_request
+def record_request_exception(exc):
+    # Unhandled exceptions skip after_request
+    if exc is not None:
+        errors_total.inc(request.endpoint or 'unknown', 'exception')
+
+# In-process cache of loaded models, sized through the environment
+model_cache = ModelCache(
+    max_entries=int(os.environ.get('ML_MODEL_CACHE_ENTRIES', 128)),
+    max_bytes=int(os.environ.get('ML_MODEL_CACHE_BYTES', 256 * 1024 * 1024)),
+    loader=load_model_file
+)
+
+# Linear-family models live as fixed-width records in one memory-mapped file
+model_registry = ModelRegistry()
+
+# Recent prediction results keyed by (model version, normalized expenses);
+# ML_RESULT_CACHE_DB names an optional SQLite file shared between processes
+result_cache = ResultCache(
+    max_entries=int(os.environ.get('ML_RESULT_CACHE_ENTRIES', 10000)),
+    ttl=float(os.environ.get('ML_RESULT_CACHE_TTL', 30 * 60)),
+    path=os.environ.get('ML_RESULT_CACHE_DB') or None
+)
+
+# Per-(user, category) feature state seeded by /train and updated by /observe,
+# so /predict can forecast a category sent without its recent expenses
+feature_states = FeatureStateStore()
+
+# Conformal interval offsets of the per-user models, written by /train
+calibrations = CalibrationStore()
+
+# Anomaly scoring state of every (user, category), updated by /anomaly/score
+anomaly_states = AnomalyStore()
+
+def forget_model(user_id, category, deleted):
+    """Drop the records of a key whose model files storage compaction removed (every state if it was deleted)"""
+    model_registry.delete(user_id, category)
+    calibrations.delete(user_id, category)
+    model_cache.invalidate(saved_model_path(user_id, category))
+    model_cache.invalidate(saved_model_path(user_id, category, prefix='compiled', ext='npz'))
+    if deleted:
+        feature_states.delete(user_id, category)
+        anomaly_states.delete(user_id, category)
+
+def record_keys():
+    """(user_id, category) of every model and state kept as a record rather than a file"""
+    keys = set()
+    for store in (model_registry, calibrations, feature_states, anomaly_states):
+        keys.update(store.keys())
+    return keys
+
+# Atomic writes, versions, budgets and compaction of the files in MODEL_DIR
+model_storage = ModelStorage(legacy_dir=LEGACY_MODEL_DIR, on_remove=forget_model, record_keys=record_keys,
+                             record_models=model_registry.saved_times)
+
+# Fingerprints of the histories the saved models were trained on, so an
+# unchanged history is not refitted and a slightly longer one skips model reselection
+training_fingerprints = FingerprintStore(model_storage)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
 
+# Warmup after start: 'background' (serve while warming), 'sync' (warm before
+# serving) or 'off'. pandas and sklearn are only imported where they are used,
+# so without warmup the first training job or pipeline prediction pays for them.
+WARMUP_MODE = os.environ.get('ML_WARMUP', 'background')
+# Number of most recently saved models to load into the cache during warmup
+WARMUP_PRELOAD = int(os.environ.get('ML_WARMUP_PRELOAD', 32))
+
+startup = {'ready': False, 'import_time': None, 'warmup_time': None, 'cold_start_time': None,
+           'preloaded_models': 0}
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness endpoint: 503 until warmup has finished"""
+    body = dict(startup, status='ready' if startup['ready'] else 'warming')
+    return jsonify(body), 200 if startup['ready'] else 503
+
+def cache_metrics():
+    """Model cache, registry and training queue values for /metrics"""
+    cache = model_cache.stats()
+    registry = model_registry.stats()
+    states = feature_states.usage()
+    anomalies = anomaly_states.usage()
+    results = result_cache.stats()
+    jobs = training_jobs.stats()['jobs']
+    return [
+        ('ml_model_cache_lookups_total', 'counter', 'Model cache lookups by result',
+         [({'result': 'hit'}, cache['hits']), ({'result': 'miss'}, cache['misses'])]),
+        ('ml_model_cache_evictions_total', 'counter', 'Models evicted from the cache', [({}, cache['evictions'])]),
+        ('ml_model_cache_invalidations_total', 'counter', 'Cached models dropped because the file changed',
+         [({}, cache['invalidations'])]),
+        ('ml_model_cache_entries', 'gauge', 'Models in the cache', [({}, cache['entries'])]),
+        ('ml_model_cache_bytes', 'gauge', 'Estimated size of the cached models', [({}, cache['bytes'])]),
+        ('ml_registry_lookups_total', 'counter', 'Model registry lookups by result',
+         [({'result': 'hit'}, registry['hits']), ({'result': 'miss'}, registry['misses'])]),
+        ('ml_registry_records', 'gauge', 'Models stored in the registry', [({}, registry['records'])]),
+        ('ml_feature_states', 'gauge', 'Feature states stored for predictions without expenses',
+         [({}, states['records'])]),
+        ('ml_anomaly_states', 'gauge', 'Anomaly scoring states stored', [({}, anomalies['records'])]),
+        ('ml_result_cache_lookups_total', 'counter', 'Prediction result cache lookups by result',
+         [({'result': 'hit'}, results['hits']), ({'result': 'miss'}, results['misses'])]),
+        ('ml_result_cache_evictions_total', 'counter', 'Prediction results evicted from the cache',
+         [({}, results['evictions'])]),
+        ('ml_result_cache_invalidations_total', 'counter', 'Prediction results dropped by a retrain',
+         [({}, results['invalidations'])]),
+        ('ml_result_cache_entries', 'gauge', 'Prediction results in the cache', [({}, results['entries'])]),
+        ('ml_train_requests_total', 'counter', 'Training requests by whether the model was retrained, '
+         'refitted without reselection or skipped', [({'outcome': outcome}, count)
+                                     for outcome, count in training_fingerprints.stats().items()]),
+        ('ml_training_jobs', 'gauge', 'Training jobs known to this process by status',
+         [({'status': status}, count) for status, count in sorted(jobs.items())])
+    ]
+
+metrics.add_collector(cache_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: stage latency histograms, request, error and cache counters"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Hit/miss/eviction counters for the saved model cache, the registry and the result cache"""
+    return jsonify(dict(model_cache.stats(), registry=model_registry.stats(), states=feature_states.usage(),
+                        anomaly_states=anomaly_states.usage(), results=result_cache.stats()))
+
+def save_trained_model(job, artifacts):
+    """Persist the models produced by a finished training job"""
+    user_id, category = job['user_id'], job['category']
+    # Stages timed in the training worker
+    observe_stages('train_model', artifacts['timings'])
+    if user_id is None or category is None:
+        return
+    
+    start = time.perf_counter()
+    if artifacts.get('category_model'):
+        if artifacts['model'] is not None:
+            save_category_model(category, artifacts['model'])
+        stage_seconds.observe(time.perf_counter() - start, 'train_global_model', 'save',
+                              job['result'].get('model_type', ''))
+        return
+    with observe_lock(user_id, category):
+        training_fingerprints.delete(user_id, category)
+        # Interval offsets of the model about to be saved; without them /predict uses the recent spread.
+        # Written first, so the result cache invalidation below also drops results with the old offsets
+        interval = (job['result'].get('metrics') or {}).get('interval')
+        if artifacts['model'] is not None and interval is not None:
+            calibrations.put(user_id, category, interval)
+        else:
+            calibrations.delete(user_id, category)
+        if artifacts['model'] is not None:
+            save_model(user_id, category, artifacts['model'], artifacts['compiled'])
+        else:
+            result_cache.invalidate(user_id, category)
+        # Seed the incrementally updated model used by /observe
+        online = artifacts['online']
+        model_storage.write(saved_model_path(user_id, category, prefix='online'),
+                            lambda path: joblib.dump(online, path))
+        # and the feature state /predict serves from
+        if artifacts.get('state') is not None:
+            feature_states.put(user_id, category, artifacts['state'])
+        # What the next /train of this (user, category) compares its history with
+        if artifacts.get('fingerprint') is not None:
+            training_fingerprints.save(user_id, category, artifacts['fingerprint'], job['result'],
+                                       artifacts.get('hyperparameters'), artifacts['model'] is not None)
+    stage_seconds.observe(time.perf_counter() - start, 'train_model', 'save', job['result']['model_type'])
+
+def save_model(user_id, category, model, compiled=None):
+    """Store the model served for a (user, category).
+
+    Linear-family models become a record in the model registry; anything
+    else (e.g. gradient boosting) is pickled to its joblib file, next to the
+    compiled node arrays when there are any. Whichever store is not used is
+    cleared so /predict cannot pick up a stale model.
+    """
+    model_path = saved_model_path(user_id, category)
+    compiled_path = saved_model_path(user_id, category, prefix='compiled', ext='npz')
+    if model_registry.put(user_id, category, model):
+        logger.info(f"Saved model for user {user_id}, category {category} to the registry")
+        stale = [model_path, compiled_path]
+    else:
+        logger.info(f"Saving model to {model_path}")
+        # Save the entire pipeline, keeping the one it replaces as a version
+        model_storage.write(model_path, lambda path: joblib.dump(model, path), versioned=True)
+        model_registry.delete(user_id, category)
+        stale = [compiled_path]
+        if isinstance(compiled, CompiledTrees):
+            model_storage.write(compiled_path, compiled.save, versioned=True)
+            stale = []
+    for path in stale:
+        if os.path.exists(path):
+            os.remove(path)
+    model_cache.invalidate(model_path)
+    model_cache.invalidate(compiled_path)
+    result_cache.invalidate(user_id, category)
+    # The saved training fingerprint no longer describes the served model
+    training_fingerprints.delete(user_id, category)
+
+def load_model(user_id, category):
+    """The model served for a (user, category), or None.
+
+    Registry records and compiled node arrays are evaluated with NumPy alone;
+    the pickled pipeline is the fallback for models saved without them.
+    """
+    model = model_registry.get(user_id, category)
+    if model is not None:
+        model = CompiledLinear.from_model(model)
+    else:
+        model = model_cache.get(saved_model_path(user_id, category, prefix='compiled', ext='npz'))
+        if model is None:
+            model = model_cache.get(saved_model_path(user_id, category))
+    if model is not None:
+        # Least recently served models are evicted first when storage is over budget
+        model_storage.touch(user_id, category)
+    return model
+
+# Models shared by all users of a category: 'fallback' serves them to users
+# without a model of their own, 'prefer' to every user, 'off' never
+GLOBAL_MODELS = os.environ.get('ML_GLOBAL_MODELS', 'fallback')
+
+def save_category_model(category, model):
+    """Store the model of a category shared by all users"""
+    path = global_model_path(category)
+    logger.info(f"Saving category model for {category} ({model.users} users) to {path}")
+    # Written aside and renamed, so other processes never load a partial file
+    model_storage.write(path, lambda tmp_path: joblib.dump(model, tmp_path), versioned=True)
+    model_cache.invalidate(path)
+
+def serving_model(user_id, category):
+    """The user's own model or the category model, as ML_GLOBAL_MODELS says, or None"""
+    if GLOBAL_MODELS == 'prefer':
+        model = model_cache.get(global_model_path(category))
+        if model is not None:
+            return model
+    model = load_model(user_id, category)
+    if model is None and GLOBAL_MODELS == 'fallback':
+        model = model_cache.get(global_model_path(category))
+    return model
+
+# /observe read-modify-writes the online model of a (user, category); one lock per key
+_observe_locks = {}
+_observe_locks_guard = threading.Lock()
+
+def observe_lock(user_id, category):
+    with _observe_locks_guard:
+        return _observe_locks.setdefault((user_id, category), threading.Lock())
+
+# Training runs in a separate pool of processes so that fitting large histories
+# does not hold up /predict requests served by this process
+training_jobs = TrainingJobQueue(
+    max_workers=int(os.environ.get('ML_TRAIN_WORKERS', 2)),
+    max_pending=int(os.environ.get('ML_TRAIN_QUEUE', 32)),
+    on_complete=save_trained_model
+)
+
+# Longest a /train request may block waiting for its job (seconds)
+MAX_TRAIN_WAIT = 25
+
+def job_response(job):
+    """202 while a job is queued or running, 200 once it has finished"""
+    status_code = 200 if job['status'] in (SUCCEEDED, FAILED, CANCELLED) else 202
+    response = jsonify(job)
+    response.status_code = status_code
+    response.headers['Location'] = f"/jobs/{job['job_id']}"
+    return response
+
+# Content types of streamed training bodies, and the bytes read from them at a time
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/jsonlines')
+INGEST_CHUNK_BYTES = int(os.environ.get('ML_INGEST_CHUNK_BYTES', DEFAULT_CHUNK_BYTES))
+
+# Granularity of models trained without an explicit one: 'transaction' or 'month'
+TRAIN_GRANULARITY = os.environ.get('ML_TRAIN_GRANULARITY', 'transaction')
+
 @app.route('/train', methods=['POST'])
 def train_model():
-    """Train a model based on historical expense data"""
+    """Queue a training job for historical expense data.
+
+    Takes a JSON object with an 'expenses' array, an NDJSON body
+    (application/x-ndjson): an optional header line with user_id, category,
+    wait and granularity, then one {amount, date} expense per line, or an
+    expense column frame (see ml.wire) with the same header fields. NDJSON
+    rows are folded into packed arrays chunk by chunk, so long histories are
+    never held as a list of dicts. granularity 'month' fits calendar-month
+    totals instead of individual expenses (default: ML_TRAIN_GRANULARITY).
+    
+    A history identical to the one the saved model was trained on finishes
+    at once with the stored result ('skipped'); one that only appends a few
+    expenses refits just the previously chosen model (see ml.fingerprint).
+    """
     start_time = time.time()
     logger.info("Received training request")
     
     try:
         # Get data from request
-        data = request.json
-        expenses = data.get('expenses', [])
+        if request.mimetype == wire.CONTENT_TYPE:
+            data, _, dates, amounts = wire.decode_expenses(request.get_data())
+            expenses = SortedHistory(dates, amounts) if len(amounts) else []
+            request_timer().lap('parse')
+        elif request.mimetype in NDJSON_TYPES:
+            data, history = ingest_ndjson(request.stream, INGEST_CHUNK_BYTES)
+            expenses = history.history() if len(history) else []
+            request_timer().lap('ingest')
+        else:
+            data = request.json
+            expenses = data.get('expenses', [])
         user_id = data.get('user_id')
         category = data.get('category')
+        # Optionally block for a while so small jobs can be answered in one round trip
+        wait = min(float(data.get('wait') or 0), MAX_TRAIN_WAIT)
+        # Per-expense models, or models of calendar-month totals
+        granularity = data.get('granularity') or TRAIN_GRANULARITY
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity!r}, expected one of {GRANULARITIES}")
         
         logger.info(f"Training model for user {user_id}, category {category} with {len(expenses)} expenses")
         
-        # Convert to DataFrame
-        df = pd.DataFrame(expenses)
-        df['date'] = pd.to_datetime(df['date'])
-        df['amount'] = pd.to_numeric(df['amount'])
-        
-        logger.info(f"Data loaded: {df.shape}")
-        
-        # Check if we have enough data
-        if len(df) < 5:
-            logger.warning("Not enough data for ML model")
-            result = {
-                'prediction': round(float(df['amount'].mean()), 2),
-                'accuracy': 50.0,  # Low accuracy due to limited data
-                'max_amount': float(df['amount'].max()),
-                'model_type': 'average',
-                'next_month': (df['date'].max() + timedelta(days=30)).strftime('%B %Y'),
-                'features_used': ['amount'],
-                'error': 'Not enough data for advanced models',
+        if not expenses:
+            return jsonify({
+                'error': 'No expenses to train on',
                 'training_time': round(time.time() - start_time, 2)
-            }
-            return jsonify(result)
-        
-        logger.info("Extracting features")
-        # Extract features from date
-        df['month'] = df['date'].dt.month
-        df['year'] = df['date'].dt.year
-        df['day_of_month'] = df['date'].dt.day
-        df['day_of_week'] = df['date'].dt.dayofweek
-        df['is_weekend'] = df['day_of_week'].apply(lambda x: 1 if x >= 5 else 0)
-        
-        # Create time-based features
-        df = df.sort_values('date')
-        df['days_since_first'] = (df['date'] - df['date'].min()).dt.days
-        
-        # Add sequence features
-        df['seq'] = range(len(df))
-        
-        # Create lag features (previous amounts)
-        df['prev_amount'] = df['amount'].shift(1)
-        df['prev_amount_2'] = df['amount'].shift(2)
-        df['prev_amount_3'] = df['amount'].shift(3)
-        
-        # Rolling statistics
-        df['rolling_mean_2'] = df['amount'].rolling(window=2).mean()
-        df['rolling_mean_3'] = df['amount'].rolling(window=3).mean()
-        df['rolling_std_3'] = df['amount'].rolling(window=3).std()
-        
-        # Trend and seasonality detection
-        df['trend'] = df['seq'] / max(1, df['seq'].max())
-        
-        # Drop rows with NaN (first few rows due to lag features)
-        df_clean = df.dropna().copy()
-        
-        if len(df_clean) < 3:
-            logger.warning("Not enough data after feature engineering")
-            # Not enough data after creating lag features
-            result = {
-                'prediction': round(float(df['amount'].mean()), 2),
-                'accuracy': 60.0,
-                'max_amount': float(df['amount'].max()),
-                'model_type': 'average_with_trend',
-                'next_month': (df['date'].max() + timedelta(days=30)).strftime('%B %Y'),
-                'features_used': ['amount', 'trend'],
-                'error': 'Limited data after feature engineering',
-                'training_time': round(time.time() - start_time, 2)
-            }
-            return jsonify(result)
+            }), 400
         
-        # Features to use
-        features = [
-            'month', 'day_of_month', 'is_weekend',
-            'days_since_first', 'seq', 'trend',
-            'prev_amount', 'rolling_mean_3'
-        ]
-        
-        # Remove features with too many NaNs
-        features = [f for f in features if df_clean[f].isnull().sum() == 0]
-        logger.info(f"Using features: {features}")
-        
-        # Prepare data for modeling
-        X = df_clean[features]
-        y = df_clean['amount']
-        
-        # Split data if we have enough samples
-        has_test_data = True
-        if len(df_clean) >= 5:
-            X_train, X_test, y_train, y_test = train_test_split(
-                X, y, test_size=0.2, random_state=42
-            )
-        else:
-            # Not enough data for test split
-            X_train, y_train = X, y
-            X_test, y_test = X.iloc[:1], y.iloc[:1]  # Just use one sample for metrics
-            has_test_data = False
-        
-        logger.info("Training models")
-        # Choose model based on data size
-        if len(df_clean) >= 10:
-            # Try different models
-            models = {
-                'linear': LinearRegression(),
-                'ridge': Ridge(alpha=1.0),
-                'gradient_boosting': GradientBoostingRegressor(n_estimators=50, max_depth=3)
-            }
-            
-            best_model_name = None
-            best_model = None
-            best_score = float('-inf')
-            model_scores = {}
-            
-            for name, model in models.items():
-                logger.info(f"Trying {name} model")
-                pipeline = Pipeline([
-                    ('scaler', StandardScaler()),
-                    ('model', model)
-                ])
-                
-                pipeline.fit(X_train, y_train)
-                score = pipeline.score(X_test, y_test) if has_test_data else 0.7
-                model_scores[name] = score
-                logger.info(f"{name} model score: {score}")
-                
-                if score > best_score:
-                    best_score = score
-                    best_model_name = name
-                    best_model = pipeline
-                    
-            # If all models perform poorly, use a simpler approach
-            if best_score < 0:
-                logger.warning("All models performed poorly, using robust linear model")
-                best_model = Pipeline([
-                    ('scaler', StandardScaler()),
-                    ('model', LinearRegression())
-                ])
-                best_model.fit(X_train, y_train)
-                best_model_name = 'robust_linear'
-        else:
-            logger.info("Using simple linear model due to limited data")
-            # For small datasets, use a simple model
-            best_model = Pipeline([
-                ('scaler', StandardScaler()),
-                ('model', LinearRegression())
-            ])
-            best_model.fit(X_train, y_train)
-            best_model_name = 'simple_linear'
-            best_score = 0.7  # Approximate score for small datasets
-        
-        # Evaluate model
-        logger.info("Evaluating model")
-        train_pred = best_model.predict(X_train)
-        mae_train = mean_absolute_error(y_train, train_pred)
-        
-        if has_test_data:
-            test_pred = best_model.predict(X_test)
-            mae_test = mean_absolute_error(y_test, test_pred)
-            rmse_test = np.sqrt(mean_squared_error(y_test, test_pred))
-            r2 = r2_score(y_test, test_pred)
-            accuracy = max(0, min(100, 100 * (1 - mae_test / y_test.mean())))
-        else:
-            mae_test = mae_train
-            rmse_test = np.sqrt(mean_squared_error(y_train, train_pred))
-            r2 = r2_score(y_train, train_pred)
-            accuracy = max(0, min(100, 100 * (1 - mae_train / y_train.mean())))
+        # Training workers receive sorted arrays rather than a list of dicts
+        if not isinstance(expenses, SortedHistory):
+            try:
+                expenses = SortedHistory(*sorted_series(expenses))
+            except (KeyError, TypeError) as e:
+                raise ValueError(f"Expense rows need an amount and a date: {str(e)}")
+            request_timer().lap('parse')
         
-        # Save the model if user_id and category are provided
+        options = {'granularity': granularity}
         if user_id is not None and category is not None:
-            model_filename = f'model_{user_id}_{category.replace(" ", "_")}.joblib'
-            model_path = os.path.join(MODEL_DIR, model_filename)
-            logger.info(f"Saving model to {model_path}")
-            # Save the entire pipeline
-            joblib.dump(best_model, model_path)
-        
-        # Get next month data
-        last_date = df['date'].max()
-        next_month_date = last_date + timedelta(days=30)
-        
-        # Prepare features for prediction
-        last_row = df_clean.iloc[-1].copy()
-        
-        # Create next month features
-        next_month_features = {
-            'month': next_month_date.month,
-            'day_of_month': next_month_date.day,
-            'is_weekend': 1 if next_month_date.weekday() >= 5 else 0,
-            'days_since_first': (next_month_date - df['date'].min()).days,
-            'seq': df_clean['seq'].max() + 1,
-            'trend': (df_clean['seq'].max() + 1) / (df_clean['seq'].max() + 1),
-            'prev_amount': df_clean['amount'].iloc[-1],
-            'rolling_mean_3': df_clean['amount'].tail(3).mean()
-        }
+            change, stored = training_fingerprints.check(user_id, category, expenses.dates, expenses.amounts,
+                                                         options)
+            request_timer().lap('fingerprint')
+            if change == UNCHANGED and (not stored['has_model'] or load_model(user_id, category) is not None):
+                logger.info("History unchanged since the last training, reusing its result")
+                # The state follows the history sent even when the model does not change
+                with observe_lock(user_id, category):
+                    feature_states.put(user_id, category,
+                                       FeatureState.from_history(expenses.dates, expenses.amounts))
+                result = dict(stored['result'], skipped=True, training_time=round(time.time() - start_time, 2))
+                job, created = training_jobs.complete(user_id, category, len(expenses), result, skipped=True)
+                if created:
+                    training_fingerprints.count('skipped')
+                return job_response(job)
+            if change == APPENDED and stored.get('hyperparameters'):
+                logger.info(f"{len(expenses) - stored['fingerprint']['rows']} expenses appended since the "
+                            f"last training, refitting {stored['hyperparameters']['model_type']} without reselection")
+                options['previous_selection'] = stored['hyperparameters']
         
-        # Filter only the features we're using
-        next_month_features = {k: v for k, v in next_month_features.items() if k in features}
+        job, created = training_jobs.submit(user_id, category, expenses, **options)
+        if created:
+            training_fingerprints.count('reselection_skipped' if 'previous_selection' in options else 'retrained')
+        if not created:
+            logger.info(f"Training already in progress as job {job['job_id']}")
+        if wait > 0:
+            job = training_jobs.wait(job['job_id'], wait)
         
-        # Create a DataFrame for prediction
-        pred_df = pd.DataFrame([next_month_features])
+        return job_response(job)
         
-        # Make prediction
-        logger.info("Making prediction")
-        prediction = best_model.predict(pred_df)[0]
-        
-        # Ensure prediction is reasonable (not negative, not extreme)
-        min_amount = df['amount'].min()
-        max_amount = df['amount'].max()
-        avg_amount = df['amount'].mean()
-        
-        # If prediction seems unreasonable, adjust it
-        if prediction < 0 or prediction > max_amount * 2:
-            logger.warning(f"Prediction {prediction} seems unreasonable, adjusting")
-            # Use a weighted average of prediction and recent values
-            adjusted_prediction = 0.5 * avg_amount + 0.5 * df_clean['amount'].tail(3).mean()
-            prediction = max(min_amount * 0.5, min(adjusted_prediction, max_amount * 1.5))
-            logger.info(f"Adjusted prediction to {prediction}")
-
-        # Calculate confidence based on model performance and data consistency
-        confidence_score = min(100, max(0, accuracy))
-        
-        # Format next month
-        next_month = next_month_date.strftime('%B %Y')
-        
-        # Return results
-        metrics = {
-            'mae_train': round(float(mae_train), 2),
-            'mae_test': round(float(mae_test), 2) if has_test_data else None,
-            'rmse_test': round(float(rmse_test), 2) if has_test_data else None,
-            'r2': round(float(r2), 4)
-        }
-        
-        # Filter out None values
-        metrics = {k: v for k, v in metrics.items() if v is not None}
-        
-        result = {
-            'prediction': round(float(prediction), 2),
-            'accuracy': round(float(confidence_score), 2),
-            'max_amount': float(max_amount),
-            'model_type': best_model_name,
-            'next_month': next_month,
-            'features_used': features,
-            'metrics': metrics,
+    except QueueFullError as e:
+        logger.warning(f"Rejecting training request: {str(e)}")
+        return jsonify({
+            'error': 'Training queue is full',
+            'details': str(e),
             'training_time': round(time.time() - start_time, 2)
-        }
-        
-        logger.info(f"Training complete in {round(time.time() - start_time, 2)} seconds")
-        return jsonify(result)
-        
+        }), 503
+    except ValueError as e:
+        # Malformed NDJSON lines or expense rows
+        logger.warning(f"Rejecting training request: {str(e)}")
+        return jsonify({
+            'error': 'Invalid training data',
+            'details': str(e),
+            'training_time': round(time.time() - start_time, 2)
+        }), 400
     except Exception as e:
         logger.error(f"Error in training: {str(e)}", exc_info=True)
         return jsonify({
@@ -300,209 +494,560 @@ def train_model():
             'training_time': round(time.time() - start_time, 2)
         }), 500
 
-@app.route('/predict', methods=['POST'])
-def predict():
-    """Make a prediction using a saved model or statistical methods"""
+@app.route('/train_global', methods=['POST'])
+def train_global_model():
+    """Queue training of one model for a category, shared by all its users.
+
+    Takes a JSON object {category, groups: [{user_id, expenses}], wait} or
+    an expense column frame whose header has category, wait and groups
+    ([{user_id, rows}]). Served per ML_GLOBAL_MODELS once trained.
+    """
+    start_time = time.time()
+    logger.info("Received category training request")
+    
+    try:
+        if request.mimetype == wire.CONTENT_TYPE:
+            data, offsets, dates, amounts = wire.decode_expenses(request.get_data())
+        else:
+            data = request.json
+            offsets, dates, amounts = group_expenses(data.get('groups', []), key='expenses')
+        groups = data.get('groups') or []
+        category = data.get('category')
+        wait = min(float(data.get('wait') or 0), MAX_TRAIN_WAIT)
+        history = GroupedHistory([g.get('user_id') for g in groups], offsets, dates, amounts)
+        request_timer().lap('parse')
+        
+        logger.info(f"Training category model for {category} with {len(history)} expenses "
+                    f"from {len(groups)} users")
+        
+        if category is None or not len(history):
+            return jsonify({
+                'error': 'A category and expenses to train on are required',
+                'training_time': round(time.time() - start_time, 2)
+            }), 400
+        
+        job, created = training_jobs.submit(ALL_USERS, category, history, category_model=category)
+        if not created:
+            logger.info(f"Category training already in progress as job {job['job_id']}")
+        if wait > 0:
+            job = training_jobs.wait(job['job_id'], wait)
+        
+        return job_response(job)
+        
+    except QueueFullError as e:
+        logger.warning(f"Rejecting category training request: {str(e)}")
+        return jsonify({
+            'error': 'Training queue is full',
+            'details': str(e),
+            'training_time': round(time.time() - start_time, 2)
+        }), 503
+    except ValueError as e:
+        logger.warning(f"Rejecting category training request: {str(e)}")
+        return jsonify({
+            'error': 'Invalid training data',
+            'details': str(e),
+            'training_time': round(time.time() - start_time, 2)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error in category training: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': str(e),
+            'training_time': round(time.time() - start_time, 2)
+        }), 500
+
+@app.route('/observe', methods=['POST'])
+def observe():
+    """Fold newly added expenses into a trained model and its feature state without refitting the history"""
     start_time = time.time()
-    logger.info("Received prediction request")
     
     try:
         data = request.json
-        recent_expenses = data.get('recent_expenses', [])
+        expenses = data.get('expenses', [])
         user_id = data.get('user_id')
         category = data.get('category')
         
-        logger.info(f"Predicting for user {user_id}, category {category} with {len(recent_expenses)} recent expenses")
+        logger.info(f"Observing {len(expenses)} new expenses for user {user_id}, category {category}")
         
-        # Check if we have a saved model
-        model = None
-        model_path = None
-        
-        if user_id is not None and category is not None:
-            model_filename = f'model_{user_id}_{category.replace(" ", "_")}.joblib'
-            model_path = os.path.join(MODEL_DIR, model_filename)
-            if os.path.exists(model_path):
-                logger.info(f"Loading saved model from {model_path}")
-                try:
-                    model = joblib.load(model_path)
-                    logger.info("Model loaded successfully")
-                except Exception as e:
-                    logger.error(f"Error loading model: {str(e)}", exc_info=True)
+        if user_id is None or category is None or not expenses:
+            return jsonify({'error': 'user_id, category and expenses are required'}), 400
         
-        # Convert expenses to DataFrame
-        df = pd.DataFrame(recent_expenses)
-        df['date'] = pd.to_datetime(df['date'])
-        df['amount'] = pd.to_numeric(df['amount'])
+        timer = request_timer()
+        timer.skip()
+        dates, amounts = sorted_series(expenses)
+        online_path = saved_model_path(user_id, category, prefix='online')
+        timer.lap('parse')
         
-        # If we have a saved model, use it for prediction
-        if model is not None:
-            logger.info("Using saved model for prediction")
-            # Extract features
-            df['month'] = df['date'].dt.month
-            df['day_of_month'] = df['date'].dt.day
-            df['day_of_week'] = df['date'].dt.dayofweek
-            df['is_weekend'] = df['day_of_week'].apply(lambda x: 1 if x >= 5 else 0)
-            
-            # Sort by date
-            df = df.sort_values('date')
-            
-            # Calculate days since first expense
-            first_date = df['date'].min()
-            df['days_since_first'] = (df['date'] - first_date).dt.days
-            
-            # Add sequence
-            df['seq'] = range(len(df))
-            
-            # Add rolling statistics
-            df['rolling_mean_3'] = df['amount'].rolling(window=min(3, len(df))).mean()
-            df['prev_amount'] = df['amount'].shift(1)
+        with observe_lock(user_id, category):
+            if not os.path.exists(online_path):
+                return jsonify({
+                    'error': 'No trained model for this category',
+                    'message': 'Train a model with /train before observing new expenses'
+                }), 404
             
-            # Fill missing values due to rolling calculations
-            df = df.fillna(method='bfill').fillna(method='ffill')
-            
-            # Get next month date
-            last_date = df['date'].max()
-            next_month_date = last_date + timedelta(days=30)
+            online = joblib.load(online_path)
+            timer.lap('model_load')
+            try:
+                fitted_rows = online.observe(dates, amounts)
+                timer.lap('fit', 'online')
+                state = feature_states.append(user_id, category, dates, amounts)
+                timer.lap('state')
+            except OutOfOrderError as e:
+                logger.warning(f"Cannot observe out-of-order expenses: {str(e)}")
+                # The state no longer matches the expenses; /predict needs them sent until the next /train
+                feature_states.delete(user_id, category)
+                return jsonify({
+                    'error': 'Expenses are older than the last observed expense',
+                    'message': 'Retrain the model with /train to include back-dated expenses',
+                    'requires_retrain': True
+                }), 409
             
-            # Create features for prediction
-            next_month_features = {
-                'month': next_month_date.month,
-                'day_of_month': next_month_date.day,
-                'is_weekend': 1 if next_month_date.weekday() >= 5 else 0,
-                'days_since_first': (next_month_date - first_date).days,
-                'seq': df['seq'].max() + 1,
-                'trend': (df['seq'].max() + 1) / (df['seq'].max() + 1),
-                'prev_amount': df['amount'].iloc[-1],
-                'rolling_mean_3': df['amount'].tail(min(3, len(df))).mean()
+            model_storage.write(online_path, lambda path: joblib.dump(online, path))
+            if online.serving and fitted_rows > 0:
+                # The stored offsets were calibrated on the trained model's residuals, not this one's:
+                # intervals fall back to the stderr band until the next /train. Deleted before
+                # save_model invalidates the result cache, so no result keeps the old offsets
+                calibrations.delete(user_id, category)
+                save_model(user_id, category, online)
+            timer.lap('save', 'online')
+        
+        logger.info(f"Observed {len(amounts)} expenses in {round(time.time() - start_time, 4)} seconds")
+        return jsonify({
+            'rows': len(amounts),
+            'fitted_rows': fitted_rows,
+            'total_rows': online.rows_seen,
+            'model_updated': bool(online.serving and fitted_rows > 0),
+            'state_updated': state is not None,
+            'model_type': 'online_ridge' if online.alpha > 0 else 'online_linear',
+            'observe_time': round(time.time() - start_time, 4)
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in observe: {str(e)}", exc_info=True)
+        return jsonify({
+            'error': str(e),
+            'observe_time': round(time.time() - start_time, 4)
+        }), 500
+
+@app.route('/state', methods=['DELETE'])
+def delete_state():
+    """Forget the feature state of a (user, category) whose past expenses were edited or deleted"""
+    data = request.json or {}
+    user_id = data.get('user_id')
+    category = data.get('category')
+    if user_id is None or category is None:
+        return jsonify({'error': 'user_id and category are required'}), 400
+    with observe_lock(user_id, category):
+        deleted = feature_states.delete(user_id, category)
+    logger.info(f"Feature state of user {user_id}, category {category} {'deleted' if deleted else 'not found'}")
+    return jsonify({'deleted': deleted})
+
+def score_group(group, update=True, reset=False):
+    """{user_id, category, scores, anomalies} of one group's expenses, scored in the order sent"""
+    user_id = group.get('user_id')
+    category = group.get('category')
+    expenses = group.get('expenses', [])
+    if user_id is None or category is None:
+        raise ValueError('user_id and category are required')
+    amounts = parse_amounts([expense['amount'] for expense in expenses])
+    if reset:
+        anomaly_states.delete(user_id, category)
+    scores = anomaly_states.score(user_id, category, amounts, update)
+    for expense, score in zip(expenses, scores):
+        if 'id' in expense:
+            score['id'] = expense['id']
+    anomalies = sum(score['anomaly'] for score in scores)
+    expenses_scored_total.inc('true', amount=anomalies)
+    expenses_scored_total.inc('false', amount=len(scores) - anomalies)
+    return {'user_id': user_id, 'category': category, 'scores': scores, 'anomalies': anomalies}
+
+@app.route('/anomaly/score', methods=['POST'])
+def score_anomalies():
+    """Score new expenses of a (user, category) against its streaming state, then fold them in"""
+    start_time = time.time()
+    try:
+        data = request.json or {}
+        if not data.get('expenses'):
+            return jsonify({'error': 'user_id, category and expenses are required'}), 400
+        result = score_group(data, update=data.get('update', True))
+        if result['anomalies']:
+            logger.info(f"{result['anomalies']} unusual expenses for user {result['user_id']}, "
+                        f"category {result['category']}")
+        result['score_time'] = round(time.time() - start_time, 6)
+        return jsonify(result)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Rejecting anomaly scoring request: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in anomaly scoring: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e), 'score_time': round(time.time() - start_time, 6)}), 500
+
+@app.route('/anomaly/score_batch', methods=['POST'])
+def score_anomalies_batch():
+    """Score the expenses of many (user, category) groups, e.g. to backfill the states from history.
+
+    With "reset", each group's state is rebuilt from the expenses sent
+    (oldest first); with "update": false, the states are left as they are.
+    """
+    start_time = time.time()
+    try:
+        data = request.json or {}
+        groups = data.get('groups', [])
+        update = data.get('update', True)
+        reset = bool(data.get('reset', False)) and update
+        logger.info(f"Scoring the expenses of {len(groups)} groups for anomalies")
+        
+        results = []
+        for group in groups:
+            try:
+                results.append(score_group(group, update, reset))
+            except (ValueError, KeyError, TypeError) as e:
+                results.append({'user_id': group.get('user_id'), 'category': group.get('category'),
+                                'error': str(e)})
+        
+        return jsonify({
+            'results': results,
+            'expenses': sum(len(result.get('scores', [])) for result in results),
+            'anomalies': sum(result.get('anomalies', 0) for result in results),
+            'score_time': round(time.time() - start_time, 4)
+        })
+    except Exception as e:
+        logger.error(f"Error in batch anomaly scoring: {str(e)}", exc_info=True)
+        return jsonify({
+            'results': [],
+            'error': str(e),
+            'score_time': round(time.time() - start_time, 4)
+        }), 500
+
+@app.route('/storage/stats', methods=['GET'])
+def storage_stats():
+    """Files, bytes, budgets and last compaction of the model directory"""
+    return jsonify(model_storage.usage())
+
+@app.route('/storage/compact', methods=['POST'])
+def compact_storage():
+    """Remove orphaned model files now and evict models over the budgets; reports the bytes reclaimed.
+
+    "keys" lists the (user_id, category) pairs that still exist; the models
+    and states of every other key are removed. "dry_run" only reports.
+    """
+    data = request.get_json(silent=True) or {}
+    keys = data.get('keys')
+    if keys is not None and not all(isinstance(key, (list, tuple)) and len(key) == 2 for key in keys):
+        return jsonify({'error': 'keys must be [user_id, category] pairs'}), 400
+    report = model_storage.compact(keys, dry_run=bool(data.get('dry_run', False)))
+    if report is None:
+        return jsonify({'error': 'Another process is compacting the model directory'}), 409
+    return jsonify(report)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status and, once finished, result of a training job"""
+    job = training_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'job_id': job_id}), 404
+    return job_response(job)
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running training job"""
+    job = training_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found', 'job_id': job_id}), 404
+    logger.info(f"Cancellation requested for training job {job_id}")
+    return job_response(job)
+
+@app.route('/jobs', methods=['GET'])
+def job_stats():
+    """Counts of training jobs by status, and of training requests by outcome"""
+    return jsonify(dict(training_jobs.stats(), training=training_fingerprints.stats()))
+
+def predict_groups(groups, series=None, horizon=None):
+    """Next-month forecasts for a list of {user_id, category, recent_expenses} groups.
+
+    series, if given, is the groups' expenses already decoded into sorted
+    (offsets, dates, amounts) arrays (see ml.wire), and recent_expenses is
+    not used. Groups sent without expenses are forecast from their feature
+    state (see ml.state_store) when they have one, with the seq,
+    days_since_first, mean and std of the whole history the state follows.
+    Groups whose (model version, expenses) were predicted recently
+    are served from the result cache. Features for the others are extracted
+    in one vectorized pass; groups with a saved model use it, the others get
+    the statistical forecast. Every forecast has lower and upper bounds,
+    from the conformal offsets stored with its model where there are any
+    (see ml.calibration). With a horizon, each result also lists the
+    forecasts of that many periods (see ml.horizon). Returns one result dict
+    per group, in order.
+    """
+    timer = request_timer()
+    timer.skip()
+    results = [None] * len(groups)
+    if series is None:
+        has_rows = [bool(group.get('recent_expenses')) for group in groups]
+    else:
+        has_rows = np.diff(series[0]) > 0
+    states = [None] * len(groups)
+    valid = []
+    for i, group in enumerate(groups):
+        if not has_rows[i] and group.get('user_id') is not None and group.get('category') is not None:
+            states[i] = feature_states.get(group.get('user_id'), group.get('category'))
+        if has_rows[i] or states[i] is not None:
+            valid.append(i)
+        else:
+            results[i] = {
+                'user_id': group.get('user_id'),
+                'category': group.get('category'),
+                'prediction': 0,
+                'confidence': 50.0,
+                'error': 'No recent expenses',
+                'next_month': 'Error'
             }
-            
-            # Get feature names from the model pipeline
-            model_features = []
+    
+    if not valid:
+        return results
+    
+    if series is None:
+        offsets, dates, amounts = group_expenses([groups[i] for i in valid])
+    else:
+        # Groups without rows own no part of the arrays, so only the offsets change
+        offsets, dates, amounts = series
+        offsets = np.concatenate(([0], np.cumsum(np.diff(offsets)[valid])))
+    if any(states[i] is not None for i in valid):
+        # Groups served from their state own no rows yet: splice in the state's recent expenses
+        pieces = [(states[i].recent_dates, states[i].recent_amounts) if states[i] is not None
+                  else (dates[offsets[j]:offsets[j + 1]], amounts[offsets[j]:offsets[j + 1]])
+                  for j, i in enumerate(valid)]
+        offsets = np.concatenate(([0], np.cumsum([len(piece[1]) for piece in pieces])))
+        dates = np.concatenate([piece[0] for piece in pieces])
+        amounts = np.concatenate([piece[1] for piece in pieces])
+    timer.lap('parse')
+    
+    models = []
+    for i in valid:
+        user_id = groups[i].get('user_id')
+        category = groups[i].get('category')
+        model = None
+        if user_id is not None and category is not None:
             try:
-                # For sklearn pipelines
-                if hasattr(model, 'named_steps'):
-                    model_step = model.named_steps.get('model')
-                    if hasattr(model_step, 'feature_names_in_'):
-                        model_features = list(model_step.feature_names_in_)
-                        logger.info(f"Features from model: {model_features}")
+                model = serving_model(user_id, category)
             except Exception as e:
-                logger.warning(f"Could not get feature names from model: {str(e)}")
-                # Default feature set
-                model_features = [
-                    'month', 'day_of_month', 'is_weekend',
-                    'days_since_first', 'seq', 'trend',
-                    'prev_amount', 'rolling_mean_3'
-                ]
-            
-            # Filter only the features the model expects
-            pred_features = {k: v for k, v in next_month_features.items() if k in model_features}
-            logger.info(f"Using features for prediction: {pred_features.keys()}")
-            
-            # Create DataFrame for prediction
-            pred_df = pd.DataFrame([pred_features])
-            
-            # Handle missing features by adding zeros
-            for feature in model_features:
-                if feature not in pred_df.columns:
-                    logger.info(f"Adding missing feature {feature}")
-                    pred_df[feature] = 0
-            
-            # Ensure columns are in the correct order
-            if model_features:
-                logger.info("Reordering features")
-                pred_df = pred_df[model_features]
-            
-            # Make prediction
-            logger.info("Making prediction with model")
-            prediction = model.predict(pred_df)[0]
-            logger.info(f"Raw prediction: {prediction}")
-            
-            # Get stats for confidence and bounds check
-            avg_amount = df['amount'].mean()
-            max_amount = df['amount'].max()
-            min_amount = df['amount'].min()
-            std_dev = df['amount'].std()
+                logger.error(f"Error loading model for user {user_id}, category {category}: {str(e)}", exc_info=True)
+        models.append(model)
+    timer.lap('model_load')
+    
+    # Positions in valid of the groups that still need a prediction
+    pending = list(range(len(valid)))
+    keys = [None] * len(valid)
+    if result_cache.enabled:
+        pending = []
+        for j, i in enumerate(valid):
+            version = model_version(models[j])
+            if isinstance(models[j], GlobalCategoryModel):
+                # A shared model's forecast also depends on whose expenses these are
+                version += ':' + user_key(groups[i].get('user_id'))
+            if states[i] is not None:
+                # The recent expenses of a state do not determine its whole-history numbers
+                version += ':state:' + states[i].version()
+            if horizon is not None:
+                version += f':h{horizon}'
+            keys[j] = result_cache.key(version, dates[offsets[j]:offsets[j + 1]],
+                                       amounts[offsets[j]:offsets[j + 1]])
+            cached = result_cache.get(keys[j])
+            if cached is not None:
+                results[i] = dict(cached, user_id=groups[i].get('user_id'), category=groups[i].get('category'))
+            else:
+                pending.append(j)
+        timer.lap('result_cache')
+        if not pending:
+            return results
+        if len(pending) < len(valid):
+            rows_of = [np.arange(offsets[j], offsets[j + 1]) for j in pending]
+            index = np.concatenate(rows_of)
+            offsets = np.concatenate(([0], np.cumsum([len(r) for r in rows_of])))
+            dates, amounts = dates[index], amounts[index]
+    
+    stats = grouped_next_period(offsets, dates, amounts)
+    seeded = [k for k, j in enumerate(pending) if states[valid[j]] is not None]
+    if seeded:
+        apply_states(stats, seeded, [states[valid[pending[k]]] for k in seeded])
+    matrix = feature_matrix(stats)
+    column = {name: j for j, name in enumerate(DEFAULT_FEATURES)}
+    
+    # Statistical forecast for every group, replaced below where a saved model exists
+    trend_effect = np.minimum(0.2 * stats['mean'], np.abs(stats['slope'] * stats['count']))
+    trend_effect *= np.where(stats['slope'] > 0, 1, -1)
+    statistical = 0.7 * stats['weighted_avg'] + 0.3 * stats['mean'] + trend_effect
+    statistical = np.maximum(stats['min'] * 0.5, np.minimum(statistical, stats['max'] * 1.5))
+    
+    # Confidence from the coefficient of variation (single rows count as fully confident)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cv = np.where(stats['mean'] > 0, stats['std'] / stats['mean'], 1.0)
+    confidence = np.clip(np.nan_to_num(100 * (1 - cv), nan=100.0), 0, 100)
+    timer.lap('features')
+    
+    rows = {}
+    predicted = np.empty(len(pending))
+    interval_offsets = [None] * len(pending)
+    # Spread the uncalibrated intervals are drawn from, in the unit of each prediction
+    interval_std = np.array(stats['std'], dtype=np.float64)
+    # k indexes the feature arrays, j the valid groups
+    for k, j in enumerate(pending):
+        i = valid[j]
+        model = models[j]
+        user_id = groups[i].get('user_id')
+        category = groups[i].get('category')
+        next_month = next_month_label(stats['next_date'][k])
+        
+        if isinstance(model, GlobalCategoryModel):
+            # Category model shared across users, in units of this user's mean
+            features = {name: values[k] for name, values in stats.items()}
+            prediction, cold_start = model.forecast(user_id, features)
+            interval_offsets[k] = model.interval_offsets(user_id, features)
+            model_type = 'global_model'
+            features_used = list(GLOBAL_FEATURES)
+        elif isinstance(model, MonthlyForecaster):
+            # Total of the next calendar month, bounded by the forecaster
+            prediction, month = model.forecast(dates[offsets[k]:offsets[k + 1]], amounts[offsets[k]:offsets[k + 1]])
+            interval_std[k] = model.spread(dates[offsets[k]:offsets[k + 1]], amounts[offsets[k]:offsets[k + 1]])
+            partial_month = not model.covers(dates[offsets[k]:offsets[k + 1]])
+            next_month = next_month_label(month)
+            model_type = 'saved_model'
+            features_used = list(MONTHLY_FEATURES)
+        elif model is not None:
+            names = tuple(model_feature_names(model))
+            if names not in rows:
+                # Missing features are filled with zeros
+                cols = [matrix[:, column[n]] if n in column else np.zeros(len(pending)) for n in names]
+                rows[names] = np.column_stack(cols)
+            if isinstance(model, (CompiledLinear, CompiledTrees)):
+                prediction = float(model.predict(rows[names][k:k + 1])[0])
+            else:
+                # sklearn pipelines validate feature names, so they get a DataFrame
+                import pandas as pd
+                frame = pd.DataFrame(rows[names][k:k + 1], columns=list(names))
+                timer.lap('dataframe')
+                prediction = float(model.predict(frame)[0])
             
             # Ensure prediction is reasonable
-            if prediction < 0 or prediction > max_amount * 2:
+            if prediction < 0 or prediction > stats['max'][k] * 2:
                 logger.warning(f"Prediction {prediction} seems unreasonable, adjusting")
                 # Use a weighted average of prediction and recent values
-                adjusted_prediction = 0.5 * avg_amount + 0.5 * df['amount'].tail(3).mean()
-                prediction = max(min_amount * 0.5, min(adjusted_prediction, max_amount * 1.5))
-                logger.info(f"Adjusted prediction to {prediction}")
-            
-            # Calculate confidence based on model accuracy and data variability
-            coefficient_of_variation = std_dev / avg_amount if avg_amount > 0 else 1
-            confidence = max(0, min(100, 100 * (1 - coefficient_of_variation)))
-            
-            # Get next month string
-            next_month = next_month_date.strftime('%B %Y')
-            
-            result = {
-                'prediction': round(float(prediction), 2),
-                'confidence': round(float(confidence), 2),
-                'next_month': next_month,
-                'model_type': 'saved_model',
-                'features_used': list(pred_features.keys()) if pred_features else ['amount'],
-                'prediction_time': round(time.time() - start_time, 2)
-            }
-            
+                adjusted = 0.5 * stats['mean'][k] + 0.5 * stats['rolling_mean_3'][k]
+                prediction = max(stats['min'][k] * 0.5, min(adjusted, stats['max'][k] * 1.5))
+            model_type = 'saved_model'
+            features_used = list(names)
         else:
-            logger.info("No saved model found, using statistical approach")
-            # Use statistical approach
-            # Sort by date
-            df = df.sort_values('date')
-            
-            # Calculate basic statistics
-            avg_amount = df['amount'].mean()
-            max_amount = df['amount'].max()
-            min_amount = df['amount'].min()
-            
-            # Weighted average (more recent expenses have higher weight)
-            weights = np.linspace(0.5, 1.0, len(df))
-            weighted_avg = np.average(df['amount'], weights=weights)
-            
-            # Simple trend analysis
-            if len(df) >= 3:
-                x = np.arange(len(df))
-                y = df['amount'].values
-                coeffs = np.polyfit(x, y, 1)
-                trend = coeffs[0]  # Slope indicates trend
-            else:
-                trend = 0
-            
-            # Prediction with trend adjustment
-            prediction = 0.7 * weighted_avg + 0.3 * avg_amount
-            
-            # Add trend effect (limited to prevent extreme predictions)
-            trend_effect = min(0.2 * avg_amount, abs(trend * len(df))) * (1 if trend > 0 else -1)
-            prediction += trend_effect
-            
-            # Ensure prediction is within reasonable bounds
-            prediction = max(min_amount * 0.5, min(prediction, max_amount * 1.5))
-            
-            # Calculate confidence
-            std_dev = df['amount'].std()
-            coefficient_of_variation = std_dev / avg_amount if avg_amount > 0 else 1
-            confidence = max(0, min(100, 100 * (1 - coefficient_of_variation)))
-            
-            # Get next month date
-            last_date = df['date'].max()
-            next_month_date = last_date + timedelta(days=30)
-            next_month = next_month_date.strftime('%B %Y')
-            
-            result = {
-                'prediction': round(float(prediction), 2),
-                'confidence': round(float(confidence), 2),
-                'next_month': next_month,
-                'model_type': 'statistical',
-                'features_used': ['amount', 'weights', 'trend'],
-                'prediction_time': round(time.time() - start_time, 2)
-            }
+            prediction = statistical[k]
+            model_type = 'statistical'
+            features_used = ['amount', 'weights', 'trend']
+        if model is not None and not isinstance(model, GlobalCategoryModel) and user_id is not None \
+                and category is not None:
+            interval_offsets[k] = calibrations.get(user_id, category)
+        predicted[k] = prediction
+        timer.lap('predict', model_type)
+        
+        results[i] = {
+            'user_id': user_id,
+            'category': category,
+            'prediction': round(float(prediction), 2),
+            'confidence': round(float(confidence[k]), 2),
+            'next_month': next_month,
+            'model_type': model_type,
+            'features_used': features_used
+        }
+        if isinstance(model, MonthlyForecaster):
+            results[i]['granularity'] = 'month'
+            # Expenses between the training data and the ones sent are missing from the month totals
+            results[i]['partial_month'] = partial_month
+        elif isinstance(model, GlobalCategoryModel):
+            results[i]['cold_start'] = cold_start
+        if states[i] is not None:
+            results[i]['from_state'] = True
+    
+    # Calibrated intervals where the model has offsets, the spread of the amounts (monthly totals
+    # for monthly models) elsewhere
+    lower, upper, calibrated = interval_bounds(
+        predicted, np.array([o[0] if o is not None else np.nan for o in interval_offsets]),
+        np.array([o[1] if o is not None else np.nan for o in interval_offsets]), interval_std)
+    for k, j in enumerate(pending):
+        results[valid[j]].update({
+            'lower': round(float(lower[k]), 2),
+            'upper': round(float(upper[k]), 2),
+            'interval_level': INTERVAL_LEVEL,
+            'interval_method': CONFORMAL if calibrated[k] else SPREAD
+        })
+    timer.lap('interval')
+    
+    if horizon is not None:
+        # Groups served by the same model (shared category models, the statistical forecast) roll out together
+        by_model = {}
+        for k, j in enumerate(pending):
+            by_model.setdefault(id(models[j]), []).append(k)
+        for ks in by_model.values():
+            ks = np.array(ks)
+            counts = offsets[ks + 1] - offsets[ks]
+            rows = np.concatenate([np.arange(offsets[k], offsets[k + 1]) for k in ks])
+            periods, predictions, stderr = forecast_horizon(
+                models[pending[ks[0]]], {name: values[ks] for name, values in stats.items()},
+                np.concatenate(([0], np.cumsum(counts))), dates[rows], amounts[rows], horizon,
+                user_ids=[groups[valid[pending[k]]].get('user_id') for k in ks])
+            for n, k in enumerate(ks):
+                results[valid[pending[k]]]['horizon'] = horizon_steps(periods[n], predictions[n], stderr[n],
+                                                                      interval_offsets[k])
+        timer.lap('horizon')
+    
+    for j in pending:
+        if keys[j] is not None:
+            i = valid[j]
+            result_cache.put(keys[j], results[i], groups[i].get('user_id'), groups[i].get('category'))
+    
+    return results
+
+def count_predictions(results):
+    counts = {}
+    for result in results:
+        model_type = result.get('model_type', 'error')
+        counts[model_type] = counts.get(model_type, 0) + 1
+    for model_type, count in counts.items():
+        predictions_total.inc(request.endpoint, model_type, amount=count)
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    """Make a prediction using a saved model or statistical methods"""
+    start_time = time.time()
+    logger.info("Received prediction request")
+    
+    try:
+        series = None
+        if request.mimetype == wire.CONTENT_TYPE:
+            data, *series = wire.decode_expenses(request.get_data())
+            rows = len(series[2])
+        else:
+            data = request.json
+            rows = len(data.get('recent_expenses', []))
+        horizon = parse_horizon(data.get('horizon'))
+        logger.info(f"Predicting for user {data.get('user_id')}, category {data.get('category')} "
+                    f"with {rows} recent expenses")
+        
+        result = predict_groups([data], series, horizon)[0]
+        count_predictions([result])
+        del result['user_id'], result['category']
+        result['prediction_time'] = round(time.time() - start_time, 2)
         
         logger.info(f"Prediction complete in {round(time.time() - start_time, 2)} seconds")
+        if 'error' in result:
+            # 404: sent without expenses and no feature state to forecast from
+            return jsonify(result), 404 if rows == 0 else 500
         return jsonify(result)
         
+    except ValueError as e:
+        logger.warning(f"Rejecting prediction request: {str(e)}")
+        return jsonify({
+            'prediction': 0,
+            'confidence': 50.0,
+            'error': str(e),
+            'next_month': 'Error',
+            'prediction_time': round(time.time() - start_time, 2)
+        }), 400
     except Exception as e:
         logger.error(f"Error in prediction: {str(e)}", exc_info=True)
         return jsonify({
@@ -513,16 +1058,182 @@ def predict():
             'prediction_time': round(time.time() - start_time, 2)
         }), 500
 
-if __name__ == '__main__':
-    # Load scikit-learn in advance to speed up first prediction
-    from sklearn import ensemble, linear_model
-    logger.info("Pre-loading scikit-learn models")
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """Predict the next month for many (user_id, category) groups in one call"""
+    start_time = time.time()
+    
+    try:
+        series = None
+        if request.mimetype == wire.CONTENT_TYPE:
+            data, *series = wire.decode_expenses(request.get_data())
+        else:
+            data = request.json
+        groups = data.get('groups', [])
+        horizon = parse_horizon(data.get('horizon'))
+        logger.info(f"Received batch prediction request for {len(groups)} groups")
+        
+        results = predict_groups(groups, series, horizon)
+        count_predictions(results)
+        
+        logger.info(f"Batch prediction for {len(groups)} groups complete in {round(time.time() - start_time, 2)} seconds")
+        return jsonify({
+            'results': results,
+            'prediction_time': round(time.time() - start_time, 2)
+        })
+        
+    except ValueError as e:
+        logger.warning(f"Rejecting batch prediction request: {str(e)}")
+        return jsonify({
+            'results': [],
+            'error': str(e),
+            'prediction_time': round(time.time() - start_time, 2)
+        }), 400
+    except Exception as e:
+        logger.error(f"Error in batch prediction: {str(e)}", exc_info=True)
+        return jsonify({
+            'results': [],
+            'error': str(e),
+            'prediction_time': round(time.time() - start_time, 2)
+        }), 500
+
+def warmup_expenses(n=40):
+    """Deterministic synthetic expense history used to exercise the code paths"""
+    start = datetime(2024, 1, 1)
+    return [{'amount': str(round(50 + 10 * np.sin(i) + i, 2)),
+             'date': (start + timedelta(days=7 * i)).strftime('%Y-%m-%dT00:00:00.000Z')}
+            for i in range(n)]
+
+def recent_model_paths(limit):
+    """Saved model files served by /predict, most recently written first"""
+    paths = glob.glob(os.path.join(MODEL_DIR, 'compiled_*.npz'))
+    compiled = set(os.path.basename(path)[len('compiled_'):-len('.npz')] for path in paths)
+    # Pipelines are only loaded for models that have no compiled form
+    paths += [path for path in glob.glob(os.path.join(MODEL_DIR, 'model_*.joblib'))
+              if os.path.basename(path)[len('model_'):-len('.joblib')] not in compiled]
+    paths.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+    return paths[:limit]
+
+def preload_models(expenses, limit=WARMUP_PRELOAD):
+    """Load the most recently saved models into the cache. Returns how many were loaded"""
+    stats = grouped_next_period(*group_expenses([{'recent_expenses': expenses}]))
+    preloaded = 0
+    for path in recent_model_paths(limit):
+        try:
+            model = model_cache.get(path)
+            # Predict once so code imported lazily by the model is loaded too
+            if model is not None:
+                names = model_feature_names(model)
+                row = feature_matrix(stats, names)
+                if isinstance(model, (CompiledLinear, CompiledTrees)):
+                    model.predict(row)
+                else:
+                    import pandas as pd
+                    model.predict(pd.DataFrame(row, columns=list(names)))
+            preloaded += model is not None
+        except Exception as e:
+            logger.warning(f"Could not preload {path}: {str(e)}")
+    return preloaded
+
+def warmup(train_in_process=False):
+    """Run a synthetic train/predict through the service and preload recent models.
+
+    With train_in_process the synthetic training runs in this process instead
+    of the training pool, which loads sklearn here and starts no threads or
+    processes (needed before forking serving workers).
+    """
+    start_time = time.time()
+    expenses = warmup_expenses()
+    try:
+        job = None
+        if train_in_process:
+            from ml.training import train_expense_model
+            train_expense_model(expenses)
+        else:
+            # Not saved (no user/category), but starts a training worker and pays its imports
+            job, _ = training_jobs.submit(None, None, expenses)
+        predict_groups([{'recent_expenses': expenses}])
+        startup['preloaded_models'] = preload_models(expenses)
+        
+        if job is not None:
+            job = training_jobs.wait(job['job_id'], timeout=120)
+            if job['status'] != SUCCEEDED:
+                logger.warning(f"Warmup training job ended as {job['status']}: {job['error']}")
+    except Exception as e:
+        logger.error(f"Warmup failed: {str(e)}", exc_info=True)
     
-    # Preload some common models to speed up first prediction
-    _ = LinearRegression()
-    _ = Ridge()
-    _ = GradientBoostingRegressor(n_estimators=10)
+    startup['warmup_time'] = round(time.time() - start_time, 3)
+    mark_ready()
+
+def mark_ready():
+    startup['cold_start_time'] = round(time.time() - STARTED_AT, 3)
+    startup['ready'] = True
+    logger.info(f"Ready {startup['cold_start_time']}s after start "
+                f"(imports {startup['import_time']}s, warmup {startup['warmup_time']}s, "
+                f"{startup['preloaded_models']} models preloaded)")
+
+def start(mode=WARMUP_MODE, train_in_process=False):
+    """Run warmup according to ML_WARMUP; call once before serving requests"""
+    startup['import_time'] = round(time.time() - STARTED_AT, 3)
+    logger.info(f"Imports finished in {startup['import_time']}s")
+    if mode == 'sync':
+        warmup(train_in_process)
+    elif mode == 'background':
+        threading.Thread(target=warmup, name='warmup', daemon=True).start()
+    else:
+        mark_ready()
+
+def serve_prefork(host, port, workers):
+    """Serve from forked workers that share the models preloaded in this process"""
+    from ml.prefork import PreforkServer
+    import shutil
+    import tempfile
+    
+    # /jobs/<id> may reach any worker, so job status is shared through files
+    job_dir = os.environ.get('ML_JOB_DIR')
+    created_job_dir = job_dir is None
+    if created_job_dir:
+        job_dir = tempfile.mkdtemp(prefix='ml_jobs_')
+    os.makedirs(job_dir, exist_ok=True)
+    training_jobs.state_dir = job_dir
+    
+    def preload():
+        if not startup['ready']:
+            # Workers are forked right after, so warm up without threads
+            start('off' if WARMUP_MODE == 'off' else 'sync', train_in_process=True)
+        else:
+            startup['preloaded_models'] = preload_models(warmup_expenses())
+            logger.info(f"Reloaded {startup['preloaded_models']} models")
     
-    logger.info("Starting Flask server")
-    # Run the app with debug disabled in production
-    app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
+    server = PreforkServer(
+        app, host, port,
+        workers=workers,
+        max_requests=int(os.environ.get('ML_MAX_REQUESTS', 0)),
+        max_requests_jitter=int(os.environ.get('ML_MAX_REQUESTS_JITTER', 0)),
+        reload_interval=float(os.environ.get('ML_RELOAD_INTERVAL', 0)),
+        watch_dir=MODEL_DIR,
+        # Only the served models: /observe, fingerprints and the record files change on every request
+        watch_patterns=('model_*.joblib', 'compiled_*.npz', 'global_*.joblib', 'global_*.npz'),
+        graceful_timeout=float(os.environ.get('ML_GRACEFUL_TIMEOUT', 30)),
+        preload=preload,
+        # Let running training jobs finish and save their models
+        worker_exit=training_jobs.shutdown
+    )
+    try:
+        server.run()
+    finally:
+        if created_job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    port = int(os.environ.get('ML_PORT', 5000))
+    # More than one worker selects the prefork server (not available on Windows)
+    workers = int(os.environ.get('ML_WORKERS', 1))
+    if workers > 1 and hasattr(os, 'fork'):
+        serve_prefork('0.0.0.0', port, workers)
+    else:
+        start()
+        
+        logger.info("Starting Flask server")
+        # Run the app with debug disabled in production
+        app.run(host='0.0.0.0', port=port, debug=False)
@@ -2,11 +2,26 @@ const express = require('express');
 const router = express.Router();
 const pool = require('../db');
 const authMiddleware = require('../middleware/authMiddleware');
+const axios = require('axios');
+
+// Configuration for ML service
+const ML_SERVICE_URL = process.env.ML_SERVICE_URL || 'http://localhost:5000';
 
 // 🔐 Protect all routes with authentication
 router.use(authMiddleware);
 const sendSMS = require('../utils/sendSMS');
 
+// Editing or deleting a past expense makes the category's feature state in the ML
+// service stale; without it predictions use the recent expenses until the next /train
+function dropFeatureState(userId, category) {
+    axios.delete(`${ML_SERVICE_URL}/state`, {
+        data: { user_id: userId, category: category },
+        timeout: 5000
+    }).catch(mlErr => {
+        console.log('ML state reset skipped:', mlErr.response ? mlErr.response.status : mlErr.message);
+    });
+}
+
 // 🧾 GET expenses for logged-in user
 router.get('/', async (req, res) => {
     try {
@@ -36,9 +51,33 @@ router.post('/', async (req, res) => {
         
         console.log('Expense added successfully, ID:', result.rows[0].id);
         
-       
+        // Fold the expense into the category's model in the background
+        axios.post(`${ML_SERVICE_URL}/observe`, {
+            user_id: req.user.id,
+            category: category,
+            expenses: [{ amount: result.rows[0].amount, date: result.rows[0].date }]
+        }, { timeout: 5000 }).catch(mlErr => {
+            // 404: no model trained yet, 409: back-dated expense (picked up by the next /train)
+            console.log('ML observe skipped:', mlErr.response ? mlErr.response.status : mlErr.message);
+        });
         
-        res.status(201).json(result.rows[0]);
+        // Flag unusual spending against the category's recent expenses; the expense is saved either way
+        let anomaly = null;
+        try {
+            const mlResponse = await axios.post(`${ML_SERVICE_URL}/anomaly/score`, {
+                user_id: req.user.id,
+                category: category,
+                expenses: [{ id: result.rows[0].id, amount: result.rows[0].amount }]
+            }, { timeout: 1000 });
+            anomaly = mlResponse.data.scores[0];
+            if (anomaly.anomaly) {
+                console.log(`Unusual ${anomaly.direction} expense ${result.rows[0].id} (score ${anomaly.score})`);
+            }
+        } catch (mlErr) {
+            console.log('ML anomaly scoring skipped:', mlErr.response ? mlErr.response.status : mlErr.message);
+        }
+        
+        res.status(201).json({ ...result.rows[0], anomaly });
     } catch (err) {
         console.error('Error in POST /expenses:', err);
         res.status(500).send('Server Error');
@@ -52,7 +91,7 @@ router.delete('/:id', async (req, res) => {
     
     try {
         const result = await pool.query(
-            'DELETE FROM expenses WHERE id = $1 AND user_id = $2',
+            'DELETE FROM expenses WHERE id = $1 AND user_id = $2 RETURNING category',
             [id, req.user.id]
         );
         
@@ -62,6 +101,7 @@ router.delete('/:id', async (req, res) => {
         }
         
         console.log('Expense deleted successfully');
+        dropFeatureState(req.user.id, result.rows[0].category);
         res.status(204).send();
     } catch (err) {
         console.error('Error in DELETE /expenses/:id:', err.message);
@@ -76,7 +116,9 @@ router.put('/:id', async (req, res) => {
     
     try {
         const result = await pool.query(
-            'UPDATE expenses SET title = $1, amount = $2, category = $3, date = $4, note = $5 WHERE id = $6 AND user_id = $7 RETURNING *',
+            `UPDATE expenses e SET title = $1, amount = $2, category = $3, date = $4, note = $5
+             FROM expenses old WHERE e.id = old.id AND e.id = $6 AND e.user_id = $7
+             RETURNING e.*, old.category AS previous_category`,
             [title, amount, category, date, note, id, req.user.id]
         );
         
@@ -86,7 +128,12 @@ router.put('/:id', async (req, res) => {
         }
         
         console.log('Expense updated successfully');
-        res.json(result.rows[0]);
+        const { previous_category, ...expense } = result.rows[0];
+        dropFeatureState(req.user.id, previous_category);
+        if (expense.category !== previous_category) {
+            dropFeatureState(req.user.id, expense.category);
+        }
+        res.json(expense);
     } catch (err) {
         console.error('Error in PUT /expenses/:id:', err.message);
         res.status(500).send('Server Error');
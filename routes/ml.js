@@ -2,17 +2,94 @@ const express = require('express');
 const router = express.Router();
 const pool = require('../db');
 const authMiddleware = require('../middleware/authMiddleware');
+const adminMiddleware = require('../middleware/adminMiddleware');
 const axios = require('axios');
 const path = require('path');
 const fs = require('fs');
+const { Readable } = require('stream');
+const mlWire = require('../utils/mlWire');
 
 // Configuration for ML service
 const ML_SERVICE_URL = process.env.ML_SERVICE_URL || 'http://localhost:5000';
 
+// Expenses go to the ML service as binary columns ('columns') or as JSON/NDJSON ('json')
+const ML_WIRE_FORMAT = process.env.ML_WIRE_FORMAT || 'columns';
+
+// Body and headers of a request carrying expense rows in the configured wire format;
+// jsonPayload builds the { body, headers } sent when that format is 'json'
+function expensePayload(header, groups, jsonPayload) {
+  if (ML_WIRE_FORMAT === 'columns') {
+    return {
+      body: mlWire.encodeExpenses(header, groups),
+      headers: { 'Content-Type': mlWire.CONTENT_TYPE }
+    };
+  }
+  return jsonPayload();
+}
+
 // Cache for prediction results
 const CACHE_DURATION = 30 * 60 * 1000; // 30 minutes in milliseconds
 const predictionCache = {};
 
+// Training runs as a background job in the ML service; poll it until it finishes
+const TRAIN_WAIT_SECONDS = 25; // how long the ML service may hold the first request
+const TRAIN_POLL_INTERVAL = 1000; // 1 second
+const TRAIN_TIMEOUT = 5 * 60 * 1000; // 5 minutes
+
+async function waitForTrainingJob(job) {
+  const deadline = Date.now() + TRAIN_TIMEOUT;
+  while (job.status === 'pending' || job.status === 'running') {
+    if (Date.now() > deadline) {
+      throw new Error(`Training job ${job.job_id} did not finish in time`);
+    }
+    await new Promise(resolve => setTimeout(resolve, TRAIN_POLL_INTERVAL));
+    const response = await axios.get(`${ML_SERVICE_URL}/jobs/${job.job_id}`, {
+      timeout: 10000 // 10 second timeout
+    });
+    job = response.data;
+  }
+  if (job.status !== 'succeeded') {
+    throw new Error(job.error || `Training job ${job.status}`);
+  }
+  return job.result;
+}
+
+// Forecast from the feature state the ML service keeps per (user, category), or null
+// when it has none (never trained, or dropped after a past expense was edited)
+async function predictFromState(header) {
+  try {
+    const response = await axios.post(`${ML_SERVICE_URL}/predict`, header, {
+      timeout: 10000 // 10 second timeout
+    });
+    return response.data;
+  } catch (err) {
+    if (err.response && err.response.status === 404) {
+      return null;
+    }
+    throw err;
+  }
+}
+
+// If ML service is down or times out, return an error
+function mlUnavailable(res, mlErr) {
+  console.error('ML service error:', mlErr.message);
+  return res.status(503).json({
+    error: 'ML service unavailable',
+    message: 'The prediction service is currently unavailable. Please try again later.',
+    details: mlErr.message
+  });
+}
+
+// Training histories are streamed as NDJSON: a header line, then one expense per line
+function ndjsonStream(header, rows) {
+  return Readable.from((function* () {
+    yield JSON.stringify(header) + '\n';
+    for (const row of rows) {
+      yield JSON.stringify({ amount: row.amount, date: row.date }) + '\n';
+    }
+  })());
+}
+
 // Add detailed logging for requests
 router.use((req, res, next) => {
   console.log(`ML API Request: ${req.method} ${req.path}`);
@@ -32,12 +109,19 @@ router.get('/health', async (req, res) => {
     const startTime = Date.now();
     const response = await axios.get(`${ML_SERVICE_URL}/health`);
     const responseTime = Date.now() - startTime;
-    
+
+    // Liveness above; readiness (503 while the service is still warming up) separately
+    const ready = await axios.get(`${ML_SERVICE_URL}/ready`, {
+      validateStatus: () => true
+    });
+
     console.log(`ML service health check response time: ${responseTime}ms`);
     res.json({
       ml_service: 'healthy',
+      ml_service_ready: ready.status === 200,
       response_time_ms: responseTime,
-      ml_service_status: response.data
+      ml_service_status: response.data,
+      ml_service_startup: ready.data
     });
   } catch (err) {
     console.error('ML service health check failed:', err.message);
@@ -56,7 +140,7 @@ router.post('/train', async (req, res) => {
   try {
     const startTime = Date.now();
     const userId = req.user.id;
-    const { category } = req.body;
+    const { category, granularity } = req.body;
     
     if (!category) {
       return res.status(400).json({ error: 'Category is required' });
@@ -80,21 +164,27 @@ router.post('/train', async (req, res) => {
     }
     
     // Prepare data for ML service
-    const requestData = {
-      expenses: result.rows,
+    const header = {
       user_id: userId,
-      category: category
+      category: category,
+      granularity: granularity, // 'transaction' or 'month'; the ML service default when omitted
+      wait: TRAIN_WAIT_SECONDS
     };
     
     console.log('Sending training request to ML service');
     
     try {
       // Send request to ML service
-      const mlResponse = await axios.post(`${ML_SERVICE_URL}/train`, requestData, {
+      const payload = expensePayload(header, [{ rows: result.rows }], () => ({
+        body: ndjsonStream(header, result.rows),
+        headers: { 'Content-Type': 'application/x-ndjson' }
+      }));
+      const mlResponse = await axios.post(`${ML_SERVICE_URL}/train`, payload.body, {
+        headers: payload.headers,
         timeout: 30000 // 30 second timeout
       });
       
-      const modelData = mlResponse.data;
+      const modelData = await waitForTrainingJob(mlResponse.data);
       console.log('ML service training complete:', modelData);
       
       // Save model data to database
@@ -128,8 +218,13 @@ router.post('/train', async (req, res) => {
           console.log('Created new model in database');
         }
         
-        // Set cache
+        // Set cache (outlooks over several months are recomputed from the new model)
         const cacheKey = `${userId}_${category}`;
+        for (const key of Object.keys(predictionCache)) {
+          if (key.startsWith(`${cacheKey}_h`)) {
+            delete predictionCache[key];
+          }
+        }
         predictionCache[cacheKey] = {
           data: {
             success: true,
@@ -176,17 +271,92 @@ router.post('/train', async (req, res) => {
   }
 });
 
+// POST endpoint to train the model of a category shared by all users (admin only);
+// users without a model of their own are predicted with it
+router.post('/train-global', [authMiddleware, adminMiddleware], async (req, res) => {
+  try {
+    const { category } = req.body;
+
+    if (!category) {
+      return res.status(400).json({ error: 'Category is required' });
+    }
+
+    const result = await pool.query(
+      'SELECT user_id, amount, date FROM expenses WHERE category = $1 ORDER BY user_id, date',
+      [category]
+    );
+
+    // One group of rows per user, in user order
+    const groups = [];
+    for (const row of result.rows) {
+      const last = groups[groups.length - 1];
+      if (last && last.meta.user_id === row.user_id) {
+        last.rows.push(row);
+      } else {
+        groups.push({ meta: { user_id: row.user_id }, rows: [row] });
+      }
+    }
+    console.log(`Training global ${category} model on ${result.rows.length} expenses of ${groups.length} users`);
+
+    const header = { category: category, wait: TRAIN_WAIT_SECONDS };
+    const payload = expensePayload(header, groups, () => ({
+      body: {
+        ...header,
+        groups: groups.map(group => ({ user_id: group.meta.user_id, expenses: group.rows }))
+      },
+      headers: { 'Content-Type': 'application/json' }
+    }));
+
+    try {
+      const mlResponse = await axios.post(`${ML_SERVICE_URL}/train_global`, payload.body, {
+        headers: payload.headers,
+        timeout: 30000 // 30 second timeout
+      });
+      const modelData = await waitForTrainingJob(mlResponse.data);
+      if (modelData.error) {
+        return res.status(400).json({ error: 'Not enough data to train model', message: modelData.error });
+      }
+
+      res.json({
+        success: true,
+        message: 'Global model trained successfully',
+        category: category,
+        users: modelData.users,
+        rows: modelData.rows,
+        accuracy: modelData.accuracy,
+        model_type: modelData.model_type
+      });
+    } catch (mlErr) {
+      console.error('ML service error:', mlErr.message);
+      return res.status(503).json({
+        error: 'ML service unavailable',
+        message: 'The prediction service is currently unavailable. Please try again later.',
+        details: mlErr.message
+      });
+    }
+  } catch (err) {
+    console.error('Error in /ml/train-global:', err);
+    res.status(500).json({ error: 'Server error', details: err.message });
+  }
+});
+
 // GET endpoint to predict next month's expense for a category
 router.get('/predict/:category', async (req, res) => {
   try {
     const startTime = Date.now();
     const userId = req.user.id;
     const { category } = req.params;
+    // Optional number of months to forecast, each with an interval (?horizon=6)
+    const horizon = req.query.horizon !== undefined ? Number(req.query.horizon) : undefined;
+    
+    if (horizon !== undefined && !(Number.isInteger(horizon) && horizon >= 1 && horizon <= 12)) {
+      return res.status(400).json({ error: 'horizon must be a whole number of months from 1 to 12' });
+    }
     
     console.log(`Predicting expenses for user ${userId} and category ${category}`);
     
     // Check cache first
-    const cacheKey = `${userId}_${category}`;
+    const cacheKey = horizon !== undefined ? `${userId}_${category}_h${horizon}` : `${userId}_${category}`;
     if (predictionCache[cacheKey] && 
         (Date.now() - predictionCache[cacheKey].timestamp) < CACHE_DURATION) {
       console.log('Returning cached prediction');
@@ -215,26 +385,11 @@ router.get('/predict/:category', async (req, res) => {
     
     const model = modelResult.rows[0];
     
-    // Get recent expenses for this category
-    const expensesResult = await pool.query(
-      'SELECT amount, date FROM expenses WHERE user_id = $1 AND category = $2 ORDER BY date DESC LIMIT 5',
-      [userId, category]
-    );
-    
-    console.log(`Found ${expensesResult.rows.length} recent expenses`);
-    
-    if (expensesResult.rows.length === 0) {
-      return res.status(404).json({ 
-        error: 'No expenses found', 
-        message: 'No recent expenses found for this category' 
-      });
-    }
-    
     // Prepare data for ML service
-    const requestData = {
-      recent_expenses: expensesResult.rows,
+    const header = {
       user_id: userId,
       category: category,
+      horizon: horizon,
       model_info: {
         max_amount: model.max_amount,
         categories: model.categories,
@@ -244,38 +399,177 @@ router.get('/predict/:category', async (req, res) => {
     
     console.log('Sending prediction request to ML service');
     
+    // The ML service keeps a feature state per category, seeded by /train and updated as
+    // expenses are added, so the recent expenses are only fetched when it has none
+    let predictionData;
     try {
-      // Send request to ML service with timeout
-      const mlResponse = await axios.post(`${ML_SERVICE_URL}/predict`, requestData, {
-        timeout: 10000 // 10 second timeout
-      });
+      predictionData = await predictFromState(header);
+    } catch (mlErr) {
+      return mlUnavailable(res, mlErr);
+    }
+    
+    if (!predictionData) {
+      // Get recent expenses for this category
+      const expensesResult = await pool.query(
+        'SELECT amount, date FROM expenses WHERE user_id = $1 AND category = $2 ORDER BY date DESC LIMIT 5',
+        [userId, category]
+      );
       
-      const predictionData = mlResponse.data;
-      console.log('ML service prediction complete:', predictionData);
+      console.log(`No feature state, found ${expensesResult.rows.length} recent expenses`);
       
-      // Prepare response
-      const responseData = {
+      if (expensesResult.rows.length === 0) {
+        return res.status(404).json({ 
+          error: 'No expenses found', 
+          message: 'No recent expenses found for this category' 
+        });
+      }
+      
+      try {
+        // Send request to ML service with timeout
+        const requestData = { ...header, recent_expenses: expensesResult.rows };
+        const payload = expensePayload(header, [{ rows: expensesResult.rows }], () => ({ body: requestData, headers: {} }));
+        const mlResponse = await axios.post(`${ML_SERVICE_URL}/predict`, payload.body, {
+          headers: payload.headers,
+          timeout: 10000 // 10 second timeout
+        });
+        predictionData = mlResponse.data;
+      } catch (mlErr) {
+        return mlUnavailable(res, mlErr);
+      }
+    }
+    
+    console.log('ML service prediction complete:', predictionData);
+    
+    // Prepare response
+    const responseData = {
+      success: true,
+      prediction: predictionData.prediction,
+      confidence: predictionData.confidence,
+      lower: predictionData.lower,
+      upper: predictionData.upper,
+      interval_level: predictionData.interval_level,
+      interval_method: predictionData.interval_method,
+      granularity: predictionData.granularity,
+      partial_month: predictionData.partial_month,
+      category: category,
+      next_month: predictionData.next_month,
+      model_type: predictionData.model_type || 'ml_model',
+      features_used: predictionData.features_used || ['amount'],
+      processing_time_ms: Date.now() - startTime
+    };
+    if (predictionData.horizon) {
+      responseData.horizon = predictionData.horizon;
+    }
+    
+    // Cache the result
+    predictionCache[cacheKey] = {
+      data: responseData,
+      timestamp: Date.now()
+    };
+    
+    res.json(responseData);
+  } catch (err) {
+    console.error('Error in /ml/predict:', err);
+    res.status(500).json({ error: 'Server error', details: err.message });
+  }
+});
+
+// GET endpoint to predict next month's expense for every trained category in one ML call
+router.get('/predict-all', async (req, res) => {
+  try {
+    const startTime = Date.now();
+    const userId = req.user.id;
+
+    console.log(`Predicting expenses for all categories of user ${userId}`);
+
+    // Categories this user has trained models for
+    const modelResult = await pool.query(
+      'SELECT model_type FROM ml_models WHERE user_id = $1',
+      [userId]
+    );
+    const categories = modelResult.rows.map(row => row.model_type);
+
+    if (categories.length === 0) {
+      return res.status(404).json({
+        error: 'Model not found',
+        message: 'You need to train a model for at least one category first'
+      });
+    }
+
+    // Last 5 expenses of every category in a single query
+    const expensesResult = await pool.query(
+      `SELECT category, amount, date FROM (
+         SELECT category, amount, date,
+                ROW_NUMBER() OVER (PARTITION BY category ORDER BY date DESC) AS rn
+         FROM expenses WHERE user_id = $1 AND category = ANY($2)
+       ) recent WHERE rn <= 5`,
+      [userId, categories]
+    );
+
+    const recentByCategory = {};
+    for (const row of expensesResult.rows) {
+      (recentByCategory[row.category] = recentByCategory[row.category] || []).push({
+        amount: row.amount,
+        date: row.date
+      });
+    }
+
+    const requestData = {
+      groups: categories
+        .filter(category => recentByCategory[category])
+        .map(category => ({
+          user_id: userId,
+          category: category,
+          recent_expenses: recentByCategory[category]
+        }))
+    };
+
+    console.log(`Sending batch prediction request for ${requestData.groups.length} categories to ML service`);
+
+    try {
+      const payload = expensePayload({}, requestData.groups.map(({ recent_expenses, ...meta }) => ({
+        meta: meta,
+        rows: recent_expenses
+      })), () => ({ body: requestData, headers: {} }));
+      const mlResponse = await axios.post(`${ML_SERVICE_URL}/predict_batch`, payload.body, {
+        headers: payload.headers,
+        timeout: 10000 // 10 second timeout
+      });
+
+      const predictions = mlResponse.data.results.map(predictionData => {
+        const responseData = {
+          success: !predictionData.error,
+          prediction: predictionData.prediction,
+          confidence: predictionData.confidence,
+          lower: predictionData.lower,
+          upper: predictionData.upper,
+          interval_level: predictionData.interval_level,
+          interval_method: predictionData.interval_method,
+          granularity: predictionData.granularity,
+          partial_month: predictionData.partial_month,
+          category: predictionData.category,
+          next_month: predictionData.next_month,
+          model_type: predictionData.model_type || 'ml_model',
+          features_used: predictionData.features_used || ['amount']
+        };
+
+        if (!predictionData.error) {
+          predictionCache[`${userId}_${predictionData.category}`] = {
+            data: responseData,
+            timestamp: Date.now()
+          };
+        }
+        return responseData;
+      });
+
+      res.json({
         success: true,
-        prediction: predictionData.prediction,
-        confidence: predictionData.confidence,
-        category: category,
-        next_month: predictionData.next_month,
-        model_type: predictionData.model_type || 'ml_model',
-        features_used: predictionData.features_used || ['amount'],
+        predictions: predictions,
         processing_time_ms: Date.now() - startTime
-      };
-      
-      // Cache the result
-      predictionCache[cacheKey] = {
-        data: responseData,
-        timestamp: Date.now()
-      };
-      
-      res.json(responseData);
+      });
     } catch (mlErr) {
       console.error('ML service error:', mlErr.message);
-      
-      // If ML service is down or times out, return an error
+
       return res.status(503).json({
         error: 'ML service unavailable',
         message: 'The prediction service is currently unavailable. Please try again later.',
@@ -283,7 +577,7 @@ router.get('/predict/:category', async (req, res) => {
       });
     }
   } catch (err) {
-    console.error('Error in /ml/predict:', err);
+    console.error('Error in /ml/predict-all:', err);
     res.status(500).json({ error: 'Server error', details: err.message });
   }
 });
@@ -361,4 +655,30 @@ router.post('/clear-cache', (req, res) => {
   });
 });
 
+// POST endpoint to compact the ML service's model storage (admin only): models and states of
+// (user, category) pairs without expenses are removed, and models over the disk budgets evicted
+router.post('/compact-storage', [authMiddleware, adminMiddleware], async (req, res) => {
+  try {
+    const result = await pool.query('SELECT DISTINCT user_id, category FROM expenses');
+    const keys = result.rows.map(row => [row.user_id, row.category]);
+
+    try {
+      const mlResponse = await axios.post(`${ML_SERVICE_URL}/storage/compact`, {
+        keys: keys,
+        dry_run: Boolean(req.body && req.body.dry_run)
+      }, { timeout: 60000 });
+      console.log(`Compacted ML storage: reclaimed ${mlResponse.data.reclaimed_bytes} bytes`);
+      res.json({ success: true, ...mlResponse.data });
+    } catch (mlErr) {
+      if (mlErr.response && mlErr.response.status === 409) {
+        return res.status(409).json({ error: 'Compaction already running', message: mlErr.response.data.error });
+      }
+      return mlUnavailable(res, mlErr);
+    }
+  } catch (err) {
+    console.error('Error in /ml/compact-storage:', err);
+    res.status(500).json({ error: 'Server error', details: err.message });
+  }
+});
+
 module.exports = router;
\ No newline at end of file
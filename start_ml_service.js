@@ -1,12 +1,20 @@
 const { spawn } = require('child_process');
 const path = require('path');
 const fs = require('fs');
+const os = require('os');
 
 // Configuration
 const PYTHON_PATH = 'python'; // Change to 'python3' for Unix/Linux
 const SERVICE_SCRIPT = path.join(__dirname, 'ml_service.py');
 const LOG_FILE = path.join(__dirname, 'ml_service.log');
 
+// In production the service forks one worker per core (prefork mode); each
+// worker is recycled after ML_MAX_REQUESTS requests
+const ML_WORKERS = process.env.ML_WORKERS ||
+  (process.env.NODE_ENV === 'production' ? String(os.cpus().length) : '1');
+const ML_MAX_REQUESTS = process.env.ML_MAX_REQUESTS || '10000';
+const ML_MAX_REQUESTS_JITTER = process.env.ML_MAX_REQUESTS_JITTER || '1000';
+
 // Create log directory if it doesn't exist
 const logDir = path.dirname(LOG_FILE);
 if (!fs.existsSync(logDir)) {
@@ -15,9 +23,17 @@ if (!fs.existsSync(logDir)) {
 
 console.log(`Starting ML service: ${SERVICE_SCRIPT}`);
 console.log(`Logs will be written to: ${LOG_FILE}`);
+console.log(`ML service workers: ${ML_WORKERS}`);
 
 // Start the Python process
-const pythonProcess = spawn(PYTHON_PATH, [SERVICE_SCRIPT]);
+const pythonProcess = spawn(PYTHON_PATH, [SERVICE_SCRIPT], {
+  env: {
+    ...process.env,
+    ML_WORKERS,
+    ML_MAX_REQUESTS,
+    ML_MAX_REQUESTS_JITTER
+  }
+});
 
 // Create a log file stream
 const logStream = fs.createWriteStream(LOG_FILE, { flags: 'a' });
@@ -40,6 +56,12 @@ pythonProcess.on('close', (code) => {
   console.log(`ML service exited with code ${code}`);
 });
 
+// Graceful reload: preload models again and replace the workers
+process.on('SIGHUP', () => {
+  console.log('Reloading ML service...');
+  pythonProcess.kill('SIGHUP');
+});
+
 // Keep the script running
 process.on('SIGINT', () => {
   console.log('Stopping ML service...');
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The ml package is imported from the repository root, as ml_service.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
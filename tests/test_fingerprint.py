@@ -0,0 +1,50 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from ml.fingerprint import APPENDED, CHANGED, UNCHANGED, FingerprintStore, history_fingerprint
+from ml.storage import ModelStorage
+
+
+def history(n):
+    dates = np.datetime64('2024-01-01') + np.arange(n).astype('timedelta64[D]')
+    return dates, np.arange(n, dtype=np.float64) + 10
+
+
+def store(tmp_path):
+    store = FingerprintStore(ModelStorage(str(tmp_path)))
+    store.path = lambda user_id, category: os.path.join(str(tmp_path), f'fingerprint_{user_id}_{category}.json')
+    return store
+
+
+def test_check_compares_with_the_saved_history(tmp_path):
+    fingerprints = store(tmp_path)
+    dates, amounts = history(100)
+    options = {'granularity': 'transaction'}
+    assert fingerprints.check(1, 'Food', dates, amounts, options)[0] == CHANGED
+
+    fingerprints.save(1, 'Food', history_fingerprint(dates, amounts, options), {'prediction': 1.0}, None, True)
+    assert fingerprints.check(1, 'Food', dates, amounts, options)[0] == UNCHANGED
+    assert fingerprints.check(1, 'Food', *history(105), options)[0] == APPENDED
+    assert fingerprints.check(1, 'Food', *history(200), options)[0] == CHANGED
+    assert fingerprints.check(1, 'Food', dates, amounts, {'granularity': 'month'})[0] == CHANGED
+
+
+def test_concurrent_saves_publish_whole_sidecars(tmp_path):
+    fingerprints = store(tmp_path)
+
+    def save(i):
+        for _ in range(20):
+            fingerprints.save(1, 'Food', {'rows': i}, {'payload': 'x' * 10000 * i}, None, True)
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(1, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(fingerprints.path(1, 'Food')) as f:
+        record = json.load(f)
+    assert len(record['result']['payload']) == 10000 * record['fingerprint']['rows']
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
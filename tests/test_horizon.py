@@ -0,0 +1,35 @@
+import numpy as np
+
+from ml.horizon import LAGS, linear_rollout, recursive_rollout
+
+
+def test_linear_rollout_matches_recursive_rollout():
+    rng = np.random.default_rng(0)
+    groups, horizon = 5, 12
+    names = ['month', 'prev_amount', 'trend', 'rolling_mean_3']
+    weights = np.array([0.8, 0.45, 3.0, 0.3])
+    bias = 12.0
+    exog = {'month': rng.integers(1, 13, (groups, horizon)).astype(float),
+            'trend': rng.uniform(1, 2, (groups, horizon))}
+    tail = rng.uniform(10, 100, (groups, LAGS))
+
+    def predict(step, prev_amount, rolling_mean):
+        return (bias + weights[0] * exog['month'][:, step] + weights[1] * prev_amount
+                + weights[2] * exog['trend'][:, step] + weights[3] * rolling_mean)
+
+    predictions, psi = linear_rollout(weights, bias, names, exog, tail)
+    np.testing.assert_allclose(predictions, recursive_rollout(predict, horizon, tail), rtol=1e-10)
+
+    # psi is the response of later steps to a unit change of the first one
+    def shifted(step, prev_amount, rolling_mean):
+        return predict(step, prev_amount, rolling_mean) + (step == 0)
+
+    response = recursive_rollout(shifted, horizon, tail) - recursive_rollout(predict, horizon, tail)
+    np.testing.assert_allclose(response, np.tile(psi, (groups, 1)), atol=1e-10)
+
+
+def test_linear_rollout_without_lag_features():
+    exog = {'month': np.array([[1.0, 2.0, 3.0]])}
+    predictions, psi = linear_rollout(np.array([2.0]), 1.0, ['month'], exog, np.full((1, LAGS), 50.0))
+    assert predictions.tolist() == [[3.0, 5.0, 7.0]]
+    assert psi.tolist() == [1.0, 0.0, 0.0]
@@ -0,0 +1,68 @@
+import os
+import signal
+import time
+from datetime import date, timedelta
+
+import pytest
+
+from ml.jobs import TrainingJobQueue, FAILED, RUNNING, SUCCEEDED
+
+
+def expenses(n=40):
+    start = date(2024, 1, 1)
+    return [{'amount': 20 + (i % 7) * 3.5, 'date': (start + timedelta(days=3 * i)).isoformat()} for i in range(n)]
+
+
+@pytest.fixture
+def queue():
+    queue = TrainingJobQueue(max_workers=1)
+    yield queue
+    queue.shutdown(wait=False)
+
+
+def kill_workers(queue):
+    for process in list(queue._executor._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+
+
+def test_submit_to_broken_pool_starts_a_new_one(queue):
+    broken = queue._get_executor()
+    with pytest.raises(Exception):
+        broken.submit(os._exit, 1).result(timeout=60)
+
+    job, created = queue.submit(1, 'Food', expenses())
+    assert created
+    job = queue.wait(job['job_id'], 120)
+    assert job['status'] == SUCCEEDED
+    assert queue._executor is not broken
+
+
+def test_dead_worker_fails_its_job_and_frees_the_key(queue):
+    job, _ = queue.submit(1, 'Food', expenses())
+    assert job['status'] == RUNNING
+    deadline = time.time() + 60
+    while not queue._executor._processes and time.time() < deadline:
+        time.sleep(0.05)
+    kill_workers(queue)
+
+    job = queue.wait(job['job_id'], 60)
+    assert job['status'] == FAILED
+    assert job['error']
+
+    retry, created = queue.submit(1, 'Food', expenses())
+    assert created
+    assert retry['job_id'] != job['job_id']
+    assert queue.wait(retry['job_id'], 120)['status'] == SUCCEEDED
+
+
+def test_submit_error_fails_the_job(queue, monkeypatch):
+    def broken_submit(job_id):
+        queue._inputs.pop(job_id)
+        raise RuntimeError('no workers')
+
+    monkeypatch.setattr(queue, '_submit_job', broken_submit)
+    job, created = queue.submit(1, 'Food', expenses())
+    assert created
+    assert job['status'] == FAILED
+    assert 'no workers' in job['error']
+    assert (1, 'Food') not in queue._active
@@ -0,0 +1,31 @@
+import numpy as np
+
+from ml.monthly import MonthlyForecaster, monthly_totals
+
+
+class MeanOfLags:
+    def predict(self, frame):
+        return frame['rolling_total_3'].to_numpy()
+
+
+def forecaster(dates, amounts):
+    dates = np.array(dates, dtype='datetime64[D]')
+    amounts = np.array(amounts, dtype=np.float64)
+    return MonthlyForecaster(MeanOfLags(), monthly_totals(dates, amounts), dates[-1])
+
+
+def test_spread_is_of_monthly_totals():
+    model = forecaster(['2024-01-05', '2024-01-20', '2024-02-03', '2024-03-10', '2024-03-11'],
+                       [10.0, 30.0, 100.0, 50.0, 70.0])
+    assert model.spread() == np.std([40.0, 100.0, 120.0])
+
+    # Expenses after the training data are folded into their month first
+    assert model.spread(np.array(['2024-03-20'], dtype='datetime64[D]'), np.array([60.0])) == \
+        np.std([40.0, 100.0, 180.0])
+
+
+def test_covers_needs_expenses_reaching_back_to_training():
+    model = forecaster(['2024-01-05', '2024-02-03', '2024-03-10'], [10.0, 20.0, 30.0])
+    assert not model.covers()
+    assert not model.covers(np.array(['2024-03-15', '2024-03-20'], dtype='datetime64[D]'))
+    assert model.covers(np.array(['2024-03-10', '2024-03-20'], dtype='datetime64[D]'))
@@ -0,0 +1,33 @@
+import threading
+
+from ml.prefork import PreforkServer, _RequestCounter
+
+
+def test_watch_signature_only_sees_watched_files(tmp_path):
+    server = PreforkServer(None, watch_dir=str(tmp_path), watch_patterns=('model_*.joblib',))
+    (tmp_path / 'model_1_Food.joblib').write_bytes(b'a')
+    signature = server._watch_signature()
+    assert signature[1] == 1
+
+    (tmp_path / 'online_1_Food.joblib').write_bytes(b'b')
+    (tmp_path / 'model_1_Food.joblib.1.2.tmp').write_bytes(b'c')
+    (tmp_path / 'anomaly_states.registry').write_bytes(b'd')
+    assert server._watch_signature() == signature
+
+    (tmp_path / 'model_2_Food.joblib').write_bytes(b'e')
+    assert server._watch_signature() != signature
+
+
+def test_request_counter_counts_concurrent_requests():
+    counter = _RequestCounter(lambda environ, start_response: None)
+
+    def handle():
+        for _ in range(1000):
+            counter({}, None)
+
+    threads = [threading.Thread(target=handle) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.count == 8000
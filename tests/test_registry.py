@@ -0,0 +1,91 @@
+import os
+import threading
+
+import numpy as np
+
+from ml.anomaly import AnomalyStore
+from ml.registry import (ModelRegistry, StandardizedLinearModel, HEADER, HEADER_SIZE, MAGIC_V1, RECORD_V1,
+                         INITIAL_CAPACITY)
+
+
+def linear_model(offset=0.0):
+    return StandardizedLinearModel(['month', 'prev_amount'], [3.0, 6.0], [2.0, 3.5], [1.5, -0.5], 20.0 + offset)
+
+
+def test_put_get_delete(tmp_path):
+    registry = ModelRegistry(str(tmp_path / 'models.registry'))
+    assert registry.get(1, 'Food') is None
+    assert registry.put(1, 'Self Development', linear_model())
+    assert not registry.put('guest', 'Food', linear_model())
+
+    model = registry.get(1, 'Self Development')
+    X = np.array([[1.0, 2.0], [5.0, 12.0]])
+    np.testing.assert_allclose(model.predict(X), linear_model().predict(X))
+    assert list(model.feature_names_in_) == ['month', 'prev_amount']
+    assert registry.keys() == [(1, 'Self_Development')]
+
+    assert registry.delete(1, 'Self Development')
+    assert not registry.delete(1, 'Self Development')
+    assert registry.get(1, 'Self Development') is None
+    assert registry.saved_times() == {}
+
+
+def test_other_processes_see_new_records(tmp_path):
+    path = str(tmp_path / 'models.registry')
+    writer, reader = ModelRegistry(path), ModelRegistry(path)
+    for user_id in range(INITIAL_CAPACITY + 10):
+        writer.put(user_id, 'Food', linear_model(user_id))
+    assert reader.get(INITIAL_CAPACITY + 5, 'Food').intercept_ == 20.0 + INITIAL_CAPACITY + 5
+
+    writer.put(7, 'Food', linear_model(100))
+    assert reader.get(7, 'Food').intercept_ == 120.0
+    assert reader.usage()['records'] == INITIAL_CAPACITY + 10
+
+
+def test_saved_times(tmp_path):
+    registry = ModelRegistry(str(tmp_path / 'models.registry'))
+    registry.put(1, 'Food', linear_model())
+    registry.put(2, 'Food', linear_model())
+    saved = registry.saved_times()
+    assert sorted(saved) == [(1, 'Food'), (2, 'Food')]
+    assert saved[(1, 'Food')] <= saved[(2, 'Food')]
+
+
+def test_first_version_files_are_upgraded(tmp_path):
+    path = str(tmp_path / 'models.registry')
+    header = np.zeros(1, dtype=HEADER)
+    header['magic'] = MAGIC_V1
+    header['record_size'] = RECORD_V1.itemsize
+    header['capacity'] = 4
+    header['count'] = 1
+    records = np.zeros(4, dtype=RECORD_V1)
+    records[0]['used'] = 1
+    records[0]['version'] = 2
+    records[0]['n_features'] = 1
+    records[0]['user_id'] = 5
+    records[0]['category'] = b'Food'
+    records[0]['scale'][0] = 1.0
+    records[0]['intercept'] = 42.0
+    with open(path, 'wb') as f:
+        f.write(header.tobytes().ljust(HEADER_SIZE, b'\0'))
+        f.write(records.tobytes())
+    os.utime(path, (1000.0, 1000.0))
+
+    registry = ModelRegistry(path)
+    assert registry.get(5, 'Food').intercept_ == 42.0
+    assert registry.saved_times() == {(5, 'Food'): 1000.0}
+
+
+def test_concurrent_updates_are_not_lost(tmp_path):
+    store = AnomalyStore(str(tmp_path / 'anomaly.registry'))
+
+    def score():
+        for _ in range(50):
+            store.score(1, 'Food', [10.0])
+
+    threads = [threading.Thread(target=score) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.score(1, 'Food', [10.0], update=False)[0]['observations'] == 200
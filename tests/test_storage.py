@@ -0,0 +1,127 @@
+import os
+import time
+
+import pytest
+
+from ml.storage import ModelStorage, model_filename
+
+
+def write_key(directory, user_id, category, size=100, last_use=None, prefixes=(('model', 'joblib'),)):
+    for prefix, ext in prefixes:
+        path = os.path.join(directory, model_filename(user_id, category, prefix, ext))
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if last_use is not None:
+            os.utime(path, (last_use, last_use))
+
+
+def stored(directory):
+    return sorted(name for name in os.listdir(directory) if not name.startswith('storage.'))
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    directory = tmp_path / 'saved_models'
+    directory.mkdir()
+    return str(directory)
+
+
+def test_legacy_models_are_kept_by_default(tmp_path, model_dir):
+    legacy = tmp_path / 'models'
+    legacy.mkdir()
+    (legacy / 'Food.joblib').write_bytes(b'old')
+
+    ModelStorage(model_dir).compact()
+    assert os.listdir(legacy) == ['Food.joblib']
+
+    report = ModelStorage(model_dir, legacy_dir=str(legacy)).compact()
+    assert report['removed']['legacy'] == 1
+    assert os.listdir(legacy) == []
+
+
+def test_max_models_evicts_least_recently_used(model_dir):
+    now = time.time()
+    write_key(model_dir, 1, 'Food', last_use=now - 300)
+    write_key(model_dir, 2, 'Food', last_use=now - 100)
+    write_key(model_dir, 3, 'Food', last_use=now - 200)
+    evicted = []
+    storage = ModelStorage(model_dir, max_models=2, on_remove=lambda *args: evicted.append(args))
+
+    report = storage.compact()
+    assert report['removed']['evicted_keys'] == 1
+    assert evicted == [('1', 'Food', False)]
+    assert stored(model_dir) == [model_filename(2, 'Food'), model_filename(3, 'Food')]
+
+
+def test_max_bytes_drops_versions_before_keys(model_dir):
+    storage = ModelStorage(model_dir, keep_versions=2, max_bytes=250)
+    path = os.path.join(model_dir, model_filename(1, 'Food'))
+    for content in (b'a' * 100, b'b' * 100, b'c' * 100):
+        storage.write(path, lambda tmp_path: open(tmp_path, 'wb').write(content), versioned=True)
+        time.sleep(0.01)
+    assert len(storage.versions(path)) == 2
+
+    report = storage.compact()
+    assert report['removed']['versions'] == 1
+    assert report['removed']['evicted_keys'] == 0
+    assert len(storage.versions(path)) == 1
+    with open(path, 'rb') as f:
+        assert f.read() == b'c' * 100
+
+
+def test_dry_run_removes_nothing(model_dir):
+    write_key(model_dir, 1, 'Food')
+    write_key(model_dir, 2, 'Food')
+    before = stored(model_dir)
+
+    report = ModelStorage(model_dir, max_models=1).compact(dry_run=True)
+    assert report['removed']['evicted_keys'] == 1
+    assert stored(model_dir) == before
+
+
+def test_deleted_keys_are_removed_with_their_records(model_dir):
+    write_key(model_dir, 1, 'Food', prefixes=(('model', 'joblib'), ('compiled', 'npz')))
+    write_key(model_dir, 2, 'Food')
+    removed = []
+    storage = ModelStorage(model_dir, on_remove=lambda *args: removed.append(args),
+                           record_keys=lambda: [(3, 'Rent')])
+
+    report = storage.compact(live_keys=[(2, 'Food')])
+    assert report['removed']['deleted_keys'] == 2
+    assert sorted(removed) == [('1', 'Food', True), ('3', 'Rent', True)]
+    assert stored(model_dir) == [model_filename(2, 'Food')]
+
+
+def test_temporary_and_orphan_files(model_dir):
+    write_key(model_dir, 1, 'Food', prefixes=(('compiled', 'npz'),))
+    tmp_path = os.path.join(model_dir, model_filename(2, 'Food') + '.1.1.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(b'partial')
+    os.utime(tmp_path, (time.time() - 7200, time.time() - 7200))
+
+    report = ModelStorage(model_dir).compact()
+    assert report['removed']['temporary'] == 1
+    assert report['removed']['orphan_compiled'] == 1
+    assert stored(model_dir) == []
+
+
+def test_record_models_count_towards_max_models(model_dir):
+    now = time.time()
+    write_key(model_dir, 1, 'Food', last_use=now - 100)
+    write_key(model_dir, 2, 'Food', last_use=now - 300)
+    records = {(3, 'Rent'): now - 400, (4, 'Rent'): now - 50}
+    evicted = []
+
+    def on_remove(user_id, category, deleted):
+        evicted.append((user_id, category))
+        records.pop((int(user_id), category), None)
+
+    storage = ModelStorage(model_dir, max_models=2, on_remove=on_remove, record_models=lambda: dict(records))
+    assert storage.usage()['models'] == 4
+
+    report = storage.compact()
+    assert report['removed']['evicted_keys'] == 2
+    assert report['models'] == 2
+    assert evicted == [('3', 'Rent'), ('2', 'Food')]
+    assert stored(model_dir) == [model_filename(1, 'Food')]
+    assert list(records) == [(4, 'Rent')]
@@ -0,0 +1,76 @@
+import json
+
+import numpy as np
+import pytest
+
+from ml.wire import MAGIC, PREFIX, FrameError, decode, decode_expenses, encode, encode_expenses
+
+
+def frame(header, data=b''):
+    """A frame with a hand-written header, as a broken client could send it"""
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+    return PREFIX.pack(MAGIC, len(header_bytes), 0) + header_bytes + data
+
+
+COLUMNS = [['amount', '<f8', 1], ['date', '<i8', 1]]
+ROW = np.array([5.0]).tobytes() + np.array([19000]).tobytes()
+
+
+def test_expenses_round_trip():
+    dates = ['2024-01-03', '2024-02-10', '2024-03-01']
+    amounts = [12.5, 40.0, 7.25]
+    header, offsets, decoded_dates, decoded_amounts = decode_expenses(
+        encode_expenses({'user_id': 4, 'category': 'Food'}, dates, amounts))
+
+    assert header == {'user_id': 4, 'category': 'Food'}
+    assert offsets.tolist() == [0, 3]
+    assert decoded_dates.tolist() == np.array(dates, dtype='datetime64[D]').tolist()
+    assert decoded_amounts.tolist() == amounts
+
+
+def test_groups_are_sorted_by_date_separately():
+    dates = ['2024-03-01', '2024-01-01', '2024-02-01', '2023-12-01', '2024-05-01']
+    amounts = [3.0, 1.0, 2.0, 10.0, 20.0]
+    groups = [{'user_id': 1, 'rows': 3}, {'user_id': 2, 'rows': 0}, {'user_id': 3, 'rows': 2}]
+    header, offsets, decoded_dates, decoded_amounts = decode_expenses(encode_expenses({}, dates, amounts, groups))
+
+    assert header['groups'] == groups
+    assert offsets.tolist() == [0, 3, 3, 5]
+    assert decoded_amounts.tolist() == [1.0, 2.0, 3.0, 10.0, 20.0]
+    assert str(decoded_dates[0]) == '2024-01-01'
+
+
+def test_columns_are_aligned_views():
+    body = encode({'name': 'x' * 5}, {'a': np.arange(3, dtype='<i4'), 'b': np.array([1.5, 2.5])})
+    assert len(body) % 8 == 0
+    header, columns = decode(body)
+    assert header == {'name': 'xxxxx'}
+    assert columns['a'].tolist() == [0, 1, 2]
+    assert columns['b'].tolist() == [1.5, 2.5]
+    assert not columns['b'].flags.writeable
+
+
+@pytest.mark.parametrize('body', [
+    b'short',
+    b'NOTFRAME' + b'\0' * 8,
+    encode_expenses({}, ['2024-01-01'], [1.0])[:-4],
+    encode({}, {'amount': np.array([1.0])}),
+    encode_expenses({}, ['2024-01-01'], [1.0], groups=[{'rows': 2}]),
+    frame({'columns': COLUMNS, 'groups': ['x']}, ROW),
+    frame({'columns': COLUMNS, 'groups': {'rows': 1}}, ROW),
+    frame({'columns': COLUMNS, 'groups': [{'rows': -1}, {'rows': 2}]}, ROW),
+    frame({'columns': COLUMNS, 'groups': [{'rows': '1'}]}, ROW),
+    frame({'columns': [['amount', '<f8', -1], ['date', '<i8', 1]]}, ROW),
+    frame({'columns': [['amount', '<f8', 1.5], ['date', '<i8', 1]]}, ROW),
+    frame({'columns': [['amount', '<f8', 2 ** 40], ['date', '<i8', 1]]}, ROW),
+    frame({'columns': [['amount', 'no such dtype', 1], ['date', '<i8', 1]]}, ROW),
+    frame({'columns': [['amount', 'S8', 1], ['date', '<i8', 1]]}, b'notanum!' + ROW[8:]),
+    frame({'columns': [['amount']]}, ROW),
+    frame({'columns': 'amount'}, ROW),
+    frame([COLUMNS], ROW),
+    frame({'columns': COLUMNS}, ROW[:12]),
+])
+def test_malformed_frames(body):
+    with pytest.raises(FrameError):
+        decode_expenses(body)
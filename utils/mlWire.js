@@ -0,0 +1,56 @@
+// Binary columnar framing of expenses for the ML service (see ml/wire.py):
+// a JSON header, then amounts as float64 and dates as int64 days since the epoch
+const CONTENT_TYPE = 'application/vnd.expense-columns';
+const MAGIC = Buffer.from('EXPCOL1\0', 'latin1');
+const DAY_MS = 24 * 60 * 60 * 1000;
+
+function padded(size) {
+  return size + ((8 - (size % 8)) % 8);
+}
+
+// Day number of a pg DATE/TIMESTAMP value or ISO string (its UTC date, like the JSON format)
+function epochDay(date) {
+  const time = date instanceof Date ? date.getTime() : Date.parse(String(date).slice(0, 10));
+  return Math.floor(time / DAY_MS);
+}
+
+/**
+ * Encode expense rows into a frame
+ * @param {object} header - request fields (user_id, category, ...)
+ * @param {Array<{meta: object, rows: Array<{amount, date}>}>} groups - one entry per group;
+ *   with a single group and no meta, the frame is a single-group frame
+ * @returns {Buffer}
+ */
+function encodeExpenses(header, groups) {
+  const total = groups.reduce((sum, group) => sum + group.rows.length, 0);
+  const amounts = new Float64Array(total);
+  const dates = new BigInt64Array(total);
+  let i = 0;
+  for (const group of groups) {
+    for (const row of group.rows) {
+      amounts[i] = Number(row.amount);
+      dates[i] = BigInt(epochDay(row.date));
+      i++;
+    }
+  }
+
+  const frameHeader = { ...header };
+  if (groups.length !== 1 || groups[0].meta) {
+    frameHeader.groups = groups.map(group => ({ ...group.meta, rows: group.rows.length }));
+  }
+  frameHeader.columns = [['amount', '<f8', total], ['date', '<i8', total]];
+  const headerJson = JSON.stringify(frameHeader);
+  const headerSize = padded(Buffer.byteLength(headerJson));
+
+  const columnSize = padded(total * 8);
+  const frame = Buffer.alloc(16 + headerSize + 2 * columnSize);
+  MAGIC.copy(frame, 0);
+  frame.writeUInt32LE(headerSize, 8);
+  frame.fill(' ', 16, 16 + headerSize);
+  frame.write(headerJson, 16);
+  Buffer.from(amounts.buffer).copy(frame, 16 + headerSize);
+  Buffer.from(dates.buffer).copy(frame, 16 + headerSize + columnSize);
+  return frame;
+}
+
+module.exports = { CONTENT_TYPE, encodeExpenses, epochDay };